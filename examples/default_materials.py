@@ -7,7 +7,7 @@ Created on Tue Feb  2 00:05:21 2016
 
 import numpy as np
 
-from opendxmc.engine import Engine
+from opendxmc.engine import Engine, pack_voxels
 from opendxmc.database import get_stored_materials
 from opendxmc.runner import generate_attinuation_lut
 import time
@@ -79,11 +79,12 @@ def cone_beam_example():
     lut_shape = np.array(lut.shape, dtype='int32')
     # and an array to store imparted energy
     energy_imparted = np.zeros_like(densities)
+    # material indices and densities are packed into one voxel array
+    voxels = pack_voxels(material_indices, densities)
     simulation = engine.setup_simulation(N, 
                                          spacing, 
                                          offset, 
-                                         material_indices, 
-                                         densities, 
+                                         voxels, 
                                          lut_shape, 
                                          lut,
                                          energy_imparted,
@@ -10,7 +10,8 @@ from scipy.ndimage.interpolation import affine_transform
 from opendxmc.database import Database, PROPETIES_DICT_TEMPLATE, Validator, PROPETIES_DICT_TEMPLATE_GROUPING
 from opendxmc.database.import_phantoms import read_phantoms
 from opendxmc.database import import_ct_series
-from opendxmc.runner import ct_runner
+from opendxmc.runner import ct_runner, SimulationCancelled
+from opendxmc.engine import Progress
 from opendxmc.utils import find_all_files
 import logging
 logger = logging.getLogger('OpenDXMC')
@@ -165,7 +166,7 @@ class DatabaseInterface(QtCore.QObject):
     send_view_array_bytescaled = QtCore.pyqtSignal(str, np.ndarray, str)  # simulation dict, array_slice, array_name, index, orientation
     send_view_array_slice = QtCore.pyqtSignal(str, np.ndarray, str, int, int)  # simulation dict, array_slice, array_name, index, orientation
     send_view_sim_propeties = QtCore.pyqtSignal(dict)
-    send_MC_ready_simulation = QtCore.pyqtSignal(dict, dict, list)
+    send_MC_ready_simulation = QtCore.pyqtSignal(dict, dict, list, dict)
 
     
     send_proper_database_path = QtCore.pyqtSignal(QtCore.QUrl)
@@ -368,8 +369,16 @@ class DatabaseInterface(QtCore.QObject):
             logger.warning('Request to materials for a ready simulations failed for a mysterious reason.')
             return
 
+        calibrations = self.__db.get_calibrations()
+
         logger.debug('Emmitting signal request to run simulation {}'.format(props['name']))
-        self.send_MC_ready_simulation.emit(props,arrays, materials)
+        self.send_MC_ready_simulation.emit(props,arrays, materials, calibrations)
+        self.database_busy.emit(False)
+
+    @QtCore.pyqtSlot(str, float)
+    def set_calibration(self, key, value):
+        self.database_busy.emit(True)
+        self.__db.set_calibration(key, value)
         self.database_busy.emit(False)
 
 
@@ -416,6 +425,7 @@ class Runner(QtCore.QThread):
     request_write_simulation_arrays = QtCore.pyqtSignal(str, dict)
     request_set_simulation_properties = QtCore.pyqtSignal(dict, bool, bool)
     request_runner_view_update = QtCore.pyqtSignal(np.ndarray, float, float, str, bool)
+    request_set_calibration = QtCore.pyqtSignal(str, float)
 
     start_timer = QtCore.pyqtSignal()
     def __init__(self, parent=None):
@@ -434,8 +444,9 @@ class Runner(QtCore.QThread):
         self.simulation_properties = None
         self.simulation_arrays = None
         self.material_list = None
+        self.calibrations = {}
 
-        self.kill_me = False
+        self.progress = None
         self.is_running=False
 
     @QtCore.pyqtSlot()
@@ -445,21 +456,23 @@ class Runner(QtCore.QThread):
         self.mutex.unlock()
     @QtCore.pyqtSlot()
     def cancel_run(self):
+        # the engine stops between histories and ct_runner returns by
+        # raising SimulationCancelled
         self.mutex.lock()
-        self.kill_me = True
+        if self.progress is not None:
+            self.progress.cancel()
         self.mutex.unlock()
 
+    def get_calibration(self, key):
+        # the runner is the calibration cache of ct_runner, calibrations are
+        # read from the database before the run and written back by signal
+        return self.calibrations.get(key, None)
+
+    def set_calibration(self, key, value):
+        self.calibrations[key] = value
+        self.request_set_calibration.emit(key, value)
+
     def update_simulation_iteration(self, name, array_dict=None, exposure_number=None, progressbar_data=None, save=True):
-        if self.kill_me:
-            self.request_runner_view_update.emit(np.ones((3, 3)), 1, 1, '', False)
-            self.mutex.lock()
-            self.kill_me = False
-            self.mutex.unlock()
-            self.is_running=False
-            self.terminated.emit()
-            self.terminate()
-            
-        
         if all([self.request_save, save, array_dict is not None, 
                 exposure_number is not None]):
             desc = {'name': name,
@@ -476,7 +489,7 @@ class Runner(QtCore.QThread):
     def run(self):
         self.is_running=True
         self.mutex.lock()
-        self.kill_me = False
+        self.progress = Progress()
         
 
         
@@ -503,7 +516,14 @@ class Runner(QtCore.QThread):
             props_dict, arr_dict = ct_runner(material_list, simulation_properties,
                                              energy_imparted_to_dose_conversion=True,
                                              callback=self.update_simulation_iteration,
+                                             progress=self.progress,
+                                             calibration_cache=self,
                                              **simulation_arrays)
+        except SimulationCancelled:
+            self.request_runner_view_update.emit(np.ones((3, 3)), 1, 1, '', False)
+            self.request_set_simulation_properties.emit({'name': simulation_properties['name'],
+                                                         'MC_running': False},
+                                                        False, False)
         except MemoryError:
             logger.error('MEMORY ERROR: Could not run simulation {0}, memory to low. Try to increase dose matrix scaling or use 64 bit version of OpenDXMC'.format(simulation_properties['name']))
             simulation_properties['MC_finished'] = False
@@ -540,6 +560,9 @@ class Runner(QtCore.QThread):
         self.simulation_arrays = None
         self.material_list = None
         self.request_save = False
+        self.mutex.lock()
+        self.progress = None
+        self.mutex.unlock()
         self.is_running=False
 
 
@@ -555,6 +578,7 @@ class RunManager(QtCore.QObject):
         self.runner.terminated.connect(interface.request_MC_ready_simulation)
         self.runner.request_set_simulation_properties.connect(interface.set_simulation_properties)
         self.runner.request_write_simulation_arrays.connect(interface.write_simulation_arrays)
+        self.runner.request_set_calibration.connect(interface.set_calibration)
         self.runner.finished.connect(self.run_finished)
         self.runner.terminated.connect(self.run_finished)
         self.runner.started.connect(self.run_started)
@@ -577,14 +601,15 @@ class RunManager(QtCore.QObject):
         self.current_simulation = ""
         self.mc_calculation_running.emit(False)
 
-    @QtCore.pyqtSlot(dict, dict, list)
-    def run_simulation(self, props, arrays, mat_list):
+    @QtCore.pyqtSlot(dict, dict, list, dict)
+    def run_simulation(self, props, arrays, mat_list, calibrations):
         logger.debug('Attemp to start MC thread')
         
         if not self.runner.is_running:
             self.runner.simulation_properties = props
             self.runner.simulation_arrays = arrays
             self.runner.material_list = mat_list
+            self.runner.calibrations = calibrations
             self.current_simulation = props['name']
             self.runner.start()
 #            self.runner.run()
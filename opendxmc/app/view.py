@@ -405,6 +405,7 @@ class ViewController(QtCore.QObject):
                        'material': MaterialScene(),
                        'energy imparted': DoseScene(),
                        'dose': DoseScene(front_array='dose'),
+                       'uncertainty': DoseScene(front_array='uncertainty'),
                        }
         self.glwidgets = {#'dose': View3D2(arrays=['ctarray','dose'], lut_names=['gist_earth','jet'], dim_scale=False, custom_data_range=[(0, 500), None]),
                           'doseCT': View3D(array='dose', lut_name='jet', dim_scale=True, smoothness=.5, custom_data_range=(0, .15), custom_data_range_is_modifier=True),
@@ -1464,7 +1465,8 @@ class DoseScene(Scene):
         self.array_names = ['ctarray', 'organ']
 
         self.front_array_name = front_array
-        self.image_item.cbar.setUnits('mGy/100mAs' if front_array == 'dose' else 'eV')
+        units = {'dose': 'mGy/100mAs', 'uncertainty': '(relative)'}
+        self.image_item.cbar.setUnits(units.get(front_array, 'eV'))
 
         self.front_array = None
 
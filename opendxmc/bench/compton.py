@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Statistical validation of the engine Compton sampling.
+
+The engine samples Compton scattered energies and angles from a
+Klein-Nishina inverse cdf table. For a range of photon energies samples from
+the table are compared with samples from the rejection sampler with a two
+sample chi-square test on the binned scatter angle cosines and a two sample
+Kolmogorov-Smirnov test on the scattered energies, and the sampling rate of
+both samplers is reported.
+
+Usage:
+    python -m opendxmc.bench.compton [--energies 20 50 100 150]
+        [--samples 1000000] [--precision float64 float32] [--output RESULTS]
+"""
+
+import sys
+import json
+import time
+import argparse
+import numpy as np
+from scipy import stats
+from opendxmc.engine import Engine, pack_voxels
+from opendxmc.database.import_materials import get_stored_materials
+from opendxmc.runner.ct_study_runner import generate_attinuation_lut
+import logging
+logger = logging.getLogger('OpenDXMC')
+
+
+def _sampling_simulation(engine, max_eV, seed):
+    # the compton table of a simulation covers the energies of its lut
+    materials = [m for m in get_stored_materials() if m.name == 'air']
+    lut = generate_attinuation_lut(materials, {0: 'air'}, max_eV=max_eV,
+                                   log_grid=True, dtype=engine.dtype)
+    N = np.array([2, 2, 2], dtype='int32')
+    voxels = pack_voxels(np.zeros((2, 2, 2), dtype='int32'),
+                         np.ones((2, 2, 2)))
+    energy_imparted = np.zeros((2, 2, 2), dtype='float64')
+    arrays = (N, np.ones(3, dtype=engine.dtype),
+              np.zeros(3, dtype=engine.dtype), voxels,
+              np.array(lut.shape, dtype='int32'), lut, energy_imparted,
+              np.array([0], dtype='int32'))
+    # the engine keeps pointers to the arrays
+    return engine.setup_simulation(*arrays, seed=seed), arrays
+
+
+def validate_compton_sampling(energies=(20e3, 50e3, 100e3, 150e3),
+                              samples=10**6, precision='float64', bins=100,
+                              significance=1e-3, seed=1):
+    """Compares samples size samples from the Compton inverse cdf table with
+    the rejection sampler for each energy in eV. Returns a list of result
+    dictionaries with the chi-square p value for the scatter angle cosines,
+    the Kolmogorov-Smirnov p value for the scattered energies, the relative
+    difference of the mean scattered energies, the samples per second of
+    each sampler and if both p values are above significance.
+    """
+    engine = Engine(precision=precision)
+    simulation, arrays = _sampling_simulation(engine, max(energies), seed)
+    results = []
+    for i, energy in enumerate(energies):
+        t0 = time.perf_counter()
+        table_energy, table_theta = engine.sample_compton(simulation, energy, samples,
+                                                          table=True, stream=2 * i)
+        t1 = time.perf_counter()
+        rejection_energy, rejection_theta = engine.sample_compton(simulation, energy, samples,
+                                                                  table=False, stream=2 * i + 1)
+        t2 = time.perf_counter()
+
+        table_hist, edges = np.histogram(np.cos(table_theta), bins=bins,
+                                         range=(-1., 1.))
+        rejection_hist, edges = np.histogram(np.cos(rejection_theta),
+                                             bins=edges)
+        counts = np.array([table_hist, rejection_hist])
+        counts = counts[:, counts.sum(axis=0) > 0]
+        chi2_p = float(stats.chi2_contingency(counts)[1])
+        ks_p = float(stats.ks_2samp(table_energy, rejection_energy).pvalue)
+        results.append({'energy': float(energy), 'precision': precision,
+                        'samples': int(samples),
+                        'angle_chi2_p': chi2_p,
+                        'energy_ks_p': ks_p,
+                        'mean_energy_difference': float(table_energy.mean() / rejection_energy.mean() - 1.),
+                        'table_samples_per_second': samples / (t1 - t0),
+                        'rejection_samples_per_second': samples / (t2 - t1),
+                        'passed': (chi2_p > significance) and (ks_p > significance)})
+    engine.cleanup(simulation=simulation)
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Validate the engine '
+                                     'Compton table sampling against the '
+                                     'rejection sampler.')
+    parser.add_argument('--energies', type=float, nargs='+',
+                        default=[20., 50., 100., 150.], help='energies in keV')
+    parser.add_argument('--samples', type=int, default=10**6)
+    parser.add_argument('--precision', nargs='+',
+                        choices=['float64', 'float32'],
+                        default=['float64', 'float32'])
+    parser.add_argument('--significance', type=float, default=1e-3)
+    parser.add_argument('--output', default=None, help='JSON result file')
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.WARNING)
+    results = []
+    for precision in args.precision:
+        results += validate_compton_sampling([e * 1000. for e in args.energies],
+                                             samples=args.samples,
+                                             precision=precision,
+                                             significance=args.significance)
+    for r in results:
+        print('{0:>6.1f} keV {1}: angle p {2:.3f}, energy p {3:.3f}, mean '
+              'difference {4:.1e}, table {5:.2f}x faster, {6}'.format(
+                  r['energy'] / 1000., r['precision'], r['angle_chi2_p'],
+                  r['energy_ks_p'], r['mean_energy_difference'],
+                  r['table_samples_per_second'] / r['rejection_samples_per_second'],
+                  'passed' if r['passed'] else 'FAILED'))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if all(r['passed'] for r in results):
+        return 0
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+"""
+Engine micro benchmarks runnable without the GUI.
+
+Synthetic geometries of a soft tissue cylinder in air with lung and bone
+inserts are simulated with bowtie and plain fan beam sources, and the
+histories per second are reported for each combination of volume size,
+tracking, precision, thread count and energy tally mode. With several
+thread counts the speedup over one thread is reported, which only measures
+scaling with at least as many cpus as threads. Results are written as JSON
+so regressions can be tracked across engine builds, a baseline result file
+can be compared with the current run.
+
+Usage:
+    python -m opendxmc.bench.engine [--sizes 32 64] [--tracking woodcock siddon]
+        [--precision float64 float32] [--threads 1 4] [--sources bowtie plain]
+        [--tally auto atomic private slab] [--output RESULTS]
+        [--baseline RESULTS]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import itertools
+import subprocess
+import numpy as np
+from opendxmc.engine import Engine, Progress, pack_voxels
+from opendxmc.database.import_materials import get_stored_materials
+from opendxmc.runner.ct_study_runner import generate_attinuation_lut
+from opendxmc.runner.ct_sources import ct_seq, batch_phase_space
+from opendxmc.tube.tungsten import specter
+import logging
+logger = logging.getLogger('OpenDXMC')
+
+BENCHMARK_VERSION = 1
+
+# material index of each tissue in synthetic geometries
+SYNTHETIC_MATERIALS = {0: 'air', 1: 'soft', 2: 'lung', 3: 'hardbone'}
+
+TRACKING = {'woodcock': 0, 'siddon': 1}
+
+
+def synthetic_geometry(size, heterogeneity=.1, width=32., seed=0):
+    """Returns material and density arrays of shape (size, size, size) and
+    the voxel spacing in cm for a soft tissue cylinder of diameter 80% of
+    width in air. A fraction heterogeneity of the cylinder is replaced by
+    spherical lung and bone inserts at random positions drawn from seed.
+    The physical size of the volume is independent of size, only the
+    resolution changes.
+    """
+    size = int(size)
+    spacing = np.repeat(width / size, 3)
+    x = np.arange(size) - size / 2. + .5
+    r2 = x[:, np.newaxis]**2 + x[np.newaxis, :]**2
+    material = np.zeros((size, size, size), dtype='int32')
+    material[r2 < (.4 * size)**2, :] = 1
+
+    heterogeneity = min(max(heterogeneity, 0.), 1.)
+    inside = np.count_nonzero(material)
+    target = heterogeneity * inside
+    random = np.random.RandomState(seed)
+    radius = max(size / 10., 1.)
+    filled = 0
+    insert = 2
+    for i in range(10000):
+        if filled >= target:
+            break
+        center = random.uniform(-.4 * size + radius, .4 * size - radius, 3)
+        center[2] = random.uniform(-size / 2. + radius, size / 2. - radius)
+        d2 = ((x[:, np.newaxis, np.newaxis] - center[0])**2 +
+              (x[np.newaxis, :, np.newaxis] - center[1])**2 +
+              (x[np.newaxis, np.newaxis, :] - center[2])**2)
+        sphere = (d2 < radius**2) & (material == 1)
+        if not sphere.any():
+            continue
+        material[sphere] = insert
+        filled += np.count_nonzero(sphere)
+        insert = 5 - insert
+
+    densities = {m.name: m.density for m in get_stored_materials()
+                 if m.name in SYNTHETIC_MATERIALS.values()}
+    density = np.choose(material, [densities[SYNTHETIC_MATERIALS[i]]
+                                   for i in range(len(SYNTHETIC_MATERIALS))])
+    return material, density.astype('float64'), spacing
+
+
+def _engine_library(precision):
+    # path of the engine build for precision, for identifying builds
+    suffix = 'f' if np.dtype(precision) == np.dtype('float32') else ''
+    path = os.path.dirname(os.path.abspath(sys.modules[Engine.__module__].__file__))
+    for ext in ['.so', '.dll']:
+        name = os.path.join(path, 'enginelib64' + suffix + ext)
+        if os.path.isfile(name):
+            return name
+    return None
+
+
+def _git_revision():
+    path = os.path.dirname(os.path.abspath(__file__))
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                           cwd=path, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return revision.decode('utf-8').strip()
+
+
+def benchmark_metadata(label=''):
+    """Returns a dictionary describing the machine and engine build."""
+    builds = {}
+    for precision in ['float64', 'float32']:
+        library = _engine_library(precision)
+        if library is not None:
+            builds[precision] = {'path': library,
+                                 'modified': time.ctime(os.path.getmtime(library))}
+    return {'benchmark_version': BENCHMARK_VERSION,
+            'label': label,
+            'time': time.ctime(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'git_revision': _git_revision(),
+            'engine_builds': builds}
+
+
+def _phase_space(exposures, histories, kV, dtype):
+    energy_specter = specter(kV, angle_deg=12., filtration_materials='Al',
+                             filtration_mm=7.)
+    phase_space = ct_seq(50., 100., 4., start=0, stop=0, step=1,
+                         exposures=exposures, histories=histories,
+                         energy_specter=energy_specter, bowtie_radius=15,
+                         bowtie_distance=10, dtype=dtype)
+    return list(batch_phase_space(phase_space, exposures))[0][:5]
+
+
+def _run_bowtie(engine, simulation, block, histories):
+    p, positions, directions, scan_axes, weights = block
+    source = engine.setup_source_bowtie(*p)
+    engine.set_random_stream(simulation, 0)
+    engine.run_bowtie_batch(source, positions, directions, scan_axes,
+                            weights, histories, simulation)
+    engine.cleanup(source=source)
+
+
+def _run_plain(engine, simulation, block, histories):
+    p, positions, directions, scan_axes, weights = block
+    dtype = engine.dtype
+    sdd = np.array([100.], dtype=dtype)
+    fov = np.array([50.], dtype=dtype)
+    collimation = np.array([4.], dtype=dtype)
+    engine.set_random_stream(simulation, 0)
+    for i in range(weights.shape[0]):
+        source = engine.setup_source(positions[i], directions[i],
+                                     scan_axes[i], sdd, fov, collimation,
+                                     weights[i:i + 1], p[6], p[7],
+                                     np.asarray(p[8], dtype='int32'))
+        engine.run(source, histories, simulation)
+        engine.cleanup(source=source)
+
+
+SOURCES = {'bowtie': _run_bowtie, 'plain': _run_plain}
+
+
+def benchmark_case(size, tracking='woodcock', precision='float64',
+                   threads=None, source='bowtie', tally='auto',
+                   heterogeneity=.1, exposures=16, histories=1000, repeats=3,
+                   kV=120., seed=0):
+    """Simulates exposures exposures of a sequential rotation with
+    histories histories each on a synthetic geometry repeats times and
+    returns a result dictionary with the histories per second of the best
+    and median repeat, the photon interactions per history and the total
+    energy imparted of the first repeat. tally is the energy tally mode of
+    the Engine. A short run before timing warms up caches and threads.
+    """
+    dtype = np.dtype(precision)
+    material, density, spacing = synthetic_geometry(size, heterogeneity,
+                                                    seed=seed)
+    materials = [m for m in get_stored_materials()
+                 if m.name in SYNTHETIC_MATERIALS.values()]
+    lut = generate_attinuation_lut(materials, SYNTHETIC_MATERIALS,
+                                   max_eV=kV * 1000., log_grid=True,
+                                   dtype=dtype)
+    N = np.array(material.shape, dtype='int32')
+    spacing = spacing.astype(dtype)
+    offset = (-N * spacing / 2.).astype(dtype)
+    voxels = pack_voxels(material, density)
+    lut_shape = np.array(lut.shape, dtype='int32')
+    use_siddon = np.array([TRACKING[tracking]], dtype='int32')
+    energy_imparted = np.zeros(material.shape, dtype='float64')
+    block = _phase_space(exposures, histories, kV, dtype)
+    run = SOURCES[source]
+
+    engine = Engine(precision=dtype.name, threads=threads, tally=tally)
+    simulation = engine.setup_simulation(N, spacing, offset, voxels,
+                                         lut_shape, lut, energy_imparted,
+                                         use_siddon, seed=seed + 1)
+    progress = Progress()
+    engine.set_progress(simulation, progress)
+    run(engine, simulation, block, max(histories // 10, 1))
+    engine.end_batch(simulation)
+
+    times = []
+    energy = None
+    interactions = None
+    for i in range(max(int(repeats), 1)):
+        energy_imparted[:] = 0
+        progress.reset()
+        t0 = time.perf_counter()
+        run(engine, simulation, block, histories)
+        engine.end_batch(simulation)
+        times.append(time.perf_counter() - t0)
+        if energy is None:
+            energy = float(energy_imparted.sum())
+            interactions = progress.interactions / max(progress.histories, 1)
+    engine.cleanup(simulation=simulation)
+
+    n_histories = exposures * histories
+    return {'size': int(size), 'tracking': tracking,
+            'precision': dtype.name, 'threads': threads, 'source': source,
+            'tally': tally, 'heterogeneity': heterogeneity, 'exposures': exposures,
+            'histories': n_histories, 'seconds': times,
+            'histories_per_second': n_histories / min(times),
+            'histories_per_second_median': n_histories / float(np.median(times)),
+            'interactions_per_history': interactions,
+            'energy_imparted': energy}
+
+
+def run_benchmarks(sizes=(32, 64), tracking=('woodcock', 'siddon'),
+                   precision=('float64', 'float32'), threads=(None,),
+                   sources=('bowtie', 'plain'), tallies=('auto',), label='',
+                   callback=None, **kwargs):
+    """Runs benchmark_case for every combination of sizes, tracking,
+    precision, threads, sources and tally modes, remaining keyword arguments
+    are passed to benchmark_case. Returns a dictionary with the benchmark
+    metadata and a list of case results. callback is called with each case
+    result.
+    """
+    results = []
+    for case in itertools.product(sizes, tracking, precision, threads, sources, tallies):
+        result = benchmark_case(*case, **kwargs)
+        results.append(result)
+        if callback is not None:
+            callback(result)
+    return {'metadata': benchmark_metadata(label), 'results': results}
+
+
+CASE_KEYS = ['size', 'tracking', 'precision', 'threads', 'source', 'tally',
+             'heterogeneity', 'exposures', 'histories']
+
+
+def thread_scaling(results):
+    """Returns a list of (result, speedup) for results with more than one
+    thread, where speedup is the ratio of histories per second to the one
+    thread result of the same case. Results without a one thread run of
+    their case are left out.
+    """
+    def key(result):
+        return tuple(result.get(k, None) for k in CASE_KEYS if k != 'threads')
+    single = {key(r): r for r in results if r['threads'] == 1}
+    scaling = []
+    for result in results:
+        if (result['threads'] or 0) <= 1:
+            continue
+        reference = single.get(key(result), None)
+        if reference is None:
+            continue
+        scaling.append((result, result['histories_per_second'] /
+                        reference['histories_per_second']))
+    return scaling
+
+
+def compare_benchmarks(baseline, current, tolerance=.1):
+    """Returns a list of (case, speedup) for cases in current also found in
+    baseline, where speedup is the ratio of histories per second, and a
+    list of cases slower than baseline by more than tolerance.
+    """
+    def key(result):
+        # results from before the tally mode was recorded used 'auto'
+        return tuple(result.get(k, 'auto' if k == 'tally' else None) for k in CASE_KEYS)
+    reference = {key(r): r for r in baseline['results']}
+    speedups = []
+    regressions = []
+    for result in current['results']:
+        old = reference.get(key(result), None)
+        if old is None:
+            continue
+        speedup = result['histories_per_second'] / old['histories_per_second']
+        speedups.append((key(result), speedup))
+        if speedup < 1. - tolerance:
+            regressions.append(key(result))
+    return speedups, regressions
+
+
+def _case_name(result):
+    threads = result['threads'] if result['threads'] else 'default'
+    return '{0}^3 {1} {2} {3} {4} threads:{5}'.format(result['size'],
+                                                       result['tracking'],
+                                                       result['precision'],
+                                                       result['source'],
+                                                       result.get('tally', 'auto'),
+                                                       threads)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark the OpenDXMC '
+                                     'engine on synthetic geometries.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[32, 64])
+    parser.add_argument('--tracking', nargs='+', choices=list(TRACKING),
+                        default=['woodcock', 'siddon'])
+    parser.add_argument('--precision', nargs='+',
+                        choices=['float64', 'float32'],
+                        default=['float64', 'float32'])
+    parser.add_argument('--threads', type=int, nargs='+', default=[0],
+                        help='thread counts, 0 uses the OpenMP default')
+    parser.add_argument('--sources', nargs='+', choices=list(SOURCES),
+                        default=['bowtie', 'plain'])
+    parser.add_argument('--tally', nargs='+',
+                        choices=['auto', 'atomic', 'private', 'slab'],
+                        default=['auto'], help='energy tally modes')
+    parser.add_argument('--heterogeneity', type=float, default=.1)
+    parser.add_argument('--exposures', type=int, default=16)
+    parser.add_argument('--histories', type=int, default=1000,
+                        help='histories per exposure')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--label', default='',
+                        help='label identifying the engine build')
+    parser.add_argument('--output', default=None,
+                        help='JSON result file, results are printed if not given')
+    parser.add_argument('--baseline', default=None,
+                        help='JSON result file to compare with')
+    parser.add_argument('--tolerance', type=float, default=.1,
+                        help='relative slowdown reported as a regression')
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.WARNING)
+
+    def report(result):
+        print('{0:<56} {1:>12.0f} histories/s'.format(_case_name(result),
+                                                       result['histories_per_second']))
+
+    threads = [t if t > 0 else None for t in args.threads]
+    if max(args.threads) > (os.cpu_count() or 1):
+        logger.warning('More threads than the {} cpus of this machine, the '
+                       'speedups do not measure scaling'.format(os.cpu_count()))
+    results = run_benchmarks(sizes=args.sizes, tracking=args.tracking,
+                             precision=args.precision, threads=threads,
+                             sources=args.sources, tallies=args.tally,
+                             label=args.label,
+                             callback=report,
+                             heterogeneity=args.heterogeneity,
+                             exposures=args.exposures,
+                             histories=args.histories, repeats=args.repeats)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    for result, speedup in thread_scaling(results['results']):
+        print('{0:<56} {1:>6.2f}x one thread'.format(_case_name(result), speedup))
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        speedups, regressions = compare_benchmarks(baseline, results,
+                                                   args.tolerance)
+        for case, speedup in speedups:
+            print('{0:<56} {1:>6.2f}x'.format(_case_name(dict(zip(CASE_KEYS, case))),
+                                              speedup))
+        if regressions:
+            print('{} cases are slower than the baseline'.format(len(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
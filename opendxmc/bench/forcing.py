@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Variance gain of forced first interactions.
+
+Phantoms are simulated in batches with analogue transport and with the
+first interaction of each source photon forced inside the volume. For each
+organ, or tissue of the synthetic phantoms, the relative uncertainty of the
+organ energy, the efficiency 1 / (sigma^2 T) and the efficiency gain of
+forcing are reported, and the organ energies of both runs are compared to
+check that forcing is unbiased.
+
+Phantoms are read with read_phantoms from the voxel phantom files given,
+such as the Katja and segm_child files. Without phantom files a synthetic
+adult sized and a thin phantom are simulated.
+
+Usage:
+    python -m opendxmc.bench.forcing [--phantoms FILE [FILE ...]]
+        [--scale 4 4 1] [--tracking siddon woodcock] [--batches 10]
+        [--histories 1000] [--output RESULTS]
+"""
+
+import sys
+import json
+import argparse
+import numpy as np
+from opendxmc.database.import_materials import get_stored_materials
+from opendxmc.database.import_phantoms import read_phantoms
+from opendxmc.runner.ct_study_runner import generate_attinuation_lut
+from opendxmc.runner.ct_study_runner import prepare_geometry_from_organ_array
+from opendxmc.runner.ct_study_runner import recarray_to_dict
+from opendxmc.bench.engine import synthetic_geometry, SYNTHETIC_MATERIALS
+from opendxmc.bench.engine import TRACKING, _phase_space
+from opendxmc.bench.scoring import run_batches, region_statistics
+from opendxmc.bench.scoring import energy_difference_sigma
+import logging
+logger = logging.getLogger('OpenDXMC')
+
+# width in cm of the synthetic phantoms
+SYNTHETIC_PHANTOMS = {'synthetic': 32., 'synthetic_thin': 12.}
+
+
+def synthetic_phantoms(size=32):
+    """Yields name, material, density, spacing, material_map, regions and
+    region names of the synthetic phantoms, regions are the materials."""
+    for name, width in sorted(SYNTHETIC_PHANTOMS.items()):
+        material, density, spacing = synthetic_geometry(size, width=width)
+        yield (name, material, density, spacing, SYNTHETIC_MATERIALS,
+               material, SYNTHETIC_MATERIALS)
+
+
+def voxel_phantoms(paths, scale=(4, 4, 1)):
+    """Yields name, material, density, spacing, material_map, regions and
+    region names of the phantoms read from paths, downsampled by scale.
+    Regions are the phantom organs."""
+    materials = get_stored_materials()
+    for props, arrays in read_phantoms(paths):
+        material_map, material, density = prepare_geometry_from_organ_array(arrays['organ'],
+                                                                            arrays['organ_material_map'],
+                                                                            scale, materials)
+        organ = np.asarray(arrays['organ'][::scale[0], ::scale[1], ::scale[2]], dtype='int32')
+        spacing = np.asarray(props['spacing'], dtype='float64') * np.asarray(scale)
+        organ_map = recarray_to_dict(arrays['organ_map'], value_is_string=True)
+        yield (props['name'], material, density, spacing, material_map,
+               organ, {int(k): v for k, v in organ_map.items()})
+
+
+def compare_forcing(phantom, tracking='siddon', precision='float64',
+                    batches=10, exposures=16, histories=1000, kV=120.,
+                    scoring='collision', min_voxels=8, seed=1):
+    """Simulates batches batches of exposures exposures with histories
+    histories each on phantom, a tuple from synthetic_phantoms or
+    voxel_phantoms, with analogue transport and forced first interactions.
+    Returns a list of result dictionaries, one for each region with at least
+    min_voxels voxels, with the region_statistics of both runs, the
+    efficiency gain of forcing and the difference of the region energies in
+    standard deviations.
+    """
+    name, material, density, spacing, material_map, regions, region_names = phantom
+    batches = max(int(batches), 2)
+    dtype = np.dtype(precision)
+    materials = [m for m in get_stored_materials()
+                 if m.name in material_map.values()]
+    lut = generate_attinuation_lut(materials, material_map,
+                                   max_eV=kV * 1000., log_grid=True,
+                                   dtype=dtype)
+    block = _phase_space(exposures, histories, kV, dtype)
+
+    runs = {}
+    for forced in (False, True):
+        runs[forced] = run_batches(tracking, material, density, spacing, lut,
+                                   block, batches, histories, regions,
+                                   seed=seed, precision=dtype.name,
+                                   scoring=scoring, forced_interaction=forced)
+
+    results = []
+    for label in np.unique(regions):
+        inside = regions == label
+        if np.count_nonzero(inside) < min_voxels:
+            continue
+        result = {'phantom': name,
+                  'region': region_names.get(int(label), str(label)),
+                  'voxels': int(np.count_nonzero(inside)),
+                  'tracking': tracking, 'scoring': scoring,
+                  'precision': dtype.name, 'batches': batches,
+                  'histories': batches * exposures * histories,
+                  'analogue': region_statistics(runs[False], inside, label),
+                  'forced': region_statistics(runs[True], inside, label)}
+        result['efficiency_gain'] = (result['forced']['efficiency'] /
+                                     result['analogue']['efficiency'])
+        result['energy_difference_sigma'] = energy_difference_sigma(result['forced'],
+                                                                    result['analogue'])
+        results.append(result)
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Report the variance gain '
+                                     'of forced first interactions.')
+    parser.add_argument('--phantoms', nargs='+', default=[],
+                        help='voxel phantom files, synthetic phantoms are '
+                        'used if not given')
+    parser.add_argument('--scale', type=int, nargs=3, default=[4, 4, 1],
+                        help='downsampling of the voxel phantoms')
+    parser.add_argument('--size', type=int, default=32,
+                        help='voxels along each axis of the synthetic phantoms')
+    parser.add_argument('--tracking', nargs='+', choices=list(TRACKING),
+                        default=['siddon', 'woodcock'])
+    parser.add_argument('--scoring', choices=['collision', 'track_length'],
+                        default='collision')
+    parser.add_argument('--precision', choices=['float64', 'float32'],
+                        default='float64')
+    parser.add_argument('--batches', type=int, default=10)
+    parser.add_argument('--exposures', type=int, default=16)
+    parser.add_argument('--histories', type=int, default=1000,
+                        help='histories per exposure and batch')
+    parser.add_argument('--output', default=None, help='JSON result file')
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.phantoms:
+        phantoms = list(voxel_phantoms(args.phantoms, args.scale))
+        if not phantoms:
+            print('No phantoms found in {}'.format(', '.join(args.phantoms)))
+            return 1
+    else:
+        phantoms = list(synthetic_phantoms(args.size))
+    results = []
+    for phantom in phantoms:
+        for tracking in args.tracking:
+            results += compare_forcing(phantom, tracking, args.precision,
+                                       batches=args.batches,
+                                       exposures=args.exposures,
+                                       histories=args.histories,
+                                       scoring=args.scoring)
+    for r in results:
+        print('{0:<14} {1:<9} {2:<24}: uncertainty analogue {3:.3f}, forced '
+              '{4:.3f}, efficiency gain {5:.2f}x, energy difference '
+              '{6:+.1f} sigma'.format(r['phantom'], r['tracking'],
+                                      r['region'][:24],
+                                      r['analogue']['relative_uncertainty'],
+                                      r['forced']['relative_uncertainty'],
+                                      r['efficiency_gain'],
+                                      r['energy_difference_sigma']))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
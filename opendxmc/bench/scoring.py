@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Efficiency comparison of the engine energy scoring estimators.
+
+The synthetic geometry of the engine benchmark is simulated in batches with
+the collision and the track length estimator. For each tissue region the
+relative uncertainty of the region energy from the batch variance is
+reported together with the simulation time and the efficiency
+1 / (sigma^2 T), the inverse of the time needed to reach unit relative
+variance, and the mean relative voxel uncertainty. The energy imparted in
+each region by both estimators is compared to check that they agree within
+their uncertainties.
+
+Usage:
+    python -m opendxmc.bench.scoring [--size 32] [--tracking woodcock siddon]
+        [--batches 10] [--histories 1000] [--output RESULTS]
+"""
+
+import sys
+import json
+import time
+import argparse
+import numpy as np
+from opendxmc.engine import Engine, pack_voxels
+from opendxmc.database.import_materials import get_stored_materials
+from opendxmc.runner.ct_study_runner import generate_attinuation_lut
+from opendxmc.bench.engine import synthetic_geometry, SYNTHETIC_MATERIALS
+from opendxmc.bench.engine import TRACKING, _phase_space
+import logging
+logger = logging.getLogger('OpenDXMC')
+
+ESTIMATORS = ['collision', 'track_length']
+
+
+def run_batches(tracking, material, density, spacing, lut, block, batches,
+                histories, regions, seed=1, importance=None, **kwargs):
+    """Simulates batches batches of the bowtie source block with histories
+    histories per exposure on the geometry, keyword arguments are passed to
+    Engine. regions is an integer array of the geometry shape labelling the
+    voxels and importance an optional voxel importance map, see
+    Engine.setup_simulation. Returns the energy imparted, the sum of squared
+    batch energies, a (batches, n_labels) array of the energy imparted in
+    each label of regions by each batch and the simulation time.
+    """
+    engine = Engine(**kwargs)
+    dtype = engine.dtype
+    N = np.array(material.shape, dtype='int32')
+    spacing = spacing.astype(dtype)
+    offset = (-N * spacing / 2.).astype(dtype)
+    energy_imparted = np.zeros(material.shape, dtype='float64')
+    energy_squared = np.zeros(material.shape, dtype='float64')
+    # the engine keeps pointers to the arrays
+    voxels = pack_voxels(material, density)
+    lut_shape = np.array(lut.shape, dtype='int32')
+    use_siddon = np.array([TRACKING[tracking]], dtype='int32')
+    simulation = engine.setup_simulation(N, spacing, offset, voxels,
+                                         lut_shape, lut, energy_imparted,
+                                         use_siddon,
+                                         energy_squared=energy_squared,
+                                         importance=importance, seed=seed)
+    p, positions, directions, scan_axes, weights = block
+    source = engine.setup_source_bowtie(*p)
+
+    labels = regions.ravel()
+    n_labels = int(labels.max()) + 1
+    region_batches = np.zeros((batches, n_labels))
+    previous = np.zeros_like(energy_imparted)
+    t0 = time.perf_counter()
+    for i in range(batches):
+        engine.run_bowtie_batch(source, positions, directions, scan_axes,
+                                weights, histories, simulation)
+        engine.end_batch(simulation)
+        batch = energy_imparted - previous
+        previous[:] = energy_imparted
+        region_batches[i] = np.bincount(labels, weights=batch.ravel(),
+                                        minlength=n_labels)
+    seconds = time.perf_counter() - t0
+    engine.cleanup(simulation=simulation, source=source)
+    return energy_imparted, energy_squared, region_batches, seconds
+
+
+def _relative_variance(energy, squared, batches):
+    # relative variance of the sum of batches from the spread of the batch
+    # sums, voxels without energy are nan
+    mean = energy / batches
+    variance = np.clip(squared / batches - mean**2, 0, None) * batches / (batches - 1.)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(energy > 0, batches * variance / energy**2, np.nan)
+
+
+def region_statistics(run, inside, label):
+    """Returns a dictionary with the energy imparted in region label of a
+    result of run_batches, its relative uncertainty and the efficiency
+    1 / (sigma^2 T) of the region energy, and the mean relative voxel
+    uncertainty and fraction of voxels with energy imparted of the voxels in
+    the boolean array inside.
+    """
+    energy, squared, region_batches, seconds = run
+    batches = region_batches.shape[0]
+    relative_variance = _relative_variance(energy[inside], squared[inside],
+                                           batches)
+    scored = np.isfinite(relative_variance)
+    if scored.any():
+        voxel_variance = float(np.mean(relative_variance[scored]))
+    else:
+        voxel_variance = float('nan')
+    total = region_batches[:, label]
+    region_energy = float(total.sum())
+    region_sigma = float(np.std(total, ddof=1) * np.sqrt(batches))
+    if region_energy > 0:
+        uncertainty = region_sigma / region_energy
+    else:
+        uncertainty = float('nan')
+    return {'energy': region_energy,
+            'energy_sigma': region_sigma,
+            'relative_uncertainty': uncertainty,
+            'seconds': seconds,
+            'efficiency': 1. / (uncertainty**2 * seconds),
+            'voxel_relative_uncertainty': float(np.sqrt(voxel_variance)),
+            'scored_fraction': float(np.mean(scored))}
+
+
+def energy_difference_sigma(result, reference):
+    """Difference of the region energies of two region_statistics results
+    in combined standard deviations."""
+    sigma = np.sqrt(result['energy_sigma']**2 + reference['energy_sigma']**2)
+    if sigma > 0:
+        return float((result['energy'] - reference['energy']) / sigma)
+    return 0.
+
+
+def compare_estimators(size=32, tracking='woodcock', precision='float64',
+                       batches=10, exposures=16, histories=1000, kV=120.,
+                       heterogeneity=.1, seed=1):
+    """Simulates batches batches of exposures exposures with histories
+    histories each with both estimators on the synthetic geometry of size
+    voxels along each axis. Returns a list of result dictionaries, one per
+    tissue region, with the region_statistics of each estimator, the
+    efficiency gain of track length scoring and the difference of the
+    region energies in standard deviations.
+    """
+    batches = max(int(batches), 2)
+    dtype = np.dtype(precision)
+    material, density, spacing = synthetic_geometry(size, heterogeneity)
+    materials = [m for m in get_stored_materials()
+                 if m.name in SYNTHETIC_MATERIALS.values()]
+    lut = generate_attinuation_lut(materials, SYNTHETIC_MATERIALS,
+                                   max_eV=kV * 1000., log_grid=True,
+                                   dtype=dtype)
+    block = _phase_space(exposures, histories, kV, dtype)
+
+    runs = {}
+    for scoring in ESTIMATORS:
+        runs[scoring] = run_batches(tracking, material, density, spacing,
+                                    lut, block, batches, histories, material,
+                                    seed=seed, precision=dtype.name,
+                                    scoring=scoring)
+
+    results = []
+    for region in sorted(SYNTHETIC_MATERIALS):
+        inside = material == region
+        if not inside.any():
+            continue
+        result = {'region': SYNTHETIC_MATERIALS[region], 'size': int(size),
+                  'tracking': tracking, 'precision': dtype.name,
+                  'batches': batches,
+                  'histories': batches * exposures * histories}
+        for scoring in ESTIMATORS:
+            result[scoring] = region_statistics(runs[scoring], inside, region)
+        result['efficiency_gain'] = (result['track_length']['efficiency'] /
+                                     result['collision']['efficiency'])
+        result['energy_difference_sigma'] = energy_difference_sigma(result['track_length'],
+                                                                    result['collision'])
+        results.append(result)
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Compare the efficiency of '
+                                     'the collision and track length energy '
+                                     'estimators.')
+    parser.add_argument('--size', type=int, default=32)
+    parser.add_argument('--tracking', nargs='+', choices=list(TRACKING),
+                        default=['woodcock', 'siddon'])
+    parser.add_argument('--precision', choices=['float64', 'float32'],
+                        default='float64')
+    parser.add_argument('--batches', type=int, default=10)
+    parser.add_argument('--exposures', type=int, default=16)
+    parser.add_argument('--histories', type=int, default=1000,
+                        help='histories per exposure and batch')
+    parser.add_argument('--heterogeneity', type=float, default=.1)
+    parser.add_argument('--output', default=None, help='JSON result file')
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.WARNING)
+    results = []
+    for tracking in args.tracking:
+        results += compare_estimators(args.size, tracking, args.precision,
+                                      batches=args.batches,
+                                      exposures=args.exposures,
+                                      histories=args.histories,
+                                      heterogeneity=args.heterogeneity)
+    for r in results:
+        print('{0:<9} {1:<9}: uncertainty collision {2:.3f}, track length '
+              '{3:.3f}, efficiency gain {4:.2f}x, energy difference '
+              '{5:+.1f} sigma'.format(r['tracking'], r['region'],
+                                      r['collision']['relative_uncertainty'],
+                                      r['track_length']['relative_uncertainty'],
+                                      r['efficiency_gain'],
+                                      r['energy_difference_sigma']))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
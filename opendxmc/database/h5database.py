@@ -37,6 +37,7 @@ PROPETIES_DICT_TEMPLATE = {
     'ctdi_vol100': [0., np.dtype(np.double), True, True, 'CTDIvol [mGy/100mAs/pitch]', 2, 4],
     'ctdi_w100': [0., np.dtype(np.double), True, True, 'CTDIw [mGy/100mAs]', 2, 4],
     'ctdi_phantom_diameter': [32., np.dtype(np.double), True, True, 'CTDI phantom diameter [cm]', 2, 4],
+    'recompute_calibration': [False, np.dtype(np.bool), False, True, 'Simulate the CTDI measurements even if the conversion factors are cached', 2, 4],
     'kV': [120., np.dtype(np.double), True, True, 'Simulation tube potential [kV]', 0, 3],
     'aquired_kV': [0., np.dtype(np.double), False, False, 'Images aquired with tube potential [kV]', 0, 2],
     'region': ['abdomen', np.dtype('a64'), False, False, 'Examination region', 0, 5],
@@ -48,12 +49,31 @@ PROPETIES_DICT_TEMPLATE = {
     'pitch': [1, np.dtype(np.double), True, True, 'Pitch', 0, 3],
     'exposures': [1200, np.dtype(np.int), True, True, 'Number of exposures in one rotation', 0, 3],
     'histories': [1000, np.dtype(np.int), True, True, 'Number of photon histories per exposure', 0, 3],
+    'batch_size': [100, np.dtype(np.int), False, True, 'Number of exposures simulated per engine call', 0, 3],
+    'processes': [0, np.dtype(np.int), False, True, 'Number of engine worker processes exposures are shared between, 0 or 1 runs the engine in the application process', 2, 3],
+    'threads_per_process': [0, np.dtype(np.int), False, True, 'Number of threads for each engine, 0 uses the OpenMP default', 2, 3],
+    'thread_schedule': ['dynamic', np.dtype('a16'), False, True, 'Scheduling of histories on engine threads, static, dynamic, guided or auto', 2, 3],
+    'chunk_size': [64, np.dtype(np.int), False, True, 'Number of histories handed to an engine thread at a time, 0 uses the schedule default', 2, 3],
+    'cpu_affinity': ['', np.dtype('a256'), False, True, 'Comma separated cpus engine threads are pinned to, empty does not pin threads', 2, 3],
+    'autotune_threads': [False, np.dtype(np.bool), False, True, 'Choose threads per process and chunk size from short test runs on the simulation geometry', 2, 3],
+    'phase_space_mode': ['none', np.dtype('a16'), False, True, 'Phase space file use, none, source or boundary to record photons leaving the source or entering the volume, replay to use recorded photons as source, both run uncertainty_batches batches without target uncertainty or time budget', 2, 3],
+    'phase_space_file': ['', np.dtype('a256'), False, True, 'Path of the phase space file recorded or replayed', 2, 3],
+    'uncertainty_batches': [10, np.dtype(np.int), True, True, 'Number of batches histories are split in to estimate dose uncertainty, 0 or 1 disables', 0, 3],
+    'target_uncertainty': [0., np.dtype(np.double), True, True, 'Target relative dose uncertainty, batches are added until it is reached, 0 disables', 0, 3],
+    'target_organs': ['', np.dtype('a256'), True, True, 'Comma separated organs the target uncertainty and importance factor apply to, empty for the whole volume', 2, 3],
+    'time_budget': [0., np.dtype(np.double), True, True, 'Simulation time budget [min], batches are added until it is spent, at least two batches are simulated, 0 disables', 0, 3],
+    'max_uncertainty_batches': [100, np.dtype(np.int), True, True, 'Maximum number of batches for target uncertainty or time budget runs', 2, 3],
+    'uncertainty_reached': [0., np.dtype(np.double), True, False, 'Relative dose uncertainty reached', 0, 3],
+    'batches_simulated': [0, np.dtype(np.int), True, False, 'Number of batches simulated', 2, 3],
+    'random_seed': [0, np.dtype(np.int), True, True, 'Random number seed, 0 draws a new seed for each run', 2, 3],
+    'random_seed_used': [0, np.dtype(np.int), True, False, 'Random number seed used in the simulation', 2, 3],
     'start_scan': [0, np.dtype(np.double), False, False, 'CT scan start position [cm]', 0, 2],
     'stop_scan': [0, np.dtype(np.double), False, False, 'CT scan stop position [cm]', 0, 2],
     'start': [0, np.dtype(np.double), True, True, 'Start position [cm]', 2, 3],
     'stop': [0, np.dtype(np.double), True, True, 'Stop position [cm]', 2, 3],
     'step': [1, np.dtype(np.int), True, True, 'Sequential aqusition step size [cm]', 0, 3],
     'start_at_exposure_no': [0, np.dtype(np.int), True, False, 'Start simulating exposure number', 0, 3],
+    'stop_at_exposure_no': [0, np.dtype(np.int), True, False, 'Stop simulating before exposure number, 0 simulates all exposures', 0, 3],
     'MC_finished': [False, np.dtype(np.bool), True, False, 'Simulation finished', 0, 3],
     'MC_ready': [False, np.dtype(np.bool), True, False, 'Simulation ready', 0, 3],
     'MC_running': [False, np.dtype(np.bool), True, False, 'Simulation is running', 0, 3],
@@ -67,6 +87,16 @@ PROPETIES_DICT_TEMPLATE = {
     'data_center': [np.zeros(3, dtype=np.double), np.dtype((np.double, 3)), True, True, 'Data collection center (relative to first voxel in volume) [cm]', 0, 3],
     'is_phantom': [False, np.dtype(np.bool), False, False, 'Matematical phantom', 0, 5],
     'use_siddon': [False, np.dtype(np.bool), True, True, 'Use Siddon tracking, default is Woodcock tracking', 0, 3],
+    'single_precision': [False, np.dtype(np.bool), True, True, 'Use single precision engine, energy is still summed in double precision', 0, 3],
+    'instrumented_engine': [False, np.dtype(np.bool), True, True, 'Use the slower instrumented engine counting transport events', 2, 3],
+    'energy_scoring': ['collision', np.dtype('a16'), True, True, 'Energy scoring estimator, collision scores energy at interactions, track_length scores kerma along photon paths', 2, 3],
+    'forced_interaction': [False, np.dtype(np.bool), True, True, 'Force the first interaction of source photons inside the patient, reduces noise in lungs and thin patients', 2, 3],
+    'importance_factor': [1., np.dtype(np.double), True, True, 'Importance of the target organs relative to the rest of the patient, photons are split entering and rouletted leaving the target organs, 1 disables', 2, 3],
+    'weight_cutoff': [0.01, np.dtype(np.double), True, True, 'Photon weight below which photons play russian roulette', 2, 3],
+    'roulette_survival': [0.2, np.dtype(np.double), True, True, 'Probability of photons surviving russian roulette', 2, 3],
+    'weight_window': [0., np.dtype(np.double), True, True, 'Photon weight above which photons are split, about 2 is recommended with the exponential transform, 0 disables', 2, 3],
+    'exponential_transform': [0., np.dtype(np.double), True, True, 'Exponential transform strength in [0, 1), Woodcock photon paths are stretched along the transform direction, 0 disables', 2, 3],
+    'exponential_transform_direction': [np.zeros(3, dtype=np.double), np.dtype((np.double, 3)), True, True, 'Direction photon paths are stretched along, zero for the direction from the scan center to the target organs', 2, 3],
     'anode_angle': [12., np.dtype(np.double), True, True, 'Angle of anode in x-ray tube [deg]', 0, 3],
     'tube_start_angle': [0, np.dtype(np.double), True, True, 'Tube start angle [deg]', 0, 3],
     'bowtie_radius': [15, np.dtype(np.double), True, True, 'Bowtie filter radius', 0, 3],
@@ -83,8 +113,10 @@ ARRAY_TEMPLATES = {
     'energy_imparted': [np.double, True, True],
     'density': [np.double, True, True],
     'dose': [np.double, True, True],
+    'uncertainty': [np.double, True, True],
     'material': [np.uint8, True, True],
     'material_map': [[('material', np.uint8), ('material_name', 'a128')], True, False],
+    'engine_counters': [[('counter', 'a64'), ('count', np.int64)], True, False],
    }
 
 
@@ -95,6 +127,9 @@ DESCRIPTION_RECARRAY = np.array([(k, v[2], v[3], v[4], v[5])
                                        ('editable', np.bool),
                                        ('description', 'a128'), ('priority', np.int)]).view(np.recarray)
 
+# cached CTDI calibrations, key is a hash of the calibration inputs
+CALIBRATION_DTYPE = np.dtype([('key', 'a40'), ('value', np.double)])
+
 def SIMULATION_DTYPE():
     d = {'names': [],
          'formats': []}
@@ -223,6 +258,8 @@ class Database(object):
 
         #adding arrays
         self.get_node('/attinuations', material.name, obj=material.attinuation)
+        # calibrations may depend on the material data
+        self.remove_node('/', 'meta_calibrations')
         logger.info('Successfully wrote material {} to database'.format(material.name))
         self.close()
 
@@ -285,6 +322,51 @@ class Database(object):
         return names
 
 
+    def get_calibration(self, key):
+        """Returns the cached CTDI calibration value for key, None if it is
+        not cached."""
+        if not self.test_node('/', 'meta_calibrations'):
+            self.close()
+            return None
+        cal_table = self.get_node('/', 'meta_calibrations', create=False)
+        value = None
+        for row in cal_table.where('key == b"{}"'.format(key)):
+            value = float(row['value'])
+            break
+        self.close()
+        return value
+
+    def get_calibrations(self):
+        """Returns all cached CTDI calibrations as a dict of values by key."""
+        if not self.test_node('/', 'meta_calibrations'):
+            self.close()
+            return {}
+        cal_table = self.get_node('/', 'meta_calibrations', create=False)
+        calibrations = {str(row['key'], encoding='utf-8'): float(row['value']) for row in cal_table}
+        self.close()
+        return calibrations
+
+    def set_calibration(self, key, value):
+        """Caches a CTDI calibration value for key."""
+        cal_table = self.get_node('/', 'meta_calibrations', create=True,
+                                  obj=CALIBRATION_DTYPE)
+        for row in cal_table.where('key == b"{}"'.format(key)):
+            row['value'] = value
+            row.update()
+            break
+        else:
+            cal_row = cal_table.row
+            cal_row['key'] = key
+            cal_row['value'] = value
+            cal_row.append()
+        cal_table.flush()
+        self.close()
+        logger.debug('Cached calibration {}'.format(key))
+
+    def clear_calibrations(self):
+        self.remove_node('/', 'meta_calibrations')
+        self.close()
+
     def add_simulation(self, properties, array_dict=None, overwrite=True):
         if not self.test_node('/', 'meta_data'):
             meta_table = self.get_node('/', 'meta_data',
@@ -953,6 +1035,13 @@ class Validator(object):
         self._props['ctdi_phantom_diameter'] = self.float_validator(value, True)
         assert self._props['ctdi_phantom_diameter'] >= 10.
 
+    @property
+    def recompute_calibration(self):
+        return self._props['recompute_calibration']
+    @recompute_calibration.setter
+    def recompute_calibration(self, value):
+        self._props['recompute_calibration'] = self.bool_validator(value)
+
     @property
     def ctdi_vol100(self):
         return self._props['ctdi_vol100']
@@ -1042,6 +1131,142 @@ class Validator(object):
         assert int(value) > 0
         self._props['batch_size'] = self.int_validator(value, True)
 
+    @property
+    def processes(self):
+        return self._props['processes']
+    @processes.setter
+    def processes(self, value):
+        self._props['processes'] = self.int_validator(value, True)
+
+    @property
+    def threads_per_process(self):
+        return self._props['threads_per_process']
+    @threads_per_process.setter
+    def threads_per_process(self, value):
+        self._props['threads_per_process'] = self.int_validator(value, True)
+
+    @property
+    def thread_schedule(self):
+        return self._props['thread_schedule']
+    @thread_schedule.setter
+    def thread_schedule(self, value):
+        if isinstance(value, bytes):
+            value = str(value, encoding='utf-8')
+        value = str(value).strip().lower()
+        assert value in ['static', 'dynamic', 'guided', 'auto']
+        self._props['thread_schedule'] = value
+
+    @property
+    def chunk_size(self):
+        return self._props['chunk_size']
+    @chunk_size.setter
+    def chunk_size(self, value):
+        self._props['chunk_size'] = self.int_validator(value, True)
+
+    @property
+    def cpu_affinity(self):
+        return self._props['cpu_affinity']
+    @cpu_affinity.setter
+    def cpu_affinity(self, value):
+        if isinstance(value, bytes):
+            value = str(value, encoding='utf-8')
+        cpus = [c.strip() for c in str(value).split(',') if len(c.strip()) > 0]
+        # raises ValueError for anything but cpu numbers
+        self._props['cpu_affinity'] = ','.join(str(int(c)) for c in cpus)
+
+    @property
+    def autotune_threads(self):
+        return self._props['autotune_threads']
+    @autotune_threads.setter
+    def autotune_threads(self, value):
+        self._props['autotune_threads'] = self.bool_validator(value)
+
+    @property
+    def phase_space_mode(self):
+        return self._props['phase_space_mode']
+    @phase_space_mode.setter
+    def phase_space_mode(self, value):
+        if isinstance(value, bytes):
+            value = str(value, encoding='utf-8')
+        value = str(value).strip().lower()
+        assert value in ['none', 'source', 'boundary', 'replay']
+        self._props['phase_space_mode'] = value
+
+    @property
+    def phase_space_file(self):
+        return self._props['phase_space_file']
+    @phase_space_file.setter
+    def phase_space_file(self, value):
+        if isinstance(value, bytes):
+            value = str(value, encoding='utf-8')
+        self._props['phase_space_file'] = str(value).strip()
+
+    @property
+    def uncertainty_batches(self):
+        return self._props['uncertainty_batches']
+    @uncertainty_batches.setter
+    def uncertainty_batches(self, value):
+        self._props['uncertainty_batches'] = self.int_validator(value, True)
+
+    @property
+    def target_uncertainty(self):
+        return self._props['target_uncertainty']
+    @target_uncertainty.setter
+    def target_uncertainty(self, value):
+        self._props['target_uncertainty'] = self.float_validator(value, True)
+
+    @property
+    def target_organs(self):
+        return self._props['target_organs']
+    @target_organs.setter
+    def target_organs(self, value):
+        if isinstance(value, bytes):
+            value = str(value, encoding='utf-8')
+        self._props['target_organs'] = str(value)
+
+    @property
+    def time_budget(self):
+        return self._props['time_budget']
+    @time_budget.setter
+    def time_budget(self, value):
+        self._props['time_budget'] = self.float_validator(value, True)
+
+    @property
+    def max_uncertainty_batches(self):
+        return self._props['max_uncertainty_batches']
+    @max_uncertainty_batches.setter
+    def max_uncertainty_batches(self, value):
+        assert int(value) > 1
+        self._props['max_uncertainty_batches'] = self.int_validator(value, True)
+
+    @property
+    def uncertainty_reached(self):
+        return self._props['uncertainty_reached']
+    @uncertainty_reached.setter
+    def uncertainty_reached(self, value):
+        self._props['uncertainty_reached'] = self.float_validator(value, True)
+
+    @property
+    def batches_simulated(self):
+        return self._props['batches_simulated']
+    @batches_simulated.setter
+    def batches_simulated(self, value):
+        self._props['batches_simulated'] = self.int_validator(value, True)
+
+    @property
+    def random_seed(self):
+        return self._props['random_seed']
+    @random_seed.setter
+    def random_seed(self, value):
+        self._props['random_seed'] = self.int_validator(value, True)
+
+    @property
+    def random_seed_used(self):
+        return self._props['random_seed_used']
+    @random_seed_used.setter
+    def random_seed_used(self, value):
+        self._props['random_seed_used'] = self.int_validator(value, True)
+
     @property
     def start_scan(self):
         return self._props['start_scan']
@@ -1089,6 +1314,13 @@ class Validator(object):
     def start_at_exposure_no(self, value):
         self._props['start_at_exposure_no'] = self.int_validator(value, True)
 
+    @property
+    def stop_at_exposure_no(self):
+        return self._props['stop_at_exposure_no']
+    @stop_at_exposure_no.setter
+    def stop_at_exposure_no(self, value):
+        self._props['stop_at_exposure_no'] = self.int_validator(value, True)
+
     @property
     def MC_finished(self):
         return self._props['MC_finished']
@@ -1259,6 +1491,91 @@ class Validator(object):
     def use_siddon(self, value):
         self._props['use_siddon'] = self.bool_validator(value)
 
+    @property
+    def single_precision(self):
+        return self._props['single_precision']
+    @single_precision.setter
+    def single_precision(self, value):
+        self._props['single_precision'] = self.bool_validator(value)
+
+    @property
+    def instrumented_engine(self):
+        return self._props['instrumented_engine']
+    @instrumented_engine.setter
+    def instrumented_engine(self, value):
+        self._props['instrumented_engine'] = self.bool_validator(value)
+
+    @property
+    def energy_scoring(self):
+        return self._props['energy_scoring']
+    @energy_scoring.setter
+    def energy_scoring(self, value):
+        if isinstance(value, bytes):
+            value = str(value, encoding='utf-8')
+        value = str(value).strip().lower()
+        assert value in ['collision', 'track_length']
+        self._props['energy_scoring'] = value
+
+    @property
+    def forced_interaction(self):
+        return self._props['forced_interaction']
+    @forced_interaction.setter
+    def forced_interaction(self, value):
+        self._props['forced_interaction'] = self.bool_validator(value)
+
+    @property
+    def importance_factor(self):
+        return self._props['importance_factor']
+    @importance_factor.setter
+    def importance_factor(self, value):
+        assert float(value) > 0
+        self._props['importance_factor'] = self.float_validator(value)
+
+    @property
+    def weight_cutoff(self):
+        return self._props['weight_cutoff']
+    @weight_cutoff.setter
+    def weight_cutoff(self, value):
+        self._props['weight_cutoff'] = self.float_validator(value, True)
+
+    @property
+    def roulette_survival(self):
+        return self._props['roulette_survival']
+    @roulette_survival.setter
+    def roulette_survival(self, value):
+        assert 0 < float(value) <= 1
+        self._props['roulette_survival'] = self.float_validator(value)
+
+    @property
+    def weight_window(self):
+        return self._props['weight_window']
+    @weight_window.setter
+    def weight_window(self, value):
+        self._props['weight_window'] = self.float_validator(value, True)
+
+    @property
+    def exponential_transform(self):
+        return self._props['exponential_transform']
+    @exponential_transform.setter
+    def exponential_transform(self, value):
+        assert 0 <= float(value) < 1
+        self._props['exponential_transform'] = self.float_validator(value)
+
+    @property
+    def exponential_transform_direction(self):
+        return self._props['exponential_transform_direction']
+    @exponential_transform_direction.setter
+    def exponential_transform_direction(self, value):
+        if isinstance(value, np.ndarray):
+            self._props['exponential_transform_direction'] = value.astype(np.double)
+        elif isinstance(value, str):
+            self._props['exponential_transform_direction'] = self.string_to_array_converter('exponential_transform_direction', value)
+        else:
+            value=np.array(value)
+            assert isinstance(value, np.ndarray)
+            assert len(value) == 3
+            self._props['exponential_transform_direction'] = value.astype(np.double)
+
     @property
     def anode_angle(self):
         return self._props['anode_angle']
@@ -1383,4 +1700,11 @@ class Validator(object):
         return self._arrays['organ_material_map']
     @organ_material_map.setter
     def organ_material_map(self, value):
-        self._arrays['organ_material_map'] = self.validate_structured_array(value, 'organ_material_map')
\ No newline at end of file
+        self._arrays['organ_material_map'] = self.validate_structured_array(value, 'organ_material_map')
+
+    @property
+    def engine_counters(self):
+        return self._arrays['engine_counters']
+    @engine_counters.setter
+    def engine_counters(self, value):
+        self._arrays['engine_counters'] = self.validate_structured_array(value, 'engine_counters')
\ No newline at end of file
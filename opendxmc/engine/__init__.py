@@ -1 +1 @@
-from .enginelib import Engine
+from .enginelib import Engine, Progress, pack_voxels, unpack_voxels, random_seed, COUNTERS_DTYPE, PhaseSpace
@@ -13,29 +13,44 @@ Created on Mon Dec 14 11:56:58 2015
 """
 
 import ctypes as ct
+import multiprocessing
 import numpy as np
 import os
 import sys
 import platform
 
 
-def get_kernel(precision):
+def get_kernel(precision, instrumented=False):
     dll_path = os.path.abspath(os.path.dirname(__file__))
+    # the single precision engine is a separate build with USING_FLOAT defined
+    if precision == ct.c_float:
+        suffix = 'f'
+    else:
+        suffix = ''
+    # the instrumented engine is a separate build with USING_COUNTERS defined
+    if instrumented:
+        suffix += 'i'
     if platform.system() == 'Windows':
+        # the engine dlls are built from src/enginelib.sln, the Release,
+        # ReleaseFloat, ReleaseCounters and ReleaseFloatCounters
+        # configurations build the four variants
+        if sys.maxsize > 2**32:
+            name = 'enginelib64' + suffix
+        else:
+            name = 'enginelib32' + suffix
         try:
-            if sys.maxsize > 2**32:
-                dll = ct.CDLL(os.path.join(dll_path, 'enginelib64'))
-            else:
-                dll = ct.CDLL(os.path.join(dll_path, 'enginelib32'))
+            dll = ct.CDLL(os.path.join(dll_path, name))
         except OSError:
-            if sys.maxsize > 2**32:
-                dll = ct.CDLL('enginelib64')
-            else:
-                dll = ct.CDLL('enginelib32')
+            try:
+                dll = ct.CDLL(name)
+            except OSError:
+                raise OSError('Engine library {0}.dll is not found, build it '
+                              'from {1} and copy it to '
+                              '{2}'.format(name, os.path.join(dll_path, 'src', 'enginelib.sln'), dll_path))
     elif platform.system() == 'Linux':
 #        dll = ct.CDLL('enginelib.so')
 #        print(os.path.join(dll_path, 'enginelib64.so'))
-        dll = ct.CDLL(os.path.join(dll_path, 'enginelib64.so'))
+        dll = ct.CDLL(os.path.join(dll_path, 'enginelib64{}.so'.format(suffix)))
     else:
         raise OSError
 
@@ -44,12 +59,16 @@ def get_kernel(precision):
     setup.argtypes = [ct.POINTER(ct.c_int), #shape
                       ct.POINTER(precision), #spacing
                       ct.POINTER(precision), #offset
-                      ct.POINTER(ct.c_int32), #materialmap
-                      ct.POINTER(precision), #density_map
+                      ct.POINTER(ct.c_uint32), #voxels
                       ct.POINTER(ct.c_int32), #lut_shape
                       ct.POINTER(precision), #lut
-                      ct.POINTER(precision), #energy_imparted
-                      ct.POINTER(ct.c_int32) #use_siddon
+                      ct.POINTER(ct.c_double), #energy_imparted, always double
+                      ct.POINTER(ct.c_double), #energy_squared, may be NULL
+                      ct.POINTER(precision), #importance, may be NULL
+                      ct.POINTER(ct.c_int32), #use_siddon
+                      ct.POINTER(ct.c_int32), #tally_mode
+                      ct.POINTER(ct.c_int64), #tally_memory_budget
+                      ct.POINTER(ct.c_uint64) #seed
                       ]
     setup.restype = ct.c_void_p
     
@@ -84,13 +103,96 @@ def get_kernel(precision):
     
     
     run = dll.run_simulation
-    run.argtypes = [ct.c_void_p, ct.c_int64, ct.c_void_p]
+    run.argtypes = [ct.c_void_p, ct.c_int64, ct.c_void_p, ct.c_void_p]
     run.restype=None    
     
     run_bowtie = dll.run_simulation_bowtie
-    run_bowtie.argtypes = [ct.c_void_p, ct.c_int64, ct.c_void_p]    
+    run_bowtie.argtypes = [ct.c_void_p, ct.c_int64, ct.c_void_p, ct.c_void_p]
     run_bowtie.restype=None    
-    
+
+    run_bowtie_batch = dll.run_simulation_bowtie_batch
+    run_bowtie_batch.argtypes = [ct.c_void_p, #source
+                                 ct.POINTER(precision), #positions
+                                 ct.POINTER(precision), #directions
+                                 ct.POINTER(precision), #scan axes
+                                 ct.POINTER(precision), #weights
+                                 ct.c_int64, #n_exposures
+                                 ct.c_int64, #n_particles
+                                 ct.c_void_p, #simulation
+                                 ct.c_void_p] #counters, may be NULL
+    run_bowtie_batch.restype=None
+
+    end_batch = dll.end_batch
+    end_batch.argtypes = [ct.c_void_p]
+    end_batch.restype = None
+
+    set_random_stream = dll.set_random_stream
+    set_random_stream.argtypes = [ct.c_void_p, ct.c_uint64]
+    set_random_stream.restype = None
+
+    set_progress = dll.set_progress
+    set_progress.argtypes = [ct.c_void_p, ct.c_void_p]
+    set_progress.restype = None
+
+    set_threading = dll.set_threading
+    set_threading.argtypes = [ct.c_void_p, #simulation
+                              ct.c_int, #n_threads
+                              ct.c_int, #schedule
+                              ct.c_int, #chunk_size
+                              ct.POINTER(ct.c_int32), #affinity, may be NULL
+                              ct.c_int] #n_affinity
+    set_threading.restype = None
+
+    sample_compton = dll.sample_compton
+    sample_compton.argtypes = [ct.c_void_p, #simulation
+                               precision, #energy
+                               ct.c_int64, #n
+                               ct.c_int, #use_table
+                               ct.c_uint64, #stream
+                               ct.POINTER(precision), #scatter_energy
+                               ct.POINTER(precision)] #theta
+    sample_compton.restype = None
+
+    set_phase_space = dll.set_phase_space
+    set_phase_space.argtypes = [ct.c_void_p, #simulation
+                                ct.POINTER(ct.c_float), #data, may be NULL
+                                ct.c_int64, #capacity
+                                ct.POINTER(ct.c_int64), #count, may be NULL
+                                ct.c_int] #mode
+    set_phase_space.restype = None
+
+    set_scoring = dll.set_scoring
+    set_scoring.argtypes = [ct.c_void_p, #simulation
+                            ct.c_int] #scoring
+    set_scoring.restype = None
+
+    set_forced_interaction = dll.set_forced_interaction
+    set_forced_interaction.argtypes = [ct.c_void_p, #simulation
+                                       ct.c_int] #forced
+    set_forced_interaction.restype = None
+
+    set_russian_roulette = dll.set_russian_roulette
+    set_russian_roulette.argtypes = [ct.c_void_p, #simulation
+                                     precision, #weight cutoff
+                                     precision, #roulette chance
+                                     precision] #weight window
+    set_russian_roulette.restype = None
+
+    set_exponential_transform = dll.set_exponential_transform
+    set_exponential_transform.argtypes = [ct.c_void_p, #simulation
+                                          precision, #strength
+                                          ct.POINTER(precision)] #direction
+    set_exponential_transform.restype = None
+
+    run_phase_space = dll.run_simulation_phase_space
+    run_phase_space.argtypes = [ct.POINTER(ct.c_float), #phase space data
+                                ct.c_int64, #capacity
+                                ct.c_int64, #start
+                                ct.c_int64, #n_particles
+                                ct.c_void_p, #simulation
+                                ct.c_void_p] #counters, may be NULL
+    run_phase_space.restype = None
+
     cleanup = dll.cleanup_simulation
     cleanup.argtypes = [ct.c_void_p]
     cleanup.restype=None
@@ -100,28 +202,444 @@ def get_kernel(precision):
     cleanup_source.restype=None
     #info = dll.device_info
     
-    return setup, source, source_bowtie, run, run_bowtie, cleanup, cleanup_source
+    return setup, source, source_bowtie, run, run_bowtie, run_bowtie_batch, end_batch, set_random_stream, set_progress, set_threading, sample_compton, set_phase_space, run_phase_space, set_scoring, set_forced_interaction, set_russian_roulette, set_exponential_transform, cleanup, cleanup_source
+
+
+TALLY_MODES = {'auto': -1, 'atomic': 0, 'private': 1, 'slab': 2}
+
+# OpenMP schedule kinds of the engine history loops
+SCHEDULES = {'static': 1, 'dynamic': 2, 'guided': 3, 'auto': 4}
+
+# energy scoring estimators, track length scoring needs the energy absorption
+# coefficients in row LUT_ENERGY_ABSORPTION of the attenuation lut
+SCORING_MODES = {'collision': 0, 'track_length': 1}
+LUT_ENERGY_ABSORPTION = 5
+
+# packed voxels are float32 densities with the lowest bits replaced by the
+# material index
+VOXEL_MATERIAL_BITS = 8
+VOXEL_MATERIAL_MASK = np.uint32(2**VOXEL_MATERIAL_BITS - 1)
+
+
+def pack_voxels(material_map, density_map):
+    """Packs a material index array and a density array into one uint32
+    voxel array for Engine.setup_simulation. The density is stored as a
+    float32 with the lowest VOXEL_MATERIAL_BITS mantissa bits holding the
+    material index, which rounds densities to about 3e-5 relative precision
+    and limits the number of materials to 2**VOXEL_MATERIAL_BITS.
+    """
+    if material_map.shape != density_map.shape:
+        raise ValueError('material_map and density_map must have the same shape')
+    if material_map.size > 0 and (material_map.min() < 0 or
+                                  material_map.max() > VOXEL_MATERIAL_MASK):
+        raise ValueError('Material indices must be in range 0 to '
+                         '{}'.format(VOXEL_MATERIAL_MASK))
+    voxels = np.ascontiguousarray(density_map, dtype=np.float32).view(np.uint32).copy()
+    # rounding to nearest before the material bits are cleared
+    voxels += np.uint32((VOXEL_MATERIAL_MASK + 1) // 2)
+    voxels &= ~VOXEL_MATERIAL_MASK
+    voxels |= material_map.astype(np.uint32)
+    return voxels
+
+
+def random_seed():
+    """Returns a random seed for Engine.setup_simulation drawn from the
+    operating system entropy source."""
+    return int.from_bytes(os.urandom(8), 'little') >> 1
+
+
+# layout of the engine Progress struct
+PROGRESS_DTYPE = np.dtype([('histories', np.int64),
+                           ('interactions', np.int64),
+                           ('cancel', np.int32),
+                           ('padding', np.int32)])
+
+
+class Progress(object):
+    def __init__(self, buffer=None):
+        """Progress counters and cancel flag shared with running engines.
+
+        The engine adds completed histories and photon interactions to the
+        counters while a run is going, and skips the remaining histories of
+        a run when the progress is cancelled. The counters are kept in
+        shared memory, buffer is the buffer attribute of another Progress to
+        share its counters, for example with engines in worker processes.
+        """
+        if buffer is None:
+            buffer = multiprocessing.RawArray(ct.c_int64, PROGRESS_DTYPE.itemsize // 8)
+        self.buffer = buffer
+        self.array = np.frombuffer(buffer, dtype=PROGRESS_DTYPE)
+
+    @property
+    def histories(self):
+        return int(self.array['histories'][0])
+
+    @property
+    def interactions(self):
+        return int(self.array['interactions'][0])
+
+    @property
+    def cancelled(self):
+        return bool(self.array['cancel'][0])
+
+    def cancel(self):
+        """Stops running engines between histories."""
+        self.array['cancel'] = 1
+
+    def reset(self):
+        self.array['histories'] = 0
+        self.array['interactions'] = 0
+        self.array['cancel'] = 0
+
+
+# layout of the engine Counters struct of transport event counts
+COUNTERS_DTYPE = np.dtype([('histories', np.int64),
+                           ('missed', np.int64),
+                           ('woodcock_real', np.int64),
+                           ('woodcock_virtual', np.int64),
+                           ('macro_block_steps', np.int64),
+                           ('siddon_voxels', np.int64),
+                           ('rayleigh', np.int64),
+                           ('compton', np.int64),
+                           ('photoelectric', np.int64),
+                           ('energy_cutoff', np.int64),
+                           ('roulette_kills', np.int64),
+                           ('splits', np.int64)])
+
+
+# phase space files hold recorded photons as one float32 array per field
+# after a header, the engine records photons leaving the source or photons
+# entering the volume at the volume boundary
+PHASE_SPACE_MODES = {'source': 1, 'boundary': 2}
+PHASE_SPACE_FIELDS = ('x', 'y', 'z', 'u', 'v', 'w', 'energy', 'weight')
+PHASE_SPACE_MAGIC = b'DXMCPHSP'
+PHASE_SPACE_VERSION = 1
+PHASE_SPACE_HEADER_DTYPE = np.dtype([('magic', 'S8'),
+                                     ('version', np.int32),
+                                     ('fields', np.int32),
+                                     ('mode', np.int32),
+                                     ('shape', np.int32, 3),
+                                     ('photons', np.int64),
+                                     ('recorded', np.int64),
+                                     ('source_histories', np.int64),
+                                     ('exposures', np.int64),
+                                     ('spacing', np.float64, 3),
+                                     ('padding', 'S40')])
+
+
+class PhaseSpace(object):
+    def __init__(self, path, capacity=None, mode='source', shape=None,
+                 spacing=None):
+        """Phase space file of photons recorded by the engine.
+
+        If capacity is given a new file for recording up to capacity photons
+        is created, mode is 'source' or 'boundary' and shape and spacing
+        describe the volume the photons are recorded for. Else an existing
+        file is opened read only for replay.
+
+        The photons are the data attribute, a memory mapped float32 array of
+        shape (len(PHASE_SPACE_FIELDS), capacity). Photons beyond the
+        capacity are counted in recorded but not stored. source_histories
+        and exposures are the histories and exposures simulated while
+        recording and are written to the file when a new file is closed,
+        each stored photon stands for source_histories / photons histories.
+        """
+        self.path = path
+        self.writable = capacity is not None
+        if self.writable:
+            if mode not in PHASE_SPACE_MODES:
+                raise ValueError('Phase space mode must be one of {}'.format(', '.join(PHASE_SPACE_MODES)))
+            self.mode = mode
+            self.capacity = int(capacity)
+            self.shape = np.array(shape, dtype=np.int32)
+            self.spacing = np.array(spacing, dtype=np.float64)
+            self.source_histories = 0
+            self.exposures = 0
+            # the engine counts recorded photons in this array
+            self.count = np.zeros(1, dtype=np.int64)
+            self._write_header()
+            self.data = np.memmap(path, dtype=np.float32, mode='r+',
+                                  offset=PHASE_SPACE_HEADER_DTYPE.itemsize,
+                                  shape=(len(PHASE_SPACE_FIELDS), max(self.capacity, 1)))
+        else:
+            header = np.fromfile(path, dtype=PHASE_SPACE_HEADER_DTYPE, count=1)
+            if (header.shape[0] != 1) or (header['magic'][0] != PHASE_SPACE_MAGIC):
+                raise ValueError('{} is not a phase space file'.format(path))
+            if header['version'][0] != PHASE_SPACE_VERSION:
+                raise ValueError('Phase space file version {} is not '
+                                 'supported'.format(header['version'][0]))
+            header = header[0]
+            self.mode = {v: k for k, v in PHASE_SPACE_MODES.items()}[int(header['mode'])]
+            self.capacity = int(header['photons'])
+            self.shape = header['shape'].copy()
+            self.spacing = header['spacing'].copy()
+            self.source_histories = int(header['source_histories'])
+            self.exposures = int(header['exposures'])
+            self.count = np.array([header['recorded']], dtype=np.int64)
+            self.data = np.memmap(path, dtype=np.float32, mode='r',
+                                  offset=PHASE_SPACE_HEADER_DTYPE.itemsize,
+                                  shape=(len(PHASE_SPACE_FIELDS), max(self.capacity, 1)))
+
+    @property
+    def photons(self):
+        """Number of stored photons."""
+        return min(int(self.count[0]), self.capacity)
+
+    @property
+    def recorded(self):
+        return int(self.count[0])
+
+    def __len__(self):
+        return self.photons
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _write_header(self, photons=0):
+        header = np.zeros(1, dtype=PHASE_SPACE_HEADER_DTYPE)
+        header['magic'] = PHASE_SPACE_MAGIC
+        header['version'] = PHASE_SPACE_VERSION
+        header['fields'] = len(PHASE_SPACE_FIELDS)
+        header['mode'] = PHASE_SPACE_MODES[self.mode]
+        header['shape'] = self.shape
+        header['photons'] = photons
+        header['recorded'] = self.count[0]
+        header['source_histories'] = self.source_histories
+        header['exposures'] = self.exposures
+        header['spacing'] = self.spacing
+        with open(self.path, 'r+b' if os.path.exists(self.path) else 'wb') as f:
+            f.write(header.tobytes())
+
+    def matches(self, shape, spacing):
+        """True if the photons are recorded for a volume of shape and
+        spacing."""
+        return (np.array_equal(self.shape, np.asarray(shape)) and
+                np.allclose(self.spacing, np.asarray(spacing, dtype=np.float64)))
+
+    def close(self):
+        """Closes the file. A new file is truncated to the stored photons
+        and its header is written."""
+        if self.data is None:
+            return
+        if self.writable:
+            photons = self.photons
+            # moving the fields next to each other before truncating
+            flat = self.data.reshape(-1)
+            for i in range(1, len(PHASE_SPACE_FIELDS)):
+                flat[i * photons:(i + 1) * photons] = flat[i * self.capacity:i * self.capacity + photons]
+            self.data.flush()
+            del flat
+            self.data = None
+            with open(self.path, 'r+b') as f:
+                f.truncate(PHASE_SPACE_HEADER_DTYPE.itemsize +
+                           len(PHASE_SPACE_FIELDS) * photons * np.dtype(np.float32).itemsize)
+            self._write_header(photons)
+            self.capacity = photons
+            self.writable = False
+        self.data = None
+
+
+def unpack_voxels(voxels):
+    """Returns the material index and float32 density arrays of a packed
+    voxel array.
+    """
+    material_map = (voxels & VOXEL_MATERIAL_MASK).astype(np.int32)
+    density_map = (voxels & ~VOXEL_MATERIAL_MASK).view(np.float32)
+    return material_map, density_map
+
 
 class Engine(object):
-    def __init__(self, precision='float64'):
-        if precision == 'float64':
+    def __init__(self, precision='float64', tally='auto',
+                 tally_memory_budget=2**30, threads=None, instrumented=False,
+                 schedule='dynamic', chunk_size=64, affinity=None,
+                 scoring='collision', forced_interaction=False,
+                 weight_cutoff=0.01, roulette_chance=0.2, weight_window=0.,
+                 exponential_transform=0., transform_direction=(0., 0., 1.)):
+        """Engine wrapper.
+
+        precision is 'float64' or 'float32' and selects the engine build.
+        Arrays passed to the engine must have the floating point type given
+        by the dtype attribute, except energy_imparted which is always
+        float64.
+
+        tally selects how threads score energy: 'atomic' uses atomic adds on
+        the shared dose array, 'private' gives each thread its own array that
+        is kept between runs and reduced by end_batch and cleanup, 'slab'
+        locks one plane of the first array axis, x, at a time and 'auto'
+        uses private arrays if the extra arrays fit in tally_memory_budget
+        bytes, else slab locks. Slabs are not planes of the scan axis z
+        since the photons of the exposures threads share deposit energy in
+        the same few z planes. Slab locks are taken for every score, for
+        every voxel crossed with track length scoring, and are meant for
+        volumes whose private arrays do not fit in memory.
+
+        threads sets the number of OpenMP threads for simulations of this
+        engine, None uses the OpenMP default. schedule is the OpenMP
+        schedule kind, 'static', 'dynamic', 'guided' or 'auto', and
+        chunk_size the number of histories handed to a thread at a time, 0
+        uses the default of the schedule kind, engines built with OpenMP
+        2.0 take both from OMP_SCHEDULE. affinity is an optional list of
+        cpus the threads are pinned to in turn, only on linux. See also
+        set_threading.
+
+        scoring selects the energy estimator, 'collision' scores the energy
+        deposited at each interaction and 'track_length' scores the kerma
+        along the photon paths, the path length times the energy absorption
+        coefficient of each voxel crossed. Track length scoring has a lower
+        variance in thin or low density regions where few photons interact,
+        it needs a lut with energy absorption coefficients, see
+        generate_attinuation_lut.
+
+        forced_interaction forces every photon from the source to interact
+        in the volume, the photon weight is split between the forced photon
+        and the part crossing the volume without interacting. This lowers
+        the variance where few photons interact, such as in lungs and thin
+        patients, at the cost of computing the optical depth of each
+        primary photon path.
+
+        Photons with weight below weight_cutoff play russian roulette after
+        each interaction, they survive with probability roulette_chance and
+        their weight is divided by roulette_chance. With an importance map,
+        see setup_simulation, the weight times the importance of the photon
+        region is compared to weight_cutoff. Photons with weight above
+        weight_window are split in photons below it at their next
+        interaction, zero disables splitting.
+
+        exponential_transform is the strength, in [0, 1), of the exponential
+        transform of Woodcock tracking. Photons moving along
+        transform_direction take longer steps and photons moving against it
+        shorter steps, the photon weights are corrected so the energy
+        imparted is unbiased. This lowers the variance of the dose to
+        regions far from the scanned region along transform_direction, such
+        as organs outside the scan range, with strengths of about 0.3 to
+        0.7. Zero disables the transform, it is not used with Siddon
+        tracking. The transform raises the weight of photons moving against
+        transform_direction, a weight_window of a few times the source photon
+        weight keeps their variance down.
+
+        instrumented selects the engine build counting transport events,
+        the run methods then return the counts of each call as a
+        COUNTERS_DTYPE record. The instrumented build is slower.
+        """
+        self.dtype = np.dtype(precision)
+        if self.dtype == np.dtype('float64'):
             self.floating_type = ct.c_double
-        else:
+        elif self.dtype == np.dtype('float32'):
             self.floating_type = ct.c_float
-        self.c_simsetup, self.c_sourcesetup, self.c_sourcesetup_bowtie, self.crun, self.crun_bowtie, self.c_simcleanup, self.c_sourcecleanup = get_kernel(self.floating_type)
+        else:
+            raise ValueError('Engine precision must be float64 or float32')
+        self.tally_mode = np.array([TALLY_MODES[tally]], dtype=np.int32)
+        self.tally_memory_budget = np.array([tally_memory_budget],
+                                            dtype=np.int64)
+        self.instrumented = instrumented
+        if schedule not in SCHEDULES:
+            raise ValueError('Engine schedule must be one of {}'.format(', '.join(SCHEDULES)))
+        self.threads = threads
+        self.schedule = schedule
+        self.chunk_size = chunk_size
+        self.affinity = affinity
+        if scoring not in SCORING_MODES:
+            raise ValueError('Engine scoring must be one of {}'.format(', '.join(SCORING_MODES)))
+        self.scoring = scoring
+        self.forced_interaction = forced_interaction
+        if not 0 < roulette_chance <= 1:
+            raise ValueError('Engine roulette_chance must be in (0, 1]')
+        self.weight_cutoff = weight_cutoff
+        self.roulette_chance = roulette_chance
+        self.weight_window = weight_window
+        if not 0 <= exponential_transform < 1:
+            raise ValueError('Engine exponential_transform must be in [0, 1)')
+        self.exponential_transform = exponential_transform
+        self.transform_direction = np.array(transform_direction, dtype=self.dtype)
+        if (exponential_transform > 0) and not np.any(self.transform_direction):
+            raise ValueError('Engine transform_direction must not be zero')
+        self.c_simsetup, self.c_sourcesetup, self.c_sourcesetup_bowtie, self.crun, self.crun_bowtie, self.crun_bowtie_batch, self.c_end_batch, self.c_set_random_stream, self.c_set_progress, self.c_set_threading, self.c_sample_compton, self.c_set_phase_space, self.crun_phase_space, self.c_set_scoring, self.c_set_forced_interaction, self.c_set_russian_roulette, self.c_set_exponential_transform, self.c_simcleanup, self.c_sourcecleanup = get_kernel(self.floating_type, instrumented)
+
+    def setup_simulation(self, shape, spacing, offset, voxels, lut_shape, lut, energy_imparted, use_siddon, energy_squared=None, importance=None, seed=None):
+        """Sets up the simulation geometry. voxels is a packed uint32 array
+        of material indices and densities from pack_voxels.
+
+        energy_imparted holds all energy imparted by the runs only after
+        end_batch or cleanup, with private tallies part of the energy is
+        kept by the threads until then.
 
-    def setup_simulation(self, shape, spacing, offset, material_map, density_map, lut_shape, lut, energy_imparted, use_siddon):
-        return self.c_simsetup(
+        If energy_squared is given the engine keeps a sum of squares tally
+        for uncertainty estimates, each call to end_batch adds the squared
+        energy imparted in each voxel since the previous batch ended.
+
+        importance is an optional array of positive voxel importances of the
+        geometry shape. Photons interacting in a voxel more important than
+        the previous interaction site are split in about the importance
+        ratio photons sharing the photon weight, photons moving to a less
+        important voxel survive russian roulette with probability of the
+        ratio. Photons from the source have unit importance. This spends
+        the simulation time on the important regions, such as organs far
+        from the scanned region, without biasing the energy imparted.
+
+        Every history has its own random stream derived from seed and the
+        stream number of the history, histories are numbered from zero in the
+        order they are run, see set_random_stream. A random seed is drawn if
+        seed is None.
+        """
+        if seed is None:
+            seed = random_seed()
+        seed = np.array([seed], dtype=np.uint64)
+        # the engine keeps pointers to these arrays, they can not be converted here
+        arrays = [('shape', shape, np.dtype(np.int32)),
+                  ('spacing', spacing, self.dtype),
+                  ('offset', offset, self.dtype),
+                  ('voxels', voxels, np.dtype(np.uint32)),
+                  ('lut_shape', lut_shape, np.dtype(np.int32)),
+                  ('lut', lut, self.dtype),
+                  ('energy_imparted', energy_imparted, np.dtype('float64')),
+                  ('use_siddon', use_siddon, np.dtype(np.int32))]
+        if energy_squared is not None:
+            arrays.append(('energy_squared', energy_squared, np.dtype('float64')))
+            energy_squared_ptr = energy_squared.ctypes.data_as(ct.POINTER(ct.c_double))
+        else:
+            energy_squared_ptr = None
+        if importance is not None:
+            arrays.append(('importance', importance, self.dtype))
+            if importance.size != voxels.size:
+                raise ValueError('importance must have the shape of the geometry')
+            if not np.all(importance > 0):
+                raise ValueError('importance must be positive')
+            importance_ptr = importance.ctypes.data_as(ct.POINTER(self.floating_type))
+        else:
+            importance_ptr = None
+        for name, arr, dtype in arrays:
+            if arr.dtype != dtype:
+                raise TypeError('{0} must be {1}, not {2}'.format(name, dtype, arr.dtype))
+            if not arr.flags['C_CONTIGUOUS']:
+                raise ValueError('{} must be C contiguous'.format(name))
+        if self.scoring == 'track_length' and lut.shape[1] <= LUT_ENERGY_ABSORPTION:
+            raise ValueError('Track length scoring needs a lut with energy absorption coefficients')
+        sim_ptr = self.c_simsetup(
                  shape.ctypes.data_as(ct.POINTER(ct.c_int32)), 
                  spacing.ctypes.data_as(ct.POINTER(self.floating_type)),
                  offset.ctypes.data_as(ct.POINTER(self.floating_type)), 
-                 material_map.ctypes.data_as(ct.POINTER(ct.c_int32)), 
-                 density_map.ctypes.data_as(ct.POINTER(self.floating_type)), 
+                 voxels.ctypes.data_as(ct.POINTER(ct.c_uint32)),
                  lut_shape.ctypes.data_as(ct.POINTER(ct.c_int32)), 
                  lut.ctypes.data_as(ct.POINTER(self.floating_type)), 
-                 energy_imparted.ctypes.data_as(ct.POINTER(self.floating_type)),
-                 use_siddon.ctypes.data_as(ct.POINTER(ct.c_int32)), 
+                 energy_imparted.ctypes.data_as(ct.POINTER(ct.c_double)),
+                 energy_squared_ptr,
+                 importance_ptr,
+                 use_siddon.ctypes.data_as(ct.POINTER(ct.c_int32)),
+                 self.tally_mode.ctypes.data_as(ct.POINTER(ct.c_int32)),
+                 self.tally_memory_budget.ctypes.data_as(ct.POINTER(ct.c_int64)),
+                 seed.ctypes.data_as(ct.POINTER(ct.c_uint64)),
                  ) 
+        self.set_threading(sim_ptr)
+        self.c_set_scoring(sim_ptr, SCORING_MODES[self.scoring])
+        self.c_set_forced_interaction(sim_ptr, int(bool(self.forced_interaction)))
+        self.c_set_russian_roulette(sim_ptr, self.weight_cutoff, self.roulette_chance,
+                                    self.weight_window)
+        self.c_set_exponential_transform(sim_ptr, self.exponential_transform,
+                                         self.transform_direction.ctypes.data_as(ct.POINTER(self.floating_type)))
+        return sim_ptr
 
                  
     def setup_source(self, source_position, source_direction, scan_axis, sdd, 
@@ -159,15 +677,151 @@ class Engine(object):
                     bowtie_angle.ctypes.data_as(ct.POINTER(self.floating_type)),
                     n_bowtie.ctypes.data_as(ct.POINTER(ct.c_int32))
                     )
+    def _counters(self):
+        # event counters for one run, None if the engine is not instrumented
+        if self.instrumented:
+            counters = np.zeros(1, dtype=COUNTERS_DTYPE)
+            return counters, counters.ctypes.data_as(ct.c_void_p)
+        return None, None
+
     def run(self, source_ptr, n_particles, sim_ptr):
+        counters, counters_ptr = self._counters()
         self.crun(source_ptr, 
                    ct.c_int64(n_particles), 
-                   sim_ptr)
+                   sim_ptr,
+                   counters_ptr)
+        if counters is not None:
+            return counters[0]
+
     def run_bowtie(self, source_ptr, n_particles, sim_ptr):
+        counters, counters_ptr = self._counters()
         self.crun_bowtie(source_ptr, 
                          ct.c_int64(n_particles), 
-                         sim_ptr)
+                         sim_ptr,
+                         counters_ptr)
+        if counters is not None:
+            return counters[0]
+
+    def run_bowtie_batch(self, source_ptr, source_positions, source_directions,
+                         scan_axes, weights, n_particles, sim_ptr):
+        """Runs n_particles histories for each exposure in a block of
+        exposures with one engine call. The source from setup_source_bowtie
+        supplies fan angles, specter and bowtie filter, while positions,
+        directions and scan axes are contiguous (n_exposures, 3) arrays and
+        weights is a (n_exposures,) array.
+
+        Returns the transport event counts as a COUNTERS_DTYPE record if the
+        engine is instrumented, else None.
+        """
+        counters, counters_ptr = self._counters()
+        self.crun_bowtie_batch(source_ptr,
+                               source_positions.ctypes.data_as(ct.POINTER(self.floating_type)),
+                               source_directions.ctypes.data_as(ct.POINTER(self.floating_type)),
+                               scan_axes.ctypes.data_as(ct.POINTER(self.floating_type)),
+                               weights.ctypes.data_as(ct.POINTER(self.floating_type)),
+                               ct.c_int64(weights.shape[0]),
+                               ct.c_int64(n_particles),
+                               sim_ptr,
+                               counters_ptr)
+        if counters is not None:
+            return counters[0]
         
+    def end_batch(self, sim_ptr):
+        """Ends a batch of histories, the thread tallies are added to
+        energy_imparted and the uncertainty tally is updated."""
+        self.c_end_batch(sim_ptr)
+
+    def set_random_stream(self, sim_ptr, stream):
+        """Sets the stream number of the next history. The following runs
+        number histories consecutively from stream, in exposure order for
+        run_bowtie_batch. A history is simulated identically for a given seed
+        and stream number, whatever the number of threads or how histories
+        are split between runs and processes.
+        """
+        self.c_set_random_stream(sim_ptr, ct.c_uint64(stream))
+
+    def set_threading(self, sim_ptr, threads=None, schedule=None,
+                      chunk_size=None, affinity=None):
+        """Sets the number of threads, schedule kind, chunk size and cpu
+        affinity for the following runs of the simulation, arguments that
+        are None are taken from the engine. Results do not depend on these
+        settings.
+        """
+        if threads is None:
+            threads = self.threads
+        if schedule is None:
+            schedule = self.schedule
+        if chunk_size is None:
+            chunk_size = self.chunk_size
+        if affinity is None:
+            affinity = self.affinity
+        if affinity is not None and len(affinity) > 0:
+            affinity = np.array(affinity, dtype=np.int32)
+            affinity_ptr = affinity.ctypes.data_as(ct.POINTER(ct.c_int32))
+            n_affinity = affinity.shape[0]
+        else:
+            affinity_ptr = None
+            n_affinity = 0
+        self.c_set_threading(sim_ptr, int(threads or 0), SCHEDULES[schedule],
+                             int(chunk_size), affinity_ptr, n_affinity)
+
+    def sample_compton(self, sim_ptr, energy, n, table=True, stream=0):
+        """Returns n compton scattered photon energies and scatter angles
+        for photons of energy eV, drawn from the random stream number stream.
+        If table is True the Klein-Nishina inverse cdf table used in
+        transport is sampled, else the rejection sampler.
+        """
+        scatter_energy = np.empty(int(n), dtype=self.dtype)
+        theta = np.empty(int(n), dtype=self.dtype)
+        self.c_sample_compton(sim_ptr, energy, ct.c_int64(n), int(bool(table)),
+                              ct.c_uint64(stream),
+                              scatter_energy.ctypes.data_as(ct.POINTER(self.floating_type)),
+                              theta.ctypes.data_as(ct.POINTER(self.floating_type)))
+        return scatter_energy, theta
+
+    def set_phase_space(self, sim_ptr, phase_space):
+        """Records the photons of the following runs of the simulation in
+        phase_space, a PhaseSpace opened for recording, None stops
+        recording. The engine keeps pointers to the phase space arrays,
+        phase_space must be kept open while the simulation records.
+        """
+        if phase_space is None:
+            self.c_set_phase_space(sim_ptr, None, 0, None, 0)
+        else:
+            self.c_set_phase_space(sim_ptr,
+                                   phase_space.data.ctypes.data_as(ct.POINTER(ct.c_float)),
+                                   ct.c_int64(phase_space.capacity),
+                                   phase_space.count.ctypes.data_as(ct.POINTER(ct.c_int64)),
+                                   PHASE_SPACE_MODES[phase_space.mode])
+
+    def run_phase_space(self, sim_ptr, phase_space, start, n_particles):
+        """Runs n_particles histories starting with the photons stored from
+        index start in phase_space. Returns the transport event counts as a
+        COUNTERS_DTYPE record if the engine is instrumented, else None.
+        """
+        if not 0 <= start <= start + n_particles <= phase_space.photons:
+            raise ValueError('Photons {0} to {1} are not in the phase '
+                             'space'.format(start, start + n_particles))
+        counters, counters_ptr = self._counters()
+        self.crun_phase_space(phase_space.data.ctypes.data_as(ct.POINTER(ct.c_float)),
+                              ct.c_int64(phase_space.capacity),
+                              ct.c_int64(start),
+                              ct.c_int64(n_particles),
+                              sim_ptr,
+                              counters_ptr)
+        if counters is not None:
+            return counters[0]
+
+    def set_progress(self, sim_ptr, progress):
+        """Sets a Progress for the following runs of the simulation, None
+        stops progress counting. The engine keeps a pointer to the progress
+        counters, progress must be kept alive while the simulation is used.
+        """
+        if progress is None:
+            self.c_set_progress(sim_ptr, None)
+        else:
+            self.c_set_progress(sim_ptr, progress.array.ctypes.data_as(ct.c_void_p))
+
     def cleanup(self, simulation=None,source=None):
         if simulation:
             self.c_simcleanup(simulation)
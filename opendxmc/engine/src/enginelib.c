@@ -1,4 +1,8 @@
 
+#ifdef __linux__
+#define _GNU_SOURCE  // for sched_setaffinity
+#include <sched.h>
+#endif
 #include "enginelib.h"
 
 #ifdef USINGCUDA
@@ -22,6 +26,34 @@ FLOAT randomduniform(uint64_t *seed)
 	return (FLOAT)xorshift128plus(seed) / (FLOAT)UINT64_MAX;
 }
 
+#ifdef USINGCUDA
+__device__
+#endif
+uint64_t splitmix64(uint64_t *x)
+{
+	uint64_t z = (x[0] += 0x9E3779B97F4A7C15ULL);
+	z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9ULL;
+	z = (z ^ (z >> 27)) * 0x94D049BB133111EBULL;
+	return z ^ (z >> 31);
+}
+
+#ifdef USINGCUDA
+__device__
+#endif
+void init_history_stream(uint64_t seed, uint64_t stream, uint64_t *state)
+{
+	// counter based seeding, the xorshift128+ state of a history depends only on the simulation seed and the
+	// stream number of the history, not on which thread runs it. Each stream takes two steps of a splitmix64
+	// sequence so streams never share state
+	uint64_t x = seed + stream * 2 * 0x9E3779B97F4A7C15ULL;
+	state[0] = splitmix64(&x);
+	state[1] = splitmix64(&x);
+	if ((state[0] == 0) && (state[1] == 0))
+	{
+		state[0] = 1;
+	}
+}
+
 
 #ifdef USINGCUDA
 #ifdef USING_DOUBLE
@@ -49,6 +81,30 @@ FLOAT atomicAdd(FLOAT *address, FLOAT val)
 }
 #endif
 
+#ifndef USINGCUDA
+void score_energy(Tally *tally, size_t index, double value)
+{
+	/*Adds value to the energy tally at index. Private tallies are owned by the calling thread and need no
+	synchronization, slab tallies lock the slab containing index. Energy is always tallied in double precision.*/
+	size_t slab;
+	switch (tally->mode)
+	{
+	case TALLY_PRIVATE:
+		tally->energy_imparted[index] += value;
+		break;
+	case TALLY_SLAB:
+		slab = index / tally->slab_size;
+		omp_set_lock(&(tally->slab_locks[slab]));
+		tally->energy_imparted[index] += value;
+		omp_unset_lock(&(tally->slab_locks[slab]));
+		break;
+	default:
+#pragma omp atomic
+		tally->energy_imparted[index] += value;
+	}
+}
+#endif
+
 
 #ifdef USINGCUDA
 __device__
@@ -58,6 +114,35 @@ FLOAT interp(FLOAT x, FLOAT x1, FLOAT x2, FLOAT y1, FLOAT y2)
 	return y1 + ((y2 - y1) * ((x - x1)) / (x2 - x1));
 }
 
+#ifdef USINGCUDA
+__device__
+#endif
+int voxel_material(uint32_t voxel)
+{ /*Returns the material index of a packed voxel*/
+	return (int)(voxel & VOXEL_MATERIAL_MASK);
+}
+
+#ifdef USINGCUDA
+__device__
+#endif
+FLOAT voxel_density(uint32_t voxel)
+{ /*Returns the density of a packed voxel, the material bits are cleared and the remaining bits read as a float32*/
+	union { uint32_t bits; float value; } density;
+	density.bits = voxel & ~VOXEL_MATERIAL_MASK;
+	return (FLOAT)density.value;
+}
+
+#ifdef USINGCUDA
+__device__
+#endif
+uint32_t pack_voxel(int material, float density)
+{ /*Packs a material index and a density into a voxel, the density is rounded to the precision left by the material bits*/
+	union { uint32_t bits; float value; } packed;
+	packed.value = density;
+	packed.bits = ((packed.bits + (VOXEL_MATERIAL_MASK + 1) / 2) & ~VOXEL_MATERIAL_MASK) | ((uint32_t)material & VOXEL_MATERIAL_MASK);
+	return packed.bits;
+}
+
 #ifdef USINGCUDA
 __device__
 #endif
@@ -103,14 +188,49 @@ FLOAT interp_array(FLOAT *xarr, FLOAT *yarr, size_t array_size, FLOAT xval)
 #ifdef USINGCUDA
 __device__
 #endif
-FLOAT lut_interpolator(int material, int interaction, FLOAT energy, int *lut_shape, FLOAT *lut, size_t *lower_index)
+size_t lut_lower_index(FLOAT energy, int *lut_shape, FLOAT *lut, FLOAT *lut_log_grid)
+{
+	/*Returns the lower energy index in the energy row of the first material in the attenuation lut. If lut_log_grid[1]
+	is nonzero the lut energies are on an uniform logarithmic grid starting at exp(lut_log_grid[0]) with lut_log_grid[1]
+	points per unit log energy and the index is computed directly, else it is found by a binary search.*/
+	size_t lower_index = 0;
+	if (lut_log_grid[1] > 0)
+	{
+		FLOAT pos = (LOG(energy) - lut_log_grid[0]) * lut_log_grid[1];
+		if (pos > 0)
+		{
+			lower_index = (size_t)FMIN(pos, (FLOAT)(lut_shape[2] - 2));
+		}
+	}
+	else
+	{
+		size_t higher_index = lut_shape[2] - 1;
+		binary_search(lut, energy, &lower_index, &higher_index);
+	}
+	return lower_index;
+}
+
+#ifdef USINGCUDA
+__device__
+#endif
+FLOAT lut_interpolator(int material, int interaction, FLOAT energy, int *lut_shape, FLOAT *lut, FLOAT *lut_log_grid, size_t *lower_index)
 {
-	lower_index[0] = material * lut_shape[1] * lut_shape[2];
-	size_t higher_index = lower_index[0] + lut_shape[2] - 1;
-	binary_search(lut, energy, lower_index, &higher_index);
+	/*Interpolates the attenuation lut for material and interaction at energy. lower_index is set to the lower energy
+	index so other interactions at the same energy can be interpolated without a new lookup. All materials are assumed
+	to share the energy grid, as generated by generate_attinuation_lut.*/
+	lower_index[0] = material * lut_shape[1] * lut_shape[2] + lut_lower_index(energy, lut_shape, lut, lut_log_grid);
 	return interp(energy, lut[lower_index[0]], lut[lower_index[0] + 1], lut[lower_index[0] + lut_shape[2] * interaction], lut[lower_index[0] + lut_shape[2] * interaction + 1]);
 }
 
+#ifdef USINGCUDA
+__device__
+#endif
+FLOAT lut_energy_absorption(FLOAT energy, size_t lower_index, int *lut_shape, FLOAT *lut)
+{
+	/*Returns the mass energy absorption coefficient at energy, lower_index is the index set by lut_interpolator for the same energy.*/
+	size_t index = lower_index + lut_shape[2] * LUT_ENERGY_ABSORPTION;
+	return interp(energy, lut[lower_index], lut[lower_index + 1], lut[index], lut[index + 1]);
+}
 
 #ifdef USINGCUDA
 __device__
@@ -129,6 +249,69 @@ size_t particle_array_index(FLOAT *particle, int *shape, FLOAT *spacing, FLOAT *
 	return i * shape[2] * shape[1] + j * shape[2] + k;
 
 }
+
+#ifdef USINGCUDA
+__device__
+#endif
+size_t macro_block_index(size_t *indices, MacroGrid *macro)
+{ /*Returns the index of the macro block containing the voxel at indices*/
+	return (indices[0] >> macro->block_shift) * macro->shape[1] * macro->shape[2] + (indices[1] >> macro->block_shift) * macro->shape[2] + (indices[2] >> macro->block_shift);
+}
+
+#ifdef USINGCUDA
+__device__
+#endif
+FLOAT macro_block_exit_distance(FLOAT *particle, size_t *indices, int *shape, FLOAT *spacing, FLOAT *offset, MacroGrid *macro)
+{ /*Returns the distance along the particle direction to just past the boundary of the macro block containing the voxel at indices.
+  The boundary planes are pushed step_epsilon outwards so the particle coordinate crossing the boundary always changes, also when the
+  particle travels nearly parallel to the boundary.*/
+	FLOAT distance = INFINITY;
+	size_t block_start;
+	int block_stop;
+	for (size_t i = 0; i < 3; i++)
+	{
+		block_start = (indices[i] >> macro->block_shift) << macro->block_shift;
+		if (particle[i + 3] > ERRF)
+		{
+			block_stop = block_start + macro->block_size;
+			if (block_stop > shape[i])
+			{
+				block_stop = shape[i];
+			}
+			distance = FMIN(distance, (offset[i] + block_stop * spacing[i] + macro->step_epsilon - particle[i]) / particle[i + 3]);
+		}
+		else if (particle[i + 3] < -ERRF)
+		{
+			distance = FMIN(distance, (offset[i] + block_start * spacing[i] - macro->step_epsilon - particle[i]) / particle[i + 3]);
+		}
+	}
+	return FMAX(distance, 0);
+}
+
+#ifdef USINGCUDA
+__device__
+#endif
+void particle_array_indices(FLOAT *particle, int *shape, FLOAT *spacing, FLOAT *offset, size_t *indices)
+{ /*Finds the voxel indices for particle in the volume arrays */
+	FLOAT index;
+	for (size_t i = 0; i < 3; i++)
+	{
+		index = (particle[i] - offset[i]) / spacing[i];
+		if (index < 0)
+		{
+			indices[i] = 0;
+		}
+		else if (index >= shape[i])
+		{
+			indices[i] = shape[i] - 1;
+		}
+		else
+		{
+			indices[i] = (size_t)index;
+		}
+	}
+}
+
 ///////////////////////////////////siddon/////////////////////////////////
 
 
@@ -235,20 +418,83 @@ void calculate_first_indices(FLOAT *ray, int *N, FLOAT *spacing, FLOAT *offset,
 #ifdef USINGCUDA
 __device__
 #endif
-bool siddon_path(size_t *volume_index, FLOAT *ray, int *N, FLOAT *spacing, FLOAT *offset, int *material_map, FLOAT *density_map, int *att_shape, FLOAT *attenuation_lut, FLOAT *max_density, uint64_t *state)
+bool siddon_skip_block(int *N, FLOAT *aglobalmin, FLOAT *aglobalmax, FLOAT *amin, FLOAT *aupdate, size_t *indices, int *indexupdate, MacroGrid *macro)
+{
+	/*Advances the siddon ray state past all voxel plane crossings until the ray leaves the macro block containing
+	the voxel at indices. Returns false if the ray leaves the volume before leaving the block.*/
+	size_t block_start, crossings;
+	size_t block_crossings[3];
+	FLOAT block_exit = INFINITY;
+	size_t i;
+	for (i = 0; i < 3; i++)
+	{
+		block_start = (indices[i] >> macro->block_shift) << macro->block_shift;
+		if (indexupdate[i] > 0)
+		{
+			block_crossings[i] = block_start + macro->block_size - indices[i];
+			if (block_start + macro->block_size > N[i])
+			{
+				block_crossings[i] = N[i] - indices[i];
+			}
+		}
+		else
+		{
+			block_crossings[i] = indices[i] - block_start + 1;
+		}
+		block_exit = FMIN(block_exit, amin[i] + (block_crossings[i] - 1) * aupdate[i]);
+	}
+	if (block_exit >= aglobalmax[0])
+	{
+		return false;
+	}
+	for (i = 0; i < 3; i++)
+	{
+		crossings = 0;
+		if (amin[i] <= block_exit)
+		{
+			crossings = (size_t)((block_exit - amin[i]) / aupdate[i]) + 1;
+			if (crossings > block_crossings[i])
+			{
+				crossings = block_crossings[i];
+			}
+		}
+		amin[i] += crossings * aupdate[i];
+		indices[i] += crossings * indexupdate[i];
+		if (indices[i] >= (size_t)N[i])
+		{
+			// rounding of the plane crossings may leave the volume before aglobalmax is reached
+			return false;
+		}
+	}
+	aglobalmin[0] = block_exit;
+	return true;
+}
+
+#ifdef USINGCUDA
+__device__
+#endif
+bool siddon_traverse(size_t *volume_index, FLOAT *ray, int *N, FLOAT *spacing, FLOAT *offset, uint32_t *voxels, int *att_shape, FLOAT *attenuation_lut, FLOAT *lut_log_grid, MacroGrid *macro, Tally *track_tally, FLOAT r1, FLOAT *transmission, Counters *counters)
 {
 	/*
 	The ray is a FLOAT [6] array: (start_x, start_y, start_z, direction_x, direction_y, direction_z). The vector
 	describing dirction of the ray must be a unit vector. N is a int [3] array giving the shape of the uniform voxel volume.
 	spacing FLOAT [3] array is voxel size, offset FLOAT [3] array is the posiyional offset of the first voxel in the volume.
+	If track_tally is not NULL the expected energy imparted along each path segment, weight * energy * path length times the
+	energy absorption coefficient, is scored in track_tally.
+
+	The ray interacts where its transmission, the exponential of minus the cumulative optical depth, falls below r1. Returns
+	true if it does, then the ray is moved to the interaction point. If the ray leaves the volume transmission is set to the
+	transmission through the volume, rays not intersecting the volume have a transmission of 1.
 
 	The ray is parameterized by p(alpha) = start + alpha * direction
 	*/
 	FLOAT amin[3], aupdate[3], aglobalmin, aglobalmax;
+	transmission[0] = 1;
 	calculate_alphas_extreme(ray, N, spacing, offset, aupdate, &aglobalmin, &aglobalmax);
 
-	if (FABS(aglobalmin - aglobalmax) < ERRF)
+	if ((aglobalmax - aglobalmin) < ERRF)
 	{ //ray is not intersecting
+		COUNT(counters, missed);
 		return false;
 	}
 
@@ -258,49 +504,105 @@ bool siddon_path(size_t *volume_index, FLOAT *ray, int *N, FLOAT *spacing, FLOAT
 
 	size_t dim_index;
 	size_t attenuation_index;
+	size_t block_start;
+	uint32_t voxel;
 	FLOAT pixel_path_lenght;
 	FLOAT pixel_interaction_lenght;
 
 	FLOAT cum_interaction_prob = 1;
 	FLOAT interaction_prob;
 	FLOAT attenuation_coef;
-	FLOAT r1 = randomduniform(state);
+	FLOAT density;
 
 	//FLOAT cum_pixel_path_lenght = 0;
 
-	//doing one iteration to get indicec right
-	amin[0] = aglobalmin + aupdate[0];
-	amin[1] = aglobalmin + aupdate[1];
-	amin[2] = aglobalmin + aupdate[2];
+	// alphas of the first voxel plane crossings after the ray start or volume entry
+	for (size_t i = 0; i < 3; i++)
+	{
+		if (aupdate[i] == INFINITY)
+		{
+			amin[i] = INFINITY;
+		}
+		else
+		{
+			amin[i] = (offset[i] + (indices[i] + (indexupdate[i] > 0 ? 1 : 0)) * spacing[i] - ray[i]) / ray[i + 3];
+			if (amin[i] <= aglobalmin)
+			{
+				amin[i] += aupdate[i];
+			}
+		}
+	}
 
+	bool new_block = true;
 	while ((aglobalmin - aglobalmax) < -ERRF)
 	{
+		if (new_block && (macro->block_set[macro_block_index(indices, macro)] < 0))
+		{
+			// empty macro block, skipping the voxels until the ray leaves the block
+			COUNT(counters, macro_block_steps);
+			if (!siddon_skip_block(N, &aglobalmin, &aglobalmax, amin, aupdate, indices, indexupdate, macro))
+			{
+				transmission[0] = cum_interaction_prob;
+				return false;
+			}
+			continue;
+		}
+		new_block = false;
+
 		dim_index = min_index3(amin);
 		pixel_path_lenght = amin[dim_index] - aglobalmin;
 		//cum_pixel_path_lenght += pixel_path_lenght;
 		volume_index[0] = (size_t)(indices[0] * (size_t)N[1] * (size_t)N[2] + indices[1] * (size_t)N[2] + indices[2]);
-		attenuation_coef = density_map[volume_index[0]] * lut_interpolator(material_map[volume_index[0]], 1, ray[6], att_shape, attenuation_lut, &attenuation_index);
+		COUNT(counters, siddon_voxels);
+		voxel = voxels[volume_index[0]];
+		density = voxel_density(voxel);
+		attenuation_coef = density * lut_interpolator(voxel_material(voxel), 1, ray[6], att_shape, attenuation_lut, lut_log_grid, &attenuation_index);
 		interaction_prob = EXP(-attenuation_coef  * pixel_path_lenght);
 		cum_interaction_prob *= interaction_prob;
 		if (cum_interaction_prob <= r1)
 		{
 			//finding interaction path lenght in voxel
 			pixel_interaction_lenght = aglobalmin + LOG(r1 *interaction_prob / cum_interaction_prob) / (-attenuation_coef);
+			if (track_tally != NULL)
+			{
+				score_energy(track_tally, volume_index[0], ray[6] * ray[7] * density * lut_energy_absorption(ray[6], attenuation_index, att_shape, attenuation_lut) * (pixel_interaction_lenght - aglobalmin));
+			}
 			ray[0] += ray[3] * pixel_interaction_lenght;
 			ray[1] += ray[4] * pixel_interaction_lenght;
 			ray[2] += ray[5] * pixel_interaction_lenght;
 			return true;
 		}
-
-		//radiological path calc goes here
+		if (track_tally != NULL)
+		{
+			score_energy(track_tally, volume_index[0], ray[6] * ray[7] * density * lut_energy_absorption(ray[6], attenuation_index, att_shape, attenuation_lut) * pixel_path_lenght);
+		}
 
 		aglobalmin = amin[dim_index];
 		amin[dim_index] += aupdate[dim_index];
+		block_start = indices[dim_index] >> macro->block_shift;
 		indices[dim_index] += indexupdate[dim_index];
+		if (indices[dim_index] >= (size_t)N[dim_index])
+		{
+			// rounding of the plane crossings may leave the volume before aglobalmax is reached
+			break;
+		}
+		new_block = (indices[dim_index] >> macro->block_shift) != block_start;
 	}
+	transmission[0] = cum_interaction_prob;
 	return false;
 }
 
+#ifdef USINGCUDA
+__device__
+#endif
+bool siddon_path(size_t *volume_index, FLOAT *ray, int *N, FLOAT *spacing, FLOAT *offset, uint32_t *voxels, int *att_shape, FLOAT *attenuation_lut, FLOAT *lut_log_grid, MacroGrid *macro, Tally *track_tally, FLOAT *transform, uint64_t *state, Counters *counters)
+{
+	/*Siddon tracking of the ray to its next interaction, see siddon_traverse. Returns true if the ray interacts in the volume.
+	The exponential transform is only used by Woodcock tracking and transform is ignored.*/
+	FLOAT transmission;
+	return siddon_traverse(volume_index, ray, N, spacing, offset, voxels, att_shape, attenuation_lut, lut_log_grid, macro, track_tally, randomduniform(state), &transmission, counters);
+}
+
 
 ////////////////////////////////////////////////////////////////////////////
 
@@ -424,26 +726,72 @@ returns false if the particle misses scoring volume.*/
 #ifdef USINGCUDA
 __device__
 #endif
-bool woodcock_step(size_t *volume_index, FLOAT *particle, int *shape, FLOAT *spacing, FLOAT *offset, int *material_map, FLOAT *density_map, int *att_shape, FLOAT *attenuation_lut, FLOAT *max_density, uint64_t *state)
-{ /*Make the particle take a woodcock step until an interaction occurs or the particle steps out of volume, returns true if an interaction occurs, then volume index contains the voxel_index for the interaction*/
+bool woodcock_step(size_t *volume_index, FLOAT *particle, int *shape, FLOAT *spacing, FLOAT *offset, uint32_t *voxels, int *att_shape, FLOAT *attenuation_lut, FLOAT *lut_log_grid, MacroGrid *macro, Tally *track_tally, FLOAT *transform, uint64_t *state, Counters *counters)
+{ /*Make the particle take a woodcock step until an interaction occurs or the particle steps out of volume, returns true if an interaction occurs, then volume index contains the voxel_index for the interaction.
+  The majorant is local to the macro block the particle is in, if the sampled step leaves the block the particle is moved to the block boundary and a new step is sampled with the majorant of the next block.
+  Empty blocks are crossed without sampling.
+  If track_tally is not NULL the track length is estimated from the tentative collisions, real and virtual, which are on average
+  spaced 1 / majorant apart. Each tentative collision scores weight * energy times the energy absorption coefficient divided by the majorant.
+  If transform is not NULL it holds a unit direction and a strength p in [0, 1) of the exponential transform. Tentative collisions are then
+  sampled with the stretched majorant majorant * (1 - p * mu), where mu is the cosine between the particle and the transform direction, so
+  photons moving along the direction take longer steps. The real collision probability of each tentative collision is unchanged and the
+  weight is corrected with the likelihood ratio of the steps, exp(-majorant * p * mu * step) / (1 - p * mu) for each tentative collision
+  and exp(-majorant * p * mu * step) for steps ending on a block boundary.*/
 
 	bool interaction = false;
 	bool valid = particle_is_intersecting_volume(particle, shape, spacing, offset);
 
-	FLOAT smin, scur, w_step;
-	size_t lut_index;
+	FLOAT smin, scur, w_step, block_step;
+	size_t lut_index, block_index, energy_index;
+	size_t indices[3];
 	size_t i;
+	int block_set;
+	uint32_t voxel;
+	FLOAT density;
+	FLOAT stretch = 1;
 	smin = 0;
-	for (i = 0; i < att_shape[0]; i++)
+	if (transform != NULL)
+	{
+		stretch = 1 - transform[3] * (particle[3] * transform[0] + particle[4] * transform[1] + particle[5] * transform[2]);
+	}
+	energy_index = lut_lower_index(particle[6], att_shape, attenuation_lut, lut_log_grid);
+	if (!valid)
 	{
-		smin = FMAX(smin, lut_interpolator((int)i, 1, particle[6], att_shape, attenuation_lut, &lut_index));
+		COUNT(counters, missed);
 	}
-	smin *= max_density[0];
 
 	while (valid && !interaction)
 	{
-		// sampling distance
-		w_step = -LOG(randomduniform(&state[0])) / smin;
+		particle_array_indices(particle, shape, spacing, offset, indices);
+		block_index = macro_block_index(indices, macro);
+		block_set = macro->block_set[block_index];
+		block_step = macro_block_exit_distance(particle, indices, shape, spacing, offset, macro);
+
+		if (block_set < 0)
+		{
+			w_step = block_step;
+			COUNT(counters, macro_block_steps);
+		}
+		else
+		{
+			// sampling distance
+			smin = interp(particle[6], attenuation_lut[energy_index], attenuation_lut[energy_index + 1], macro->majorant_lut[block_set * att_shape[2] + energy_index], macro->majorant_lut[block_set * att_shape[2] + energy_index + 1]) * macro->block_density[block_index];
+			w_step = -LOG(randomduniform(&state[0])) / (smin * stretch);
+			if (w_step > block_step)
+			{
+				w_step = block_step;
+				block_set = -1;
+				COUNT(counters, macro_block_steps);
+			}
+			if (transform != NULL)
+			{
+				particle[7] *= EXP(-smin * (1 - stretch) * w_step);
+				if (block_set >= 0)
+				{
+					particle[7] /= stretch;
+				}
+			}
+		}
 
 		//moving particle a w_step
 		for (i = 0; i < 3; i++)
@@ -453,12 +801,26 @@ bool woodcock_step(size_t *volume_index, FLOAT *particle, int *shape, FLOAT *spa
 		// test to see if particle still is inside volume
 		valid = particle_inside_volume(particle, shape, spacing, offset); // skips intersection test
 
-		if (valid)
+		if (valid && (block_set >= 0))
 		{
 			volume_index[0] = particle_array_index(particle, shape, spacing, offset);
-			scur = lut_interpolator(material_map[volume_index[0]], 1, particle[6], att_shape, attenuation_lut, &lut_index) * density_map[volume_index[0]]; // basicly total attenuation(E) * density
+			voxel = voxels[volume_index[0]];
+			density = voxel_density(voxel);
+			scur = lut_interpolator(voxel_material(voxel), 1, particle[6], att_shape, attenuation_lut, lut_log_grid, &lut_index) * density; // basicly total attenuation(E) * density
+			if (track_tally != NULL)
+			{
+				score_energy(track_tally, volume_index[0], particle[6] * particle[7] * density * lut_energy_absorption(particle[6], lut_index, att_shape, attenuation_lut) / smin);
+			}
 
 			interaction = randomduniform(&state[0]) <= (scur / smin);
+			if (interaction)
+			{
+				COUNT(counters, woodcock_real);
+			}
+			else
+			{
+				COUNT(counters, woodcock_virtual);
+			}
 		}
 	}
 	return interaction;
@@ -558,7 +920,8 @@ void rayleigh_event_draw_theta(FLOAT *angle, uint64_t *state)
 		A = POW((FABS(c) + SQRT(c * c + 4.f)) / 2.f, (1.f / 3.f));
 	else
 		A = -POW((FABS(c) + SQRT(c * c + 4.f)) / 2.f, (1.f / 3.f));
-	angle[0] = ACOS(A - 1.f / A);
+	// clamping since rounding may give a cosine just outside [-1, 1] in single precision
+	angle[0] = ACOS(FMIN(FMAX(A - 1.f / A, -1.f), 1.f));
 }
 
 #ifdef USINGCUDA
@@ -594,7 +957,34 @@ FLOAT compton_event_draw_energy_theta(FLOAT energy, FLOAT *theta, uint64_t *stat
 			break;
 	}
 	
-	theta[0] = ACOS(1.f + (1.f - 1.f / epsilon) / k);
+	// clamping since rounding may give a cosine just below -1 in single precision
+	theta[0] = ACOS(FMAX(1.f + (1.f - 1.f / epsilon) / k, -1.f));
+	return epsilon * energy;
+}
+
+#ifdef USINGCUDA
+__device__
+#endif
+FLOAT compton_table_draw_energy_theta(ComptonTable *table, FLOAT energy, FLOAT *theta, uint64_t *state)
+{
+	/*Draws scattered energy and angle from the Klein-Nishina inverse cdf table with one random number, by bilinear
+	interpolation in log energy and the uniform variate. Returns scattered energy and sets theta to scatter angle.
+	Energies outside the table use the closest tabulated energy.*/
+	FLOAT k = energy / ELECTRON_MASS;
+	FLOAT epsilon_0 = 1.f / (1.f + 2.f * k);
+	FLOAT pos = FMIN(FMAX((LOG(energy) - table->log_emin) * table->inv_dlog, 0), (FLOAT)(table->n_energies - 1));
+	size_t i = (size_t)FMIN(pos, (FLOAT)(table->n_energies - 2));
+	FLOAT fi = pos - (FLOAT)i;
+	FLOAT v = randomduniform(state) * (FLOAT)(table->n_variates - 1);
+	size_t j = (size_t)FMIN(v, (FLOAT)(table->n_variates - 2));
+	FLOAT fj = v - (FLOAT)j;
+	FLOAT *low = &table->fraction[i * table->n_variates + j];
+	FLOAT *high = low + table->n_variates;
+	FLOAT fraction = (1.f - fi) * ((1.f - fj) * low[0] + fj * low[1]) + fi * ((1.f - fj) * high[0] + fj * high[1]);
+	FLOAT epsilon = epsilon_0 + fraction * (1.f - epsilon_0);
+
+	// clamping since rounding may give a cosine just below -1 in single precision
+	theta[0] = ACOS(FMAX(1.f + (1.f - 1.f / epsilon) / k, -1.f));
 	return epsilon * energy;
 }
 
@@ -602,8 +992,64 @@ FLOAT compton_event_draw_energy_theta(FLOAT energy, FLOAT *theta, uint64_t *stat
 #ifdef USINGCUDA
 __device__
 #endif
-void generate_particle(FLOAT *source_position, FLOAT *source_direction, FLOAT *scan_axis, FLOAT *sdd, FLOAT *fov, FLOAT *collimation, FLOAT *weight, int *specter_elements, FLOAT *specter_cpd, FLOAT *specter_energy, FLOAT *particle, uint64_t *state)
+size_t alias_sample(AliasTable *table, FLOAT r, FLOAT *fraction)
+{
+	/*Draws a bin from an alias table with one uniform random number r. fraction is set to an uniform number in [0, 1]
+	independent of the bin, made from the remaining bits of r.*/
+	FLOAT x = r * (FLOAT)table->n;
+	size_t bin = (size_t)FMIN(x, (FLOAT)(table->n - 1));
+	FLOAT f = x - (FLOAT)bin;
+	if (f < table->probability[bin])
+	{
+		fraction[0] = f / table->probability[bin];
+		return bin;
+	}
+	fraction[0] = FMIN((f - table->probability[bin]) / (1.f - table->probability[bin]), 1.f);
+	return table->alias[bin];
+}
+
+#ifdef USINGCUDA
+__device__
+#endif
+FLOAT sample_specter(AliasTable *table, FLOAT *specter_energy, uint64_t *state)
+{
+	/*Draws a photon energy from the specter alias table, energies are uniform within the interval of a bin which gives
+	the same distribution as interpolating the cumulative specter.*/
+	FLOAT fraction;
+	size_t bin = alias_sample(table, randomduniform(state), &fraction);
+	if (bin == 0)
+	{
+		return specter_energy[0];
+	}
+	return specter_energy[bin - 1] + fraction * (specter_energy[bin] - specter_energy[bin - 1]);
+}
+
+#ifdef USINGCUDA
+__device__
+#endif
+FLOAT sample_bowtie_angle(AliasTable *table, FLOAT *bowtie_angle, FLOAT *bowtie_weight, uint64_t *state)
+{
+	/*Draws a fan angle with probability proportional to the bowtie weight, linearly interpolated between the bowtie
+	angles. The bin is drawn from the alias table and the angle within the bin by inverting the cdf of the linear
+	weight.*/
+	FLOAT g;
+	size_t bin = alias_sample(table, randomduniform(state), &g);
+	FLOAT w0 = bowtie_weight[bin];
+	FLOAT w1 = bowtie_weight[bin + 1];
+	if (FABS(w1 - w0) > ERRF * (w0 + w1))
+	{
+		g = (SQRT(w0 * w0 + (w1 * w1 - w0 * w0) * g) - w0) / (w1 - w0);
+	}
+	return bowtie_angle[bin] + g * (bowtie_angle[bin + 1] - bowtie_angle[bin]);
+}
+
+#ifdef USINGCUDA
+__device__
+#endif
+void generate_particle(Source *source, FLOAT *particle, uint64_t *state)
 {
+	FLOAT *source_direction = source->source_direction;
+	FLOAT *scan_axis = source->scan_axis;
 	FLOAT v_rot[3];
 	FLOAT v_z_lenght, v_rot_lenght;
 	// cross product scan_axis x source_direction
@@ -611,38 +1057,44 @@ void generate_particle(FLOAT *source_position, FLOAT *source_direction, FLOAT *s
 	v_rot[1] = scan_axis[2] * source_direction[0] - scan_axis[0] * source_direction[2];
 	v_rot[2] = scan_axis[0] * source_direction[1] - scan_axis[1] * source_direction[0];
 
-	v_z_lenght = collimation[0] / (2.f * sdd[0]) * (randomduniform(state) - 0.5f) * 2.f;
-	v_rot_lenght = fov[0] * 2.f / sdd[0] * (randomduniform(state) - 0.5f) * 2.f;
+	v_z_lenght = source->collimation[0] / (2.f * source->sdd[0]) * (randomduniform(state) - 0.5f) * 2.f;
+	v_rot_lenght = source->fov[0] * 2.f / source->sdd[0] * (randomduniform(state) - 0.5f) * 2.f;
 
 	FLOAT inv_vec_lenght = 1.f / SQRT(1.f + v_rot_lenght * v_rot_lenght + v_z_lenght * v_z_lenght);
 
 	for (size_t i = 0; i < 3; i++)
 	{
-		particle[i] = source_position[i];
+		particle[i] = source->source_position[i];
 		particle[i + 3] = (source_direction[i] + v_rot[i] * v_rot_lenght + scan_axis[i] * v_z_lenght) * inv_vec_lenght;
 	}
 
-	FLOAT r1 = randomduniform(state);
-
-	particle[6] = interp_array(specter_cpd, specter_energy, specter_elements[0], r1);
-	particle[7] = weight[0];
+	particle[6] = sample_specter(&source->specter_table, source->specter_energy, state);
+	particle[7] = source->weight[0];
 }
 
 #ifdef USINGCUDA
 __device__
 #endif
-void generate_particle_bowtie(FLOAT *source_position, FLOAT *source_direction, FLOAT *scan_axis, FLOAT *scan_axis_fan_angle, FLOAT *rot_axis_fan_angle, FLOAT *weight, int *specter_elements, FLOAT *specter_cpd, FLOAT *specter_energy, int *bowtie_elements, FLOAT *bowtie_weight, FLOAT *bowtie_angle,
-FLOAT *particle, uint64_t *state)
+void generate_particle_bowtie(FLOAT *source_position, FLOAT *source_direction, FLOAT *scan_axis, FLOAT *weight, SourceBowtie *source, FLOAT *particle, uint64_t *state)
 {
+	/*Generates a photon from a bowtie source at source_position with direction source_direction, scan_axis and weight.
+	The fan angle is importance sampled from the bowtie profile so all photons have the same weight.*/
 	FLOAT v_rot[3];
-	FLOAT v_z_lenght, v_rot_lenght, r_ang;;
+	FLOAT v_z_lenght, v_rot_lenght, r_ang;
 	// cross product scan_axis x source_direction
 	v_rot[0] = scan_axis[1] * source_direction[2] - scan_axis[2] * source_direction[1];
 	v_rot[1] = scan_axis[2] * source_direction[0] - scan_axis[0] * source_direction[2];
 	v_rot[2] = scan_axis[0] * source_direction[1] - scan_axis[1] * source_direction[0];
 
-	r_ang = rot_axis_fan_angle[0] * (randomduniform(state) - 0.5f);
-	v_z_lenght = ASIN(scan_axis_fan_angle[0] * (randomduniform(state) - 0.5f));
+	if (source->bowtie_table.n > 0)
+	{
+		r_ang = sample_bowtie_angle(&source->bowtie_table, source->bowtie_angle, source->bowtie_weight, state);
+	}
+	else
+	{
+		r_ang = source->rot_axis_fan_angle[0] * (randomduniform(state) - 0.5f);
+	}
+	v_z_lenght = ASIN(source->scan_axis_fan_angle[0] * (randomduniform(state) - 0.5f));
 	v_rot_lenght = ASIN(r_ang);
 
 	FLOAT inv_vec_lenght = 1.f / SQRT(1.f + v_rot_lenght * v_rot_lenght + v_z_lenght * v_z_lenght);
@@ -655,158 +1107,334 @@ FLOAT *particle, uint64_t *state)
 	}
 
 	/////////////selecting energy///////////////////
-	FLOAT r1 = randomduniform(state);
-	particle[6] = interp_array(specter_cpd, specter_energy, specter_elements[0], r1);
+	particle[6] = sample_specter(&source->specter_table, source->specter_energy, state);
 	//selecting weight of particle
-	particle[7] = weight[0];
-	if (bowtie_elements[0] == 1)
-	{
-		particle[7] *= bowtie_weight[0];
-	}
-	else
-	{
-		particle[7] *= interp_array(bowtie_angle, bowtie_weight, bowtie_elements[0], r_ang);
-	}
+	particle[7] = weight[0] * source->bowtie_mean_weight;
 }
 
 
 #ifdef USINGCUDA
-__global__
+__device__
 #endif
-void transport_particles(FLOAT *source_position, FLOAT *source_direction, FLOAT *scan_axis, FLOAT *sdd, FLOAT *fov, FLOAT *collimation, FLOAT *weight, int *specter_elements, FLOAT *specter_cpd, FLOAT *specter_energy, size_t *n_particles, int *shape, FLOAT *spacing, FLOAT *offset, int *material_map, FLOAT *density_map, int *att_shape, FLOAT *attenuation_lut, FLOAT *energy_imparted, FLOAT *max_density, trackingFuncPtr tracking_func, uint64_t *states)
+void record_phase_space(PhaseSpace *phase_space, FLOAT *particle, int *shape, FLOAT *spacing, FLOAT *offset)
 {
-#ifdef USINGCUDA
-	size_t id = threadIdx.x + blockIdx.x * blockDim.x;
-	if (id >= n_particles[0])
+	/*Stores a photon in the phase space if recording. In boundary mode only photons intersecting the volume are
+	stored, moved to where they enter the volume. Photons beyond the phase space capacity are counted but not
+	stored.*/
+	if (phase_space->mode == PHASE_SPACE_OFF)
+	{
+		return;
+	}
+	if ((phase_space->mode == PHASE_SPACE_BOUNDARY) && (!particle_is_intersecting_volume(particle, shape, spacing, offset)))
 	{
 		return;
 	}
+	int64_t index;
+#if _OPENMP >= 201107
+#pragma omp atomic capture
+	index = phase_space->count[0]++;
 #else
-	size_t id = n_particles[0];
+#pragma omp critical(phase_space_count)
+	index = phase_space->count[0]++;
 #endif
+	if (index < phase_space->capacity)
+	{
+		for (int64_t i = 0; i < PHASE_SPACE_FIELDS; i++)
+		{
+			phase_space->data[i * phase_space->capacity + index] = (float)particle[i];
+		}
+	}
+}
 
-	FLOAT particle[8];
+#ifdef USINGCUDA
+__device__
+#endif
+bool photon_interaction(FLOAT *particle, Simulation *sim, Tally *tally, size_t volume_index, FLOAT importance, bool collision_scoring, uint64_t *state, int64_t *interactions, Counters *counters)
+{
+	/*Samples the interaction of a photon at an interaction site in voxel volume_index, scores the energy imparted in tally
+	and returns false if the photon is absorbed or ended by the energy cutoff or russian roulette. importance is the importance
+	of the photon region, one without an importance map.*/
+	int *att_shape = sim->lut_shape;
+	FLOAT *attenuation_lut = sim->attenuation_lut;
 	FLOAT rayleight, photoelectric, r_interaction, scatter_angle, scatter_energy;
-	size_t volume_index, lut_index;
-	generate_particle(source_position, source_direction, scan_axis, sdd, fov, collimation, weight, specter_elements, specter_cpd, specter_energy, particle, &states[id * 2]);
+	size_t lut_index;
 
-	while ((*tracking_func)(&volume_index, particle, shape, spacing, offset, material_map, density_map, att_shape, attenuation_lut, max_density, &states[id * 2]))
-	{
-		rayleight = lut_interpolator(material_map[volume_index], 2, particle[6], att_shape, attenuation_lut, &lut_index);
-		photoelectric = interp(particle[6], attenuation_lut[lut_index], attenuation_lut[lut_index + 1], attenuation_lut[lut_index + att_shape[2] * 3], attenuation_lut[lut_index + att_shape[2] * 3 + 1]);
+	interactions[0]++;
+	rayleight = lut_interpolator(voxel_material(sim->voxels[volume_index]), 2, particle[6], att_shape, attenuation_lut, sim->lut_log_grid, &lut_index);
+	//Here we take a shortcut, instead of interpolating the array again we just jump to the already calculated index in the lut table and do a between two points interpolation 
+	photoelectric = interp(particle[6], attenuation_lut[lut_index], attenuation_lut[lut_index + 1], attenuation_lut[lut_index + att_shape[2] * 3], attenuation_lut[lut_index + att_shape[2] * 3 + 1]);
 
-		r_interaction = randomduniform(&states[id * 2]) * interp(particle[6], attenuation_lut[lut_index], attenuation_lut[lut_index + 1], attenuation_lut[lut_index + att_shape[2]], attenuation_lut[lut_index + att_shape[2] + 1]);
+	r_interaction = randomduniform(state) * interp(particle[6], attenuation_lut[lut_index], attenuation_lut[lut_index + 1], attenuation_lut[lut_index + att_shape[2]], attenuation_lut[lut_index + att_shape[2] + 1]);
 
-		if (rayleight > r_interaction) //rayleigh scatter event
-		{
-			rayleigh_event_draw_theta(&scatter_angle, &states[id * 2]);
-			rotate_particle(particle, scatter_angle, (randomduniform(&states[id * 2]) * 2.f - 1.f) * PI);
-		}
-		else if ((rayleight + photoelectric) > r_interaction) //photoelectric event
+	if (rayleight > r_interaction) //rayleigh scatter event
+	{
+		COUNT(counters, rayleigh);
+		rayleigh_event_draw_theta(&scatter_angle, state);
+		rotate_particle(particle, scatter_angle, (randomduniform(state) * 2.f - 1.f) * PI);
+	}
+	else if ((rayleight + photoelectric) > r_interaction) //photoelectric event
+	{
+		COUNT(counters, photoelectric);
+		if (collision_scoring)
 		{
-			atomicAdd(&energy_imparted[volume_index], particle[6] * particle[7]);
-			break;
+			score_energy(tally, volume_index, particle[6] * particle[7]);
 		}
-		else // compton event
+		return false;
+	}
+	else // compton event
+	{
+		COUNT(counters, compton);
+		scatter_energy = compton_table_draw_energy_theta(sim->compton_table, particle[6], &scatter_angle, state);
+		rotate_particle(particle, scatter_angle, (randomduniform(state) * 2.f - 1.f) * PI);
+		if (collision_scoring)
 		{
-			scatter_energy = compton_event_draw_energy_theta(particle[6], &scatter_angle, &states[id * 2]);
-			rotate_particle(particle, scatter_angle, (randomduniform(&states[id * 2]) * 2.f - 1.f) * PI);
-			atomicAdd(&energy_imparted[volume_index], (particle[6] - scatter_energy) * particle[7]);
-			particle[6] = scatter_energy;
+			score_energy(tally, volume_index, (particle[6] - scatter_energy) * particle[7]);
 		}
+		particle[6] = scatter_energy;
+	}
 
-		//test for energy cutoff and weight cutoff
+	//test for energy cutoff
+	if (particle[6] < ENERGY_CUTOFF)
+	{
+		COUNT(counters, energy_cutoff);
+		score_energy(tally, volume_index, particle[6] * particle[7]);
+		return false;
+	}
 
-		if (particle[6] < ENERGY_CUTOFF)
+	//test for low weight threshold and do a russian rulette photon termination
+	if (particle[7] * importance < sim->weight_cutoff)
+	{
+		if (randomduniform(state) < sim->roulette_chance)
 		{
-			atomicAdd(&energy_imparted[volume_index], particle[6] * particle[7]);
-			break;
+			//if the photon survives russian rulette, we give it extra weigh to conserve energy
+			particle[7] /= sim->roulette_chance;
 		}
-
-		//test for low weight threshold and do a russian rulette photon termination
-		if (particle[7] < WEIGHT_CUTOFF)
+		else
 		{
-			if (RUSSIAN_RULETTE_CHANCE < randomduniform(&states[id * 2]))
-			{
-				particle[7] /= RUSSIAN_RULETTE_CHANCE;
-			}
-			else
-			{
-				break;
-			}
+			COUNT(counters, roulette_kills);
+			return false;
 		}
 	}
+	return true;
 }
 
 #ifdef USINGCUDA
-__global__
+__device__
 #endif
-void transport_particles_bowtie(FLOAT *source_position, FLOAT *source_direction, FLOAT *scan_axis, FLOAT *scan_axis_fan_angle, FLOAT *rot_axis_fan_angle, FLOAT *weight, int *specter_elements, FLOAT *specter_cpd, FLOAT *specter_energy, int *bowtie_elements, FLOAT *bowtie_weight, FLOAT *bowtie_angle, size_t *n_particles, int *shape, FLOAT *spacing, FLOAT *offset, int *material_map, FLOAT *density_map, int *att_shape, FLOAT *attenuation_lut, FLOAT *energy_imparted, FLOAT *max_density, trackingFuncPtr tracking_func, uint64_t *states)
+void split_photon(FLOAT *particle, int n_split, size_t volume_index, FLOAT importance, FLOAT *bank, size_t *bank_index, int *n_bank, Counters *counters)
 {
-#ifdef USINGCUDA
-	size_t id = threadIdx.x + blockIdx.x * blockDim.x;
-	if (id >= n_particles[0])
+	/*Splits a photon at an interaction site in voxel volume_index in n_split photons sharing its weight. The split photons are
+	pushed to bank with their importance and their voxel index in bank_index, photons are not split further when the bank is full.*/
+	int i, j;
+	if (n_split > (SPLIT_BANK_SIZE - n_bank[0] + 1))
 	{
-		return;
+		n_split = SPLIT_BANK_SIZE - n_bank[0] + 1;
 	}
-#else
-	size_t id = n_particles[0];
-#endif
-
-	FLOAT particle[8];
-	FLOAT rayleight, photoelectric, r_interaction, scatter_angle, scatter_energy;
-	size_t volume_index, lut_index;
-	generate_particle_bowtie(source_position, source_direction, scan_axis, scan_axis_fan_angle, rot_axis_fan_angle, weight, specter_elements, specter_cpd, specter_energy, bowtie_elements, bowtie_weight, bowtie_angle, particle, &states[id * 2]);
-
-	while ((*tracking_func)(&volume_index, particle, shape, spacing, offset, material_map, density_map, att_shape, attenuation_lut, max_density, &states[id * 2]))
+	particle[7] /= n_split;
+	for (i = 1; i < n_split; i++)
 	{
-		rayleight = lut_interpolator(material_map[volume_index], 2, particle[6], att_shape, attenuation_lut, &lut_index);
-		//Here we take a shortcut, instead of interpolating the array again we just jump to the already calculated index in the lut table and do a between two points interpolation 
-		photoelectric = interp(particle[6], attenuation_lut[lut_index], attenuation_lut[lut_index + 1], attenuation_lut[lut_index + att_shape[2] * 3], attenuation_lut[lut_index + att_shape[2] * 3 + 1]);
-
-		r_interaction = randomduniform(&states[id * 2]) * interp(particle[6], attenuation_lut[lut_index], attenuation_lut[lut_index + 1], attenuation_lut[lut_index + att_shape[2]], attenuation_lut[lut_index + att_shape[2] + 1]);
-
-		if (rayleight > r_interaction) //rayleigh scatter event
+		for (j = 0; j < PHASE_SPACE_FIELDS; j++)
 		{
-			rayleigh_event_draw_theta(&scatter_angle, &states[id * 2]);
-			rotate_particle(particle, scatter_angle, (randomduniform(&states[id * 2]) * 2.f - 1.f) * PI);
+			bank[n_bank[0] * (PHASE_SPACE_FIELDS + 1) + j] = particle[j];
 		}
-		else if ((rayleight + photoelectric) > r_interaction) //photoelectric event
+		bank[n_bank[0] * (PHASE_SPACE_FIELDS + 1) + PHASE_SPACE_FIELDS] = importance;
+		bank_index[n_bank[0]] = volume_index;
+		n_bank[0]++;
+		COUNT(counters, splits);
+	}
+}
+
+#ifdef USINGCUDA
+__device__
+#endif
+bool importance_split(FLOAT *particle, size_t volume_index, FLOAT *importance, FLOAT *importance_map, FLOAT *bank, size_t *bank_index, int *n_bank, uint64_t *state, Counters *counters)
+{
+	/*Splits or rouletts a photon at an interaction site in voxel volume_index. importance is the importance of the region the
+	photon comes from and is updated to the importance of the voxel. With an importance ratio r above one the photon is split in
+	floor(r) or floor(r) + 1 photons, so that r photons are expected, see split_photon. Below one the photon survives
+	with probability r and its weight is divided by r. Returns false if the photon is killed.*/
+	FLOAT ratio = importance_map[volume_index] / importance[0];
+	int n_split;
+	importance[0] = importance_map[volume_index];
+	if (ratio > 1)
+	{
+		n_split = (int)ratio;
+		if (randomduniform(state) < (ratio - n_split))
 		{
-			atomicAdd(&energy_imparted[volume_index], particle[6] * particle[7]);
-			break;
+			n_split++;
 		}
-		else // compton event
+		split_photon(particle, n_split, volume_index, importance[0], bank, bank_index, n_bank, counters);
+	}
+	else if (ratio < 1)
+	{
+		if (randomduniform(state) < ratio)
 		{
-			scatter_energy = compton_event_draw_energy_theta(particle[6], &scatter_angle, &states[id * 2]);
-			rotate_particle(particle, scatter_angle, (randomduniform(&states[id * 2]) * 2.f - 1.f) * PI);
-			atomicAdd(&energy_imparted[volume_index], (particle[6] - scatter_energy) * particle[7]);
-			particle[6] = scatter_energy;
+			particle[7] /= ratio;
 		}
-
-		//test for energy cutoff
-		if (particle[6] < ENERGY_CUTOFF)
+		else
 		{
-			atomicAdd(&energy_imparted[volume_index], particle[6] * particle[7]);
-			break;
+			COUNT(counters, roulette_kills);
+			return false;
 		}
+	}
+	return true;
+}
+
+#ifdef USINGCUDA
+__device__
+#endif
+void transport_photon(FLOAT *particle, Simulation *sim, Tally *tally, trackingFuncPtr tracking_func, bool at_interaction, size_t volume_index, uint64_t *state, int64_t *interactions, Counters *counters)
+{
+	/*Transports a photon until it is absorbed, leaves the volume or is ended by the energy cutoff or russian roulette,
+	and scores the energy imparted in tally. With track length scoring the tracking function scores the energy along
+	the photon path and the interactions only score the energy of photons ended by the energy cutoff.
+	If at_interaction is true the photon is at an interaction site in voxel volume_index, else it is tracked to one first.
+	With an importance map photons are split or rouletted at interaction sites, see importance_split, photons from the source
+	have unit importance. Photons with weight times importance above the weight window of the simulation, if it is above zero,
+	are split in photons below the window. Split photons are transported after the photon ends. Woodcock tracking stretches the
+	photon steps with the exponential transform of the simulation if its strength is above zero, see woodcock_step.*/
+	Tally *track_tally = NULL;
+	FLOAT *transform = NULL;
+	bool collision_scoring = true;
+	bool alive;
+	FLOAT importance = 1;
+	FLOAT bank[SPLIT_BANK_SIZE * (PHASE_SPACE_FIELDS + 1)];  // photons waiting for transport and their importance
+	size_t bank_index[SPLIT_BANK_SIZE];
+	int n_bank = 0;
+	int j;
+	if (sim->scoring == SCORING_TRACK_LENGTH)
+	{
+		track_tally = tally;
+		collision_scoring = false;
+	}
+	if (sim->exponential_transform[3] > 0)
+	{
+		transform = sim->exponential_transform;
+	}
 
-		//test for low weight threshold and do a russian rulette photon termination
-		if (particle[7] < WEIGHT_CUTOFF)
+	if (!at_interaction)
+	{
+		at_interaction = (*tracking_func)(&volume_index, particle, sim->shape, sim->spacing, sim->offset, sim->voxels, sim->lut_shape, sim->attenuation_lut, sim->lut_log_grid, sim->macro_grid, track_tally, transform, state, counters);
+	}
+	while (true)
+	{
+		if (at_interaction)
 		{
-			if (RUSSIAN_RULETTE_CHANCE < randomduniform(&states[id * 2]))
+			alive = true;
+			if (sim->importance != NULL)
 			{
-				//if the photon survives russian rulette, we give it extra weigh to conserve energy
-				particle[7] /= RUSSIAN_RULETTE_CHANCE;
+				alive = importance_split(particle, volume_index, &importance, sim->importance, bank, bank_index, &n_bank, state, counters);
 			}
-			else
+			if (alive && (sim->weight_window > 0) && (particle[7] * importance > sim->weight_window))
 			{
-				// else we deposit the energy in current voxel
-				atomicAdd(&energy_imparted[volume_index], particle[6] * particle[7]);
-				break;
+				split_photon(particle, (int)CEIL(particle[7] * importance / sim->weight_window), volume_index, importance, bank, bank_index, &n_bank, counters);
 			}
 		}
+		else if (n_bank > 0)
+		{
+			// next split photon, it is at the interaction site it was split at
+			n_bank--;
+			for (j = 0; j < PHASE_SPACE_FIELDS; j++)
+			{
+				particle[j] = bank[n_bank * (PHASE_SPACE_FIELDS + 1) + j];
+			}
+			importance = bank[n_bank * (PHASE_SPACE_FIELDS + 1) + PHASE_SPACE_FIELDS];
+			volume_index = bank_index[n_bank];
+			alive = true;
+		}
+		else
+		{
+			break;
+		}
+		if (alive)
+		{
+			alive = photon_interaction(particle, sim, tally, volume_index, importance, collision_scoring, state, interactions, counters);
+		}
+		at_interaction = alive && (*tracking_func)(&volume_index, particle, sim->shape, sim->spacing, sim->offset, sim->voxels, sim->lut_shape, sim->attenuation_lut, sim->lut_log_grid, sim->macro_grid, track_tally, transform, state, counters);
+	}
+}
+
+#ifdef USINGCUDA
+__device__
+#endif
+void transport_primary(FLOAT *particle, Simulation *sim, Tally *tally, trackingFuncPtr tracking_func, uint64_t *state, int64_t *interactions, Counters *counters)
+{
+	/*Transports a photon from the source. With forced interaction the photon is split in a part crossing the volume
+	without interacting, with weight times the transmission T through the volume, and a part forced to interact in the
+	volume with weight times 1 - T. The interaction site is sampled from the exponential distribution truncated to the path
+	inside the volume by siddon tracking, the cumulative optical depth also gives T. The uncrossed part only scores with
+	track length scoring. The first interaction is forced for every tracking function, later flights are tracked as usual.*/
+	if (!sim->forced_interaction)
+	{
+		transport_photon(particle, sim, tally, tracking_func, false, 0, state, interactions, counters);
+		return;
+	}
+	Tally *track_tally = (sim->scoring == SCORING_TRACK_LENGTH) ? tally : NULL;
+	FLOAT weight = particle[7];
+	FLOAT transmission, ignored;
+	size_t volume_index;
+	// optical depth of the path through the volume
+	siddon_traverse(&volume_index, particle, sim->shape, sim->spacing, sim->offset, sim->voxels, sim->lut_shape, sim->attenuation_lut, sim->lut_log_grid, sim->macro_grid, NULL, -1, &transmission, counters);
+	if (transmission >= 1)
+	{
+		// no attenuating material along the path
+		return;
+	}
+	if (track_tally != NULL)
+	{
+		particle[7] = weight * transmission;
+		siddon_traverse(&volume_index, particle, sim->shape, sim->spacing, sim->offset, sim->voxels, sim->lut_shape, sim->attenuation_lut, sim->lut_log_grid, sim->macro_grid, track_tally, -1, &ignored, counters);
+	}
+	particle[7] = weight * (1 - transmission);
+	// the photon interacts where the transmission falls below r1, r1 is uniform on (transmission, 1]
+	if (siddon_traverse(&volume_index, particle, sim->shape, sim->spacing, sim->offset, sim->voxels, sim->lut_shape, sim->attenuation_lut, sim->lut_log_grid, sim->macro_grid, track_tally, 1 - randomduniform(state) * (1 - transmission), &ignored, counters))
+	{
+		transport_photon(particle, sim, tally, tracking_func, true, volume_index, state, interactions, counters);
+	}
+}
+
+#ifdef USINGCUDA
+__global__
+#endif
+void transport_particles(Source *source, size_t *n_particles, Simulation *sim, Tally *tally, trackingFuncPtr tracking_func, uint64_t *states, int64_t *interactions, Counters *counters)
+{
+#ifdef USINGCUDA
+	size_t id = threadIdx.x + blockIdx.x * blockDim.x;
+	if (id >= n_particles[0])
+	{
+		return;
 	}
+#else
+	size_t id = n_particles[0];
+#endif
+
+	FLOAT particle[8];
+	generate_particle(source, particle, &states[id * 2]);
+	COUNT(counters, histories);
+	record_phase_space(&sim->phase_space, particle, sim->shape, sim->spacing, sim->offset);
+	transport_primary(particle, sim, tally, tracking_func, &states[id * 2], interactions, counters);
+}
+
+#ifdef USINGCUDA
+__global__
+#endif
+void transport_particles_bowtie(FLOAT *source_position, FLOAT *source_direction, FLOAT *scan_axis, FLOAT *weight, SourceBowtie *source, size_t *n_particles, Simulation *sim, Tally *tally, trackingFuncPtr tracking_func, uint64_t *states, int64_t *interactions, Counters *counters)
+{
+#ifdef USINGCUDA
+	size_t id = threadIdx.x + blockIdx.x * blockDim.x;
+	if (id >= n_particles[0])
+	{
+		return;
+	}
+#else
+	size_t id = n_particles[0];
+#endif
+
+	FLOAT particle[8];
+	generate_particle_bowtie(source_position, source_direction, scan_axis, weight, source, particle, &states[id * 2]);
+	COUNT(counters, histories);
+	record_phase_space(&sim->phase_space, particle, sim->shape, sim->spacing, sim->offset);
+	transport_primary(particle, sim, tally, tracking_func, &states[id * 2], interactions, counters);
 }
 
 #ifdef USINGCUDA
@@ -824,17 +1452,6 @@ __global__ void init_random_seed(uint64_t *seed, size_t *n_threads, uint64_t *st
 		}
 	}
 }
-#else
-void init_random_seed(uint64_t *seed, size_t *n_threads, uint64_t *states)
-{
-	states[0] = xorshift128plus(seed);
-	states[1] = xorshift128plus(seed);
-	for (uint64_t id = 1; id < n_threads[0]; id++)
-	{
-		states[id * 2] = xorshift128plus(&states[id * 2 - 2]);
-		states[id * 2 + 1] = xorshift128plus(&states[id * 2 - 1]);
-	}
-}
 #endif
 
 #ifdef USINGCUDA
@@ -938,32 +1555,297 @@ __host__ void* setup_simulation(int *shape, FLOAT *spacing, FLOAT *offset, int *
 	return (void*)sim_dev;
 }
 #else
-void* setup_simulation(int *shape, FLOAT *spacing, FLOAT *offset, int *material_map, FLOAT *density_map, int *lut_shape, FLOAT *attenuation_lut, FLOAT *energy_imparted, int *use_siddon)
+void setup_lut_log_grid(int *lut_shape, FLOAT *lut, FLOAT *lut_log_grid)
+{
+	/*Tests if all materials in the attenuation lut shares the same uniform logarithmic energy grid. If so lut_log_grid
+	is set to the logarithm of the first energy and the number of grid points per unit log energy, else lut_log_grid[1]
+	is set to zero and lut lookups falls back to binary search.*/
+	size_t n = lut_shape[2];
+	size_t material_size = lut_shape[1] * lut_shape[2];
+	size_t i, m;
+	lut_log_grid[0] = 0;
+	lut_log_grid[1] = 0;
+	if (n < 3)
+	{
+		return;
+	}
+	FLOAT log_emin = LOG(lut[0]);
+	FLOAT dlog = (LOG(lut[n - 1]) - log_emin) / (FLOAT)(n - 1);
+	if (!(dlog > 0))
+	{
+		return;
+	}
+	for (m = 0; m < lut_shape[0]; m++)
+	{
+		for (i = 0; i < n; i++)
+		{
+			if (FABS(lut[m * material_size + i] - EXP(log_emin + dlog * i)) > lut[m * material_size + i] * LOG_GRID_TOLERANCE)
+			{
+				return;
+			}
+		}
+	}
+	lut_log_grid[0] = log_emin;
+	lut_log_grid[1] = 1 / dlog;
+}
+
+void setup_majorant_lut(int *lut_shape, FLOAT *lut, uint64_t material_set, FLOAT *majorant_lut)
+{
+	/*Computes the woodcock majorant for each energy in the attenuation lut as the largest total attenuation of the
+	materials in material_set, where bit m is set for material m. Materials above 63 are only included in the set with
+	all bits set. Interpolating the table between two energies gives an upper bound for the interpolated attenuation
+	of every material in the set.*/
+	size_t material_size = lut_shape[1] * lut_shape[2];
+	size_t i, m;
+	for (i = 0; i < lut_shape[2]; i++)
+	{
+		majorant_lut[i] = 0;
+		for (m = 0; m < lut_shape[0]; m++)
+		{
+			if ((m < 64) ? ((material_set >> m) & 1) : (material_set == UINT64_MAX))
+			{
+				majorant_lut[i] = FMAX(majorant_lut[i], lut[m * material_size + lut_shape[2] + i]);
+			}
+		}
+	}
+}
+
+MacroGrid* setup_macro_grid(int *shape, FLOAT *spacing, uint32_t *voxels, int *lut_shape, FLOAT *lut)
+{
+	/*Divides the volume into blocks of 2^MACRO_BLOCK_SHIFT voxels along each axis and finds the largest density and the
+	set of materials in each block. A woodcock majorant table is computed for each distinct material set. Blocks with
+	zero density or zero attenuation for all materials at all energies are flagged as empty.*/
+	MacroGrid *macro = (MacroGrid*)malloc(sizeof(MacroGrid));
+	size_t i, j, k, b, n;
+	size_t block_size = ((size_t)1) << MACRO_BLOCK_SHIFT;
+	macro->block_shift = MACRO_BLOCK_SHIFT;
+	macro->block_size = (int)block_size;
+	for (i = 0; i < 3; i++)
+	{
+		macro->shape[i] = (shape[i] + block_size - 1) / block_size;
+	}
+	size_t n_blocks = (size_t)macro->shape[0] * (size_t)macro->shape[1] * (size_t)macro->shape[2];
+	uint64_t *block_materials = (uint64_t*)calloc(n_blocks, sizeof(uint64_t));
+	macro->block_density = (FLOAT*)calloc(n_blocks, sizeof(FLOAT));
+	macro->block_set = (int*)malloc(n_blocks * sizeof(int));
+	macro->step_epsilon = MACRO_STEP_EPSILON * FMIN(spacing[0], FMIN(spacing[1], spacing[2]));
+
+	size_t index = 0;
+	int material;
+	for (i = 0; i < shape[0]; i++)
+	{
+		for (j = 0; j < shape[1]; j++)
+		{
+			for (k = 0; k < shape[2]; k++)
+			{
+				b = (i / block_size) * macro->shape[1] * macro->shape[2] + (j / block_size) * macro->shape[2] + k / block_size;
+				material = voxel_material(voxels[index]);
+				if (material < 64)
+				{
+					block_materials[b] |= ((uint64_t)1) << material;
+				}
+				else
+				{
+					block_materials[b] = UINT64_MAX;
+				}
+				macro->block_density[b] = FMAX(macro->block_density[b], voxel_density(voxels[index]));
+				index++;
+			}
+		}
+	}
+
+	// finding distinct material sets
+	uint64_t *sets = (uint64_t*)malloc(n_blocks * sizeof(uint64_t));
+	int n_sets = 0;
+	int set;
+	for (b = 0; b < n_blocks; b++)
+	{
+		for (set = n_sets - 1; set >= 0; set--)
+		{
+			if (sets[set] == block_materials[b])
+			{
+				break;
+			}
+		}
+		if (set < 0)
+		{
+			sets[n_sets] = block_materials[b];
+			set = n_sets;
+			n_sets++;
+		}
+		macro->block_set[b] = set;
+	}
+	macro->n_sets = n_sets;
+	macro->majorant_lut = (FLOAT*)malloc(n_sets * lut_shape[2] * sizeof(FLOAT));
+
+	bool *empty_set = (bool*)malloc(n_sets * sizeof(bool));
+	for (set = 0; set < n_sets; set++)
+	{
+		setup_majorant_lut(lut_shape, lut, sets[set], &(macro->majorant_lut[set * lut_shape[2]]));
+		empty_set[set] = true;
+		for (n = 0; n < lut_shape[2]; n++)
+		{
+			if (macro->majorant_lut[set * lut_shape[2] + n] > 0)
+			{
+				empty_set[set] = false;
+				break;
+			}
+		}
+	}
+
+	// flagging empty blocks
+	for (b = 0; b < n_blocks; b++)
+	{
+		if (empty_set[macro->block_set[b]] || (macro->block_density[b] <= 0))
+		{
+			macro->block_set[b] = -1;
+		}
+	}
+
+	free(empty_set);
+	free(sets);
+	free(block_materials);
+	return macro;
+}
+
+void cleanup_macro_grid(MacroGrid *macro)
+{
+	free(macro->block_set);
+	free(macro->block_density);
+	free(macro->majorant_lut);
+	free(macro);
+}
+
+double klein_nishina(double epsilon, double k)
+{
+	// Klein-Nishina cross section per unit epsilon up to a constant, epsilon is the ratio of scattered to incident energy
+	double t = (1. - epsilon) / (k * epsilon);
+	double qsin_theta = t * (2. - t);
+	return (1. / epsilon + epsilon) * (1. - epsilon / (1. + epsilon * epsilon) * qsin_theta);
+}
+
+ComptonTable* setup_compton_table(FLOAT emin, FLOAT emax)
+{
+	/*Tabulates the inverse cdf of the Klein-Nishina cross section for COMPTON_TABLE_ENERGIES energies on an uniform
+	logarithmic grid from emin to emax and COMPTON_TABLE_VARIATES uniform variates from 0 to 1. The cdf is integrated
+	with the trapezoidal rule and inverted by linear interpolation, in double precision also in float builds. The
+	table stores epsilon as a fraction of the interval from epsilon_0 to 1 so energies can be interpolated.*/
+	ComptonTable *table = (ComptonTable*)malloc(sizeof(ComptonTable));
+	size_t n_e = COMPTON_TABLE_ENERGIES;
+	size_t n_v = COMPTON_TABLE_VARIATES;
+	size_t n_x = COMPTON_TABLE_INTEGRATION_POINTS;
+	size_t i, j, l;
+	double log_emin = log((double)emin);
+	double log_emax = log((double)FMAX(emax, 2 * emin));
+	double dlog = (log_emax - log_emin) / (double)(n_e - 1);
+	double *cdf = (double*)malloc(n_x * sizeof(double));
+	table->n_energies = (int)n_e;
+	table->n_variates = (int)n_v;
+	table->log_emin = (FLOAT)log_emin;
+	table->inv_dlog = (FLOAT)(1. / dlog);
+	table->fraction = (FLOAT*)malloc(n_e * n_v * sizeof(FLOAT));
+	for (i = 0; i < n_e; i++)
+	{
+		double k = exp(log_emin + dlog * (double)i) / ELECTRON_MASS;
+		double epsilon_0 = 1. / (1. + 2. * k);
+		double dx = 1. / (double)(n_x - 1);
+		double f_prev = klein_nishina(epsilon_0, k);
+		cdf[0] = 0;
+		for (l = 1; l < n_x; l++)
+		{
+			double f = klein_nishina(epsilon_0 + (double)l * dx * (1. - epsilon_0), k);
+			cdf[l] = cdf[l - 1] + (f + f_prev) * .5;
+			f_prev = f;
+		}
+		l = 0;
+		for (j = 0; j < n_v; j++)
+		{
+			double u = cdf[n_x - 1] * (double)j / (double)(n_v - 1);
+			while ((l < n_x - 2) && (cdf[l + 1] < u))
+			{
+				l++;
+			}
+			double w = (u - cdf[l]) / (cdf[l + 1] - cdf[l]);
+			table->fraction[i * n_v + j] = (FLOAT)(((double)l + fmin(fmax(w, 0.), 1.)) * dx);
+		}
+	}
+	free(cdf);
+	return table;
+}
+
+void cleanup_compton_table(ComptonTable *table)
+{
+	free(table->fraction);
+	free(table);
+}
+
+void* setup_simulation(int *shape, FLOAT *spacing, FLOAT *offset, uint32_t *voxels, int *lut_shape, FLOAT *attenuation_lut, double *energy_imparted, double *energy_squared, FLOAT *importance, int *use_siddon, int *tally_mode, int64_t *tally_memory_budget, uint64_t *seed)
 {
 	Simulation *sim_dev = (Simulation*)malloc(sizeof(Simulation));
 	sim_dev->shape = shape;
 	sim_dev->spacing = spacing;
 	sim_dev->offset = offset;
-	sim_dev->material_map = material_map;
-	sim_dev->density_map = density_map;
+	sim_dev->voxels = voxels;
 	sim_dev->lut_shape = lut_shape;
 	sim_dev->attenuation_lut = attenuation_lut;
 	sim_dev->energy_imparted = energy_imparted;
+	sim_dev->energy_squared = energy_squared;
+	sim_dev->importance = importance;
+	sim_dev->batch_start = NULL;
+	if (energy_squared != NULL)
+	{
+		// energy imparted at the start of the current batch, the batch sum is the difference when the batch ends
+		size_t n_voxels = (size_t)shape[0] * (size_t)shape[1] * (size_t)shape[2];
+		sim_dev->batch_start = (double*)malloc(n_voxels * sizeof(double));
+		for (size_t i = 0; i < n_voxels; i++)
+		{
+			sim_dev->batch_start[i] = energy_imparted[i];
+		}
+	}
 	sim_dev->use_siddon_pathing = use_siddon;
+	sim_dev->tally_mode = tally_mode[0];
+	sim_dev->tally_memory_budget = tally_memory_budget[0];
+	sim_dev->tallies = NULL;
+	sim_dev->n_tallies = 0;
 
 	FLOAT *max_dens = (FLOAT*)malloc(sizeof(FLOAT));
 	max_dens[0] = 0;
 
 	for (size_t i = 0; i < sim_dev->shape[0] * sim_dev->shape[1] * sim_dev->shape[2]; i++)
 	{
-		max_dens[0] = FMAX(max_dens[0], density_map[i]);
+		max_dens[0] = FMAX(max_dens[0], voxel_density(voxels[i]));
 	}
 
 	sim_dev->max_density = max_dens;
 
-	sim_dev->seed = (uint64_t*)malloc(2 * sizeof(uint64_t));
-	(sim_dev->seed)[0] = time(NULL);
-	(sim_dev->seed)[1] = shape[0];
+	sim_dev->lut_log_grid = (FLOAT*)malloc(2 * sizeof(FLOAT));
+	setup_lut_log_grid(lut_shape, attenuation_lut, sim_dev->lut_log_grid);
+
+	sim_dev->macro_grid = setup_macro_grid(shape, spacing, voxels, lut_shape, attenuation_lut);
+	// the compton table covers the lut energies, photons below the energy cutoff are not transported
+	sim_dev->compton_table = setup_compton_table(ENERGY_CUTOFF, attenuation_lut[lut_shape[2] - 1]);
+
+	sim_dev->seed = seed[0];
+	sim_dev->stream = 0;
+	sim_dev->progress = NULL;
+	sim_dev->n_threads = 0;
+	sim_dev->schedule = 2;  // omp_sched_dynamic
+	sim_dev->chunk_size = DYNAMIC_CHUNK_SIZE;
+	sim_dev->affinity = NULL;
+	sim_dev->n_affinity = 0;
+	sim_dev->phase_space.data = NULL;
+	sim_dev->phase_space.capacity = 0;
+	sim_dev->phase_space.count = NULL;
+	sim_dev->phase_space.mode = PHASE_SPACE_OFF;
+	sim_dev->scoring = SCORING_COLLISION;
+	sim_dev->forced_interaction = 0;
+	sim_dev->weight_cutoff = WEIGHT_CUTOFF;
+	sim_dev->roulette_chance = RUSSIAN_RULETTE_CHANCE;
+	sim_dev->weight_window = 0;
+	for (int i = 0; i < 4; i++)
+	{
+		sim_dev->exponential_transform[i] = 0;
+	}
 	return (void*)sim_dev;
 }
 #endif
@@ -1034,9 +1916,86 @@ __host__ void* setup_source(FLOAT *source_position, FLOAT *source_direction, FLO
 }
 
 #else
+void setup_alias_table(double *weights, size_t n, AliasTable *table)
+{
+	/*Builds a Walker alias table for drawing n bins with probabilities proportional to weights by the method of Vose.
+	table->probability and table->alias must hold n elements.*/
+	double total = 0;
+	size_t i, s, l;
+	size_t n_small = 0, n_large = 0;
+	double *scaled = (double*)malloc(n * sizeof(double));
+	size_t *small = (size_t*)malloc(n * sizeof(size_t));
+	size_t *large = (size_t*)malloc(n * sizeof(size_t));
+	table->n = (int)n;
+	for (i = 0; i < n; i++)
+	{
+		total += fmax(weights[i], 0.);
+	}
+	for (i = 0; i < n; i++)
+	{
+		scaled[i] = (total > 0) ? fmax(weights[i], 0.) * (double)n / total : 1.;
+		if (scaled[i] < 1.)
+		{
+			small[n_small++] = i;
+		}
+		else
+		{
+			large[n_large++] = i;
+		}
+	}
+	while ((n_small > 0) && (n_large > 0))
+	{
+		s = small[--n_small];
+		l = large[--n_large];
+		table->probability[s] = (FLOAT)scaled[s];
+		table->alias[s] = (int)l;
+		scaled[l] = (scaled[l] + scaled[s]) - 1.;
+		if (scaled[l] < 1.)
+		{
+			small[n_small++] = l;
+		}
+		else
+		{
+			large[n_large++] = l;
+		}
+	}
+	// remaining bins are full, also bins left in small by rounding
+	while (n_large > 0)
+	{
+		l = large[--n_large];
+		table->probability[l] = 1;
+		table->alias[l] = (int)l;
+	}
+	while (n_small > 0)
+	{
+		s = small[--n_small];
+		table->probability[s] = 1;
+		table->alias[s] = (int)s;
+	}
+	free(scaled);
+	free(small);
+	free(large);
+}
+
+void setup_specter_table(FLOAT *specter_cpd, int n_specter, AliasTable *table)
+{
+	/*Builds the specter alias table from the cumulative specter, bin 0 holds the probability of the first energy and
+	bin i the probability of the interval from energy i - 1 to energy i.*/
+	double *weights = (double*)malloc(n_specter * sizeof(double));
+	weights[0] = specter_cpd[0];
+	for (int i = 1; i < n_specter; i++)
+	{
+		weights[i] = specter_cpd[i] - specter_cpd[i - 1];
+	}
+	setup_alias_table(weights, n_specter, table);
+	free(weights);
+}
+
 void* setup_source(FLOAT *source_position, FLOAT *source_direction, FLOAT *scan_axis, FLOAT *sdd, FLOAT *fov, FLOAT *collimation, FLOAT *weight, FLOAT *specter_cpd, FLOAT *specter_energy, int *specter_elements)
 {
-	Source *source_dev = (Source*)malloc(sizeof(Source));
+	// the specter table is allocated with the source so cleanup_source frees both
+	size_t n_specter = specter_elements[0];
+	Source *source_dev = (Source*)malloc(sizeof(Source) + n_specter * (sizeof(FLOAT) + sizeof(int)));
 	source_dev->source_position = source_position;
 	source_dev->source_direction = source_direction;
 	source_dev->scan_axis = scan_axis;
@@ -1047,11 +2006,20 @@ void* setup_source(FLOAT *source_position, FLOAT *source_direction, FLOAT *scan_
 	source_dev->specter_elements = specter_elements;
 	source_dev->specter_cpd = specter_cpd;
 	source_dev->specter_energy = specter_energy;
+	source_dev->specter_table.probability = (FLOAT*)(source_dev + 1);
+	source_dev->specter_table.alias = (int*)(source_dev->specter_table.probability + n_specter);
+	setup_specter_table(specter_cpd, n_specter, &source_dev->specter_table);
 	return (void*)source_dev;
 }
 void* setup_source_bowtie(FLOAT *source_position, FLOAT *source_direction, FLOAT *scan_axis, FLOAT *scan_axis_fan_angle, FLOAT *rot_axis_fan_angle, FLOAT *weight, FLOAT *specter_cpd, FLOAT *specter_energy, int *specter_elements, FLOAT *bowtie_weight, FLOAT *bowtie_angle, int* bowtie_elements)
 {
-	SourceBowtie *source_dev = (SourceBowtie*)malloc(sizeof(SourceBowtie));
+	/*Sets up a bowtie source and builds the alias tables for the specter and the fan angle, the tables are allocated
+	with the source so cleanup_source frees them. Fan angles are drawn with probability proportional to the bowtie
+	weight and photons get the mean bowtie weight over the fan, which keeps the expected fluence at each angle.*/
+	size_t n_specter = specter_elements[0];
+	size_t n_bins = (bowtie_elements[0] > 1) ? (size_t)(bowtie_elements[0] - 1) : 0;
+	size_t i;
+	SourceBowtie *source_dev = (SourceBowtie*)malloc(sizeof(SourceBowtie) + (n_specter + n_bins) * (sizeof(FLOAT) + sizeof(int)));
 	source_dev->source_position = source_position;
 	source_dev->source_direction = source_direction;
 	source_dev->scan_axis = scan_axis;
@@ -1064,6 +2032,30 @@ void* setup_source_bowtie(FLOAT *source_position, FLOAT *source_direction, FLOAT
 	source_dev->bowtie_elements = bowtie_elements;
 	source_dev->bowtie_weight = bowtie_weight;
 	source_dev->bowtie_angle = bowtie_angle;
+
+	FLOAT *probabilities = (FLOAT*)(source_dev + 1);
+	int *aliases = (int*)(probabilities + n_specter + n_bins);
+	source_dev->specter_table.probability = probabilities;
+	source_dev->specter_table.alias = aliases;
+	setup_specter_table(specter_cpd, n_specter, &source_dev->specter_table);
+
+	source_dev->bowtie_table.n = 0;
+	source_dev->bowtie_table.probability = probabilities + n_specter;
+	source_dev->bowtie_table.alias = aliases + n_specter;
+	source_dev->bowtie_mean_weight = bowtie_weight[0];
+	if (n_bins > 0)
+	{
+		double *areas = (double*)malloc(n_bins * sizeof(double));
+		double total = 0;
+		for (i = 0; i < n_bins; i++)
+		{
+			areas[i] = ((double)bowtie_weight[i] + (double)bowtie_weight[i + 1]) * .5 * ((double)bowtie_angle[i + 1] - (double)bowtie_angle[i]);
+			total += areas[i];
+		}
+		setup_alias_table(areas, n_bins, &source_dev->bowtie_table);
+		source_dev->bowtie_mean_weight = (FLOAT)(total / ((double)bowtie_angle[n_bins] - (double)bowtie_angle[0]));
+		free(areas);
+	}
 	return (void*)source_dev;
 }
 #endif
@@ -1175,82 +2167,263 @@ __host__ void run_simulation(void *dev_source, size_t n_particles, void *dev_sim
 	return;
 }
 #else
-void run_simulation(void *dev_source, int64_t n_particles, void *dev_simulation)
+bool update_progress(Progress *progress, int64_t *histories, int64_t *interactions)
 {
-	// simulating particles
+	/*Adds the histories and interactions counted by a thread to the shared progress counters and resets the thread
+	counts. Returns true if the simulation is cancelled.*/
+	int32_t cancel = 0;
+	if (progress != NULL)
+	{
+#pragma omp atomic
+		progress->histories += histories[0];
+#pragma omp atomic
+		progress->interactions += interactions[0];
+#if _OPENMP >= 201107
+#pragma omp atomic read
+		cancel = progress->cancel;
+#else
+#pragma omp flush
+		cancel = progress->cancel;
+#endif
+	}
+	histories[0] = 0;
+	interactions[0] = 0;
+	return cancel != 0;
+}
 
-	size_t thread_number;
-	size_t n_threads = omp_get_max_threads();
+size_t simulation_threads(Simulation *sim)
+{
+	// Returns the number of threads for runs of the simulation
+	if (sim->n_threads > 0)
+	{
+		return (size_t)sim->n_threads;
+	}
+	return (size_t)omp_get_max_threads();
+}
 
-	trackingFuncPtr tracking_func;
+#ifdef __linux__
+typedef cpu_set_t CpuMask;
+#else
+typedef int CpuMask;
+#endif
 
-	if (((Simulation*)dev_simulation)->use_siddon_pathing[0] == 1)
+bool pin_thread(Simulation *sim, size_t thread_number, CpuMask *previous)
+{
+	/*Pins the calling thread to a cpu from the affinity list of the simulation, threads are given the cpus in turn.
+	The cpus the thread was allowed to run on are stored in previous for unpin_thread. Returns false and does nothing
+	without an affinity list or on platforms other than linux.*/
+#ifdef __linux__
+	if ((sim->n_affinity > 0) && (sched_getaffinity(0, sizeof(cpu_set_t), previous) == 0))
 	{
-		tracking_func = &siddon_path;
+		cpu_set_t cpus;
+		CPU_ZERO(&cpus);
+		CPU_SET(sim->affinity[thread_number % (size_t)sim->n_affinity], &cpus);
+		return sched_setaffinity(0, sizeof(cpu_set_t), &cpus) == 0;
 	}
-	else
+#endif
+	return false;
+}
+
+void unpin_thread(bool pinned, CpuMask *previous)
+{
+	/*Restores the cpus of a thread pinned by pin_thread, the calling thread of a run is an application thread that
+	must not stay pinned.*/
+#ifdef __linux__
+	if (pinned)
 	{
-		tracking_func = &woodcock_step;
+		sched_setaffinity(0, sizeof(cpu_set_t), previous);
 	}
+#endif
+}
 
-	uint64_t *states = (uint64_t*)malloc(2 * n_threads * sizeof(uint64_t));
-	init_random_seed(((Simulation*)dev_simulation)->seed, &n_threads, states);
+void add_counters(Counters *thread_counters, size_t n_threads, Counters *counters)
+{
+	// Adds the event counters of each thread to counters and frees the thread counters, counters may be NULL
+	size_t n_counters = sizeof(Counters) / sizeof(int64_t);
+	size_t i, t;
+	if (counters != NULL)
+	{
+		for (t = 0; t < n_threads; t++)
+		{
+			for (i = 0; i < n_counters; i++)
+			{
+				((int64_t*)counters)[i] += ((int64_t*)&thread_counters[t])[i];
+			}
+		}
+	}
+	free(thread_counters);
+}
 
-#pragma omp parallel num_threads(n_threads) private(thread_number)
+Tally* setup_tallies(Simulation *sim, size_t n_threads)
+{
+	/*Returns an array of n_threads energy tallies according to the tally mode of the simulation. In automatic
+	mode private tallies are used if the n_threads - 1 extra tallies fits in the tally memory budget, else slab
+	tallies. Thread 0 always scores directly in energy_imparted. Falls back to slab tallies if the private tallies
+	can not be allocated.*/
+	size_t n_voxels = (size_t)sim->shape[0] * (size_t)sim->shape[1] * (size_t)sim->shape[2];
+	size_t i, j;
+	int mode = sim->tally_mode;
+
+	Tally *tallies = (Tally*)malloc(n_threads * sizeof(Tally));
+
+	if (mode == TALLY_AUTO)
 	{
-		thread_number = omp_get_thread_num();
-		int64_t i;
-#pragma omp for
-		for (i = 0; i < n_particles; i++)
-		{
-			transport_particles
-				(
-				((Source*)dev_source)->source_position,
-				((Source*)dev_source)->source_direction,
-				((Source*)dev_source)->scan_axis,
-				((Source*)dev_source)->sdd,
-				((Source*)dev_source)->fov,
-				((Source*)dev_source)->collimation,
-				((Source*)dev_source)->weight,
-				((Source*)dev_source)->specter_elements,
-				((Source*)dev_source)->specter_cpd,
-				((Source*)dev_source)->specter_energy,
-				&thread_number,
-				((Simulation*)dev_simulation)->shape,
-				((Simulation*)dev_simulation)->spacing,
-				((Simulation*)dev_simulation)->offset,
-				((Simulation*)dev_simulation)->material_map,
-				((Simulation*)dev_simulation)->density_map,
-				((Simulation*)dev_simulation)->lut_shape,
-				((Simulation*)dev_simulation)->attenuation_lut,
-				((Simulation*)dev_simulation)->energy_imparted,
-				((Simulation*)dev_simulation)->max_density,
-				tracking_func,
-				states);
+		if ((n_threads - 1) * n_voxels * sizeof(double) <= (size_t)sim->tally_memory_budget)
+		{
+			mode = TALLY_PRIVATE;
+		}
+		else
+		{
+			mode = TALLY_SLAB;
 		}
 	}
-	// free  memory
-	if (states)
+
+	for (i = 0; i < n_threads; i++)
 	{
-		free(states);
+		tallies[i].energy_imparted = sim->energy_imparted;
+		tallies[i].mode = mode;
+		tallies[i].slab_size = (size_t)sim->shape[1] * (size_t)sim->shape[2];
+		tallies[i].slab_locks = NULL;
 	}
-	return;
+
+	if (mode == TALLY_PRIVATE)
+	{
+		for (i = 1; i < n_threads; i++)
+		{
+			tallies[i].energy_imparted = (double*)calloc(n_voxels, sizeof(double));
+			if (tallies[i].energy_imparted == NULL)
+			{
+				// not enough memory, falling back to slab tallies
+				for (j = 1; j < i; j++)
+				{
+					free(tallies[j].energy_imparted);
+				}
+				for (j = 0; j < n_threads; j++)
+				{
+					tallies[j].energy_imparted = sim->energy_imparted;
+				}
+				mode = TALLY_SLAB;
+				break;
+			}
+		}
+	}
+
+	if (mode == TALLY_SLAB)
+	{
+		/*The slabs are planes of the first axis, x, not of the scan axis z. The threads of a run share the histories
+		of a few consecutive exposures, so their primary photons are collimated to the same few z planes and z slab locks
+		would be contended by all threads. The fan beams cross many x planes in every exposure. x planes are also the
+		slowest varying axis of the C ordered arrays, so each slab is one contiguous block. Slab locks cost one lock per
+		score, that is one per voxel crossed with track length scoring, they are meant for volumes whose private tallies
+		do not fit in memory.*/
+		omp_lock_t *slab_locks = (omp_lock_t*)malloc(sim->shape[0] * sizeof(omp_lock_t));
+		for (i = 0; i < (size_t)sim->shape[0]; i++)
+		{
+			omp_init_lock(&slab_locks[i]);
+		}
+		for (i = 0; i < n_threads; i++)
+		{
+			tallies[i].mode = mode;
+			tallies[i].slab_locks = slab_locks;
+		}
+	}
+	return tallies;
 }
 
-void run_simulation_bowtie(void *dev_source, int64_t n_particles, void *dev_simulation)
+void reduce_tallies(Simulation *sim)
 {
-	// simulating particles
+	/*Adds the private tallies of the simulation to energy_imparted and zeroes them. Slab and atomic tallies score
+	directly in energy_imparted.*/
+	Tally *tallies = sim->tallies;
+	size_t n_threads = sim->n_tallies;
+	int64_t n_voxels = (int64_t)sim->shape[0] * (int64_t)sim->shape[1] * (int64_t)sim->shape[2];
+	int64_t i;
+	size_t t;
+	if ((tallies == NULL) || (tallies[0].mode != TALLY_PRIVATE) || (n_threads < 2))
+	{
+		return;
+	}
+#pragma omp parallel for num_threads(n_threads) private(t)
+	for (i = 0; i < n_voxels; i++)
+	{
+		for (t = 1; t < n_threads; t++)
+		{
+			sim->energy_imparted[i] += tallies[t].energy_imparted[i];
+			tallies[t].energy_imparted[i] = 0;
+		}
+	}
+}
 
+void cleanup_tallies(Simulation *sim)
+{
+	// Reduces the tallies of the simulation and frees all tally memory
+	Tally *tallies = sim->tallies;
+	size_t t;
+	int i;
+	if (tallies == NULL)
+	{
+		return;
+	}
+	reduce_tallies(sim);
+	if (tallies[0].mode == TALLY_PRIVATE)
+	{
+		for (t = 1; t < sim->n_tallies; t++)
+		{
+			free(tallies[t].energy_imparted);
+		}
+	}
+	else if (tallies[0].mode == TALLY_SLAB)
+	{
+		for (i = 0; i < sim->shape[0]; i++)
+		{
+			omp_destroy_lock(&(tallies[0].slab_locks[i]));
+		}
+		free(tallies[0].slab_locks);
+	}
+	free(tallies);
+	sim->tallies = NULL;
+	sim->n_tallies = 0;
+}
+
+Tally* simulation_tallies(Simulation *sim, size_t n_threads)
+{
+	/*Returns the n_threads energy tallies of the simulation. The tallies are set up by the first run and kept for the
+	following runs, so private tallies are allocated once per simulation and only reduced by end_batch and cleanup. A
+	run with another number of threads reduces and frees the tallies of the previous runs first.*/
+	if ((sim->tallies != NULL) && (sim->n_tallies != n_threads))
+	{
+		cleanup_tallies(sim);
+	}
+	if (sim->tallies == NULL)
+	{
+		sim->tallies = setup_tallies(sim, n_threads);
+		sim->n_tallies = n_threads;
+	}
+	return sim->tallies;
+}
+
+void run_histories(Simulation *sim, void *source, historyFuncPtr history_func, int64_t n_histories, Counters *counters)
+{
+	/*Simulates n_histories histories in one parallel region, history_func transports history i of the source. Each
+	history has its own random stream numbered consecutively from the stream of the simulation, the stream of the
+	simulation is advanced past the histories afterwards. Private tallies are not reduced into energy_imparted until
+	end_batch or cleanup_simulation.*/
 	size_t thread_number;
-	size_t n_threads = omp_get_max_threads();
+	size_t n_threads = simulation_threads(sim);
 
 	uint64_t *states = (uint64_t*)malloc(2 * n_threads * sizeof(uint64_t));
-
-	init_random_seed(((Simulation*)dev_simulation)->seed, &n_threads, states);
+	uint64_t seed = sim->seed;
+	uint64_t stream = sim->stream;
+	Progress *progress = sim->progress;
+	Tally *tallies = simulation_tallies(sim, n_threads);
+	Counters *thread_counters = (Counters*)calloc(n_threads, sizeof(Counters));
+#if _OPENMP >= 200805
+	omp_set_schedule((omp_sched_t)sim->schedule, sim->chunk_size);
+#endif
 
 	trackingFuncPtr tracking_func;
 
-	if (((Simulation*)dev_simulation)->use_siddon_pathing[0] == 1)
+	if (sim->use_siddon_pathing[0] == 1)
 	{
 		tracking_func = &siddon_path;
 	}
@@ -1259,41 +2432,43 @@ void run_simulation_bowtie(void *dev_source, int64_t n_particles, void *dev_simu
 		tracking_func = &woodcock_step;
 	}
 
-
 #pragma omp parallel num_threads(n_threads) private(thread_number)
 	{
 		thread_number = omp_get_thread_num();
+		CpuMask cpus;
+		bool pinned = pin_thread(sim, thread_number, &cpus);
 		int64_t i;
-#pragma omp for
-		for (i = 0; i < n_particles; i++)
-		{
-			transport_particles_bowtie(
-				((SourceBowtie*)dev_source)->source_position,
-				((SourceBowtie*)dev_source)->source_direction,
-				((SourceBowtie*)dev_source)->scan_axis,
-				((SourceBowtie*)dev_source)->scan_axis_fan_angle,
-				((SourceBowtie*)dev_source)->rot_axis_fan_angle,
-				((SourceBowtie*)dev_source)->weight,
-				((SourceBowtie*)dev_source)->specter_elements,
-				((SourceBowtie*)dev_source)->specter_cpd,
-				((SourceBowtie*)dev_source)->specter_energy,
-				((SourceBowtie*)dev_source)->bowtie_elements,
-				((SourceBowtie*)dev_source)->bowtie_weight,
-				((SourceBowtie*)dev_source)->bowtie_angle,
+		int64_t histories = 0, interactions = 0;
+		bool cancelled = update_progress(progress, &histories, &interactions);
+#pragma omp for schedule(runtime)
+		for (i = 0; i < n_histories; i++)
+		{
+			if (cancelled)
+			{
+				continue;
+			}
+			init_history_stream(seed, stream + (uint64_t)i, &states[thread_number * 2]);
+			history_func(
+				source,
+				i,
 				&thread_number,
-				((Simulation*)dev_simulation)->shape,
-				((Simulation*)dev_simulation)->spacing,
-				((Simulation*)dev_simulation)->offset,
-				((Simulation*)dev_simulation)->material_map,
-				((Simulation*)dev_simulation)->density_map,
-				((Simulation*)dev_simulation)->lut_shape,
-				((Simulation*)dev_simulation)->attenuation_lut,
-				((Simulation*)dev_simulation)->energy_imparted,
-				((Simulation*)dev_simulation)->max_density,
+				sim,
+				&tallies[thread_number],
 				tracking_func,
-				states);
+				states,
+				&interactions,
+				&thread_counters[thread_number]);
+			histories++;
+			if (histories == PROGRESS_INTERVAL)
+			{
+				cancelled = update_progress(progress, &histories, &interactions);
+			}
 		}
+		update_progress(progress, &histories, &interactions);
+		unpin_thread(pinned, &cpus);
 	}
+	add_counters(thread_counters, n_threads, counters);
+	sim->stream = stream + (uint64_t)n_histories;
 	// free  memory
 	if (states)
 	{
@@ -1301,6 +2476,82 @@ void run_simulation_bowtie(void *dev_source, int64_t n_particles, void *dev_simu
 	}
 	return;
 }
+
+void history_source(void *source, int64_t history, size_t *thread_number, Simulation *sim, Tally *tally, trackingFuncPtr tracking_func, uint64_t *states, int64_t *interactions, Counters *counters)
+{
+	// Transports a photon from a Source
+	transport_particles((Source*)source, thread_number, sim, tally, tracking_func, states, interactions, counters);
+}
+
+void history_bowtie(void *source, int64_t history, size_t *thread_number, Simulation *sim, Tally *tally, trackingFuncPtr tracking_func, uint64_t *states, int64_t *interactions, Counters *counters)
+{
+	// Transports a photon from a SourceBowtie at the source position
+	SourceBowtie *bowtie = (SourceBowtie*)source;
+	transport_particles_bowtie(bowtie->source_position, bowtie->source_direction, bowtie->scan_axis, bowtie->weight,
+		bowtie, thread_number, sim, tally, tracking_func, states, interactions, counters);
+}
+
+void history_bowtie_batch(void *source, int64_t history, size_t *thread_number, Simulation *sim, Tally *tally, trackingFuncPtr tracking_func, uint64_t *states, int64_t *interactions, Counters *counters)
+{
+	// Transports a photon from the exposure of a BowtieBatch the history belongs to
+	BowtieBatch *batch = (BowtieBatch*)source;
+	int64_t e = history / batch->n_particles;
+	transport_particles_bowtie(&batch->source_position[e * 3], &batch->source_direction[e * 3],
+		&batch->scan_axis[e * 3], &batch->weight[e], batch->source, thread_number, sim, tally, tracking_func,
+		states, interactions, counters);
+}
+
+void history_phase_space(void *source, int64_t history, size_t *thread_number, Simulation *sim, Tally *tally, trackingFuncPtr tracking_func, uint64_t *states, int64_t *interactions, Counters *counters)
+{
+	// Transports a photon replayed from a PhaseSpaceReplay, photons are not recorded while replaying
+	PhaseSpaceReplay *replay = (PhaseSpaceReplay*)source;
+	FLOAT particle[PHASE_SPACE_FIELDS];
+	int64_t j;
+	for (j = 0; j < PHASE_SPACE_FIELDS; j++)
+	{
+		particle[j] = (FLOAT)replay->data[j * replay->capacity + replay->start + history];
+	}
+	COUNT(counters, histories);
+	transport_primary(particle, sim, tally, tracking_func, &states[thread_number[0] * 2], interactions, counters);
+}
+
+void run_simulation(void *dev_source, int64_t n_particles, void *dev_simulation, Counters *counters)
+{
+	// simulating particles
+	run_histories((Simulation*)dev_simulation, dev_source, &history_source, n_particles, counters);
+}
+
+void run_simulation_bowtie(void *dev_source, int64_t n_particles, void *dev_simulation, Counters *counters)
+{
+	// simulating particles
+	run_histories((Simulation*)dev_simulation, dev_source, &history_bowtie, n_particles, counters);
+}
+
+void run_simulation_bowtie_batch(void *dev_source, FLOAT *source_position, FLOAT *source_direction, FLOAT *scan_axis, FLOAT *weight, int64_t n_exposures, int64_t n_particles, void *dev_simulation, Counters *counters)
+{
+	/*Simulates n_particles histories for each of n_exposures exposures in one parallel region. The source supplies
+	fan angles, specter and bowtie filter, while source_position, source_direction and scan_axis are FLOAT [n_exposures * 3]
+	arrays and weight is a FLOAT [n_exposures] array describing each exposure.*/
+	BowtieBatch batch;
+	batch.source = (SourceBowtie*)dev_source;
+	batch.source_position = source_position;
+	batch.source_direction = source_direction;
+	batch.scan_axis = scan_axis;
+	batch.weight = weight;
+	batch.n_particles = n_particles;
+	run_histories((Simulation*)dev_simulation, &batch, &history_bowtie_batch, n_exposures * n_particles, counters);
+}
+
+void run_simulation_phase_space(float *phase_space, int64_t capacity, int64_t start, int64_t n_particles, void *dev_simulation, Counters *counters)
+{
+	/*Replays photons start to start + n_particles of a phase space, a float [PHASE_SPACE_FIELDS, capacity] array, as
+	the source of n_particles histories. Photons are not recorded while replaying.*/
+	PhaseSpaceReplay replay;
+	replay.data = phase_space;
+	replay.capacity = capacity;
+	replay.start = start;
+	run_histories((Simulation*)dev_simulation, &replay, &history_phase_space, n_particles, counters);
+}
 #endif
 
 #ifdef USINGCUDA
@@ -1332,12 +2583,174 @@ __host__ void cleanup_simulation(void *dev_simulation, int *shape, FLOAT *energy
 #else
 void cleanup_simulation(void *dev_simulation)
 {
+	// private tallies are reduced into energy_imparted before they are freed
+	cleanup_tallies((Simulation*)dev_simulation);
 	// free memory
 	free(((Simulation*)dev_simulation)->max_density);
-	free(((Simulation*)dev_simulation)->seed);
+	free(((Simulation*)dev_simulation)->lut_log_grid);
+	cleanup_macro_grid(((Simulation*)dev_simulation)->macro_grid);
+	cleanup_compton_table(((Simulation*)dev_simulation)->compton_table);
+	if (((Simulation*)dev_simulation)->batch_start)
+	{
+		free(((Simulation*)dev_simulation)->batch_start);
+	}
+	if (((Simulation*)dev_simulation)->affinity)
+	{
+		free(((Simulation*)dev_simulation)->affinity);
+	}
 	free(dev_simulation);
 	return;
 }
+
+void end_batch(void *dev_simulation)
+{
+	/*Ends a batch of histories. Private tallies are reduced into energy_imparted, which then holds the energy of all
+	runs so far. For the uncertainty tally the energy imparted in each voxel since the previous batch ended is squared
+	and added to energy_squared, if the simulation was set up with energy_squared.*/
+	Simulation *sim = (Simulation*)dev_simulation;
+	reduce_tallies(sim);
+	if (sim->energy_squared == NULL)
+	{
+		return;
+	}
+	int64_t n_voxels = (int64_t)sim->shape[0] * (int64_t)sim->shape[1] * (int64_t)sim->shape[2];
+	int64_t i;
+	double batch_energy;
+#pragma omp parallel for num_threads(simulation_threads(sim)) private(batch_energy)
+	for (i = 0; i < n_voxels; i++)
+	{
+		batch_energy = sim->energy_imparted[i] - sim->batch_start[i];
+		sim->energy_squared[i] += batch_energy * batch_energy;
+		sim->batch_start[i] = sim->energy_imparted[i];
+	}
+}
+
+void set_phase_space(void *dev_simulation, float *data, int64_t capacity, int64_t *count, int mode)
+{
+	/*Records the photons of the following runs in data, a float [PHASE_SPACE_FIELDS, capacity] array, and counts them
+	in count. mode is PHASE_SPACE_SOURCE for photons leaving the source and PHASE_SPACE_BOUNDARY for photons entering
+	the volume, PHASE_SPACE_OFF stops recording. Photons are stored in the order threads reach them.*/
+	Simulation *sim = (Simulation*)dev_simulation;
+	sim->phase_space.data = data;
+	sim->phase_space.capacity = capacity;
+	sim->phase_space.count = count;
+	sim->phase_space.mode = ((data == NULL) || (count == NULL)) ? PHASE_SPACE_OFF : mode;
+}
+
+void set_scoring(void *dev_simulation, int scoring)
+{
+	/*Sets the energy scoring estimator of the following runs, SCORING_COLLISION or SCORING_TRACK_LENGTH. Track length
+	scoring needs the energy absorption coefficients in lut row LUT_ENERGY_ABSORPTION, without them collision scoring is used.*/
+	Simulation *sim = (Simulation*)dev_simulation;
+	if ((scoring == SCORING_TRACK_LENGTH) && (sim->lut_shape[1] > LUT_ENERGY_ABSORPTION))
+	{
+		sim->scoring = SCORING_TRACK_LENGTH;
+	}
+	else
+	{
+		sim->scoring = SCORING_COLLISION;
+	}
+}
+
+void set_forced_interaction(void *dev_simulation, int forced)
+{
+	/*Forces the first interaction of every photon from the source inside the volume in the following runs if forced is
+	non zero, see transport_primary. Forcing reduces the variance where few photons interact, such as in lungs and thin patients.*/
+	((Simulation*)dev_simulation)->forced_interaction = forced;
+}
+
+void set_russian_roulette(void *dev_simulation, FLOAT weight_cutoff, FLOAT roulette_chance, FLOAT weight_window)
+{
+	/*Sets the weight below which photons play russian roulette and their probability of surviving it for the following
+	runs, and the weight window above which photons are split, zero disables splitting. With an importance map the weights
+	are compared after multiplying with the importance of the photon region.*/
+	Simulation *sim = (Simulation*)dev_simulation;
+	sim->weight_cutoff = weight_cutoff;
+	sim->roulette_chance = roulette_chance;
+	sim->weight_window = weight_window;
+}
+
+void set_exponential_transform(void *dev_simulation, FLOAT strength, FLOAT *direction)
+{
+	/*Stretches the steps of photons moving along direction in the following runs with Woodcock tracking, see woodcock_step.
+	strength is in [0, 1), zero disables the transform. direction is normalized.*/
+	Simulation *sim = (Simulation*)dev_simulation;
+	FLOAT length = SQRT(direction[0] * direction[0] + direction[1] * direction[1] + direction[2] * direction[2]);
+	if ((length <= 0) || (strength <= 0))
+	{
+		strength = 0;
+		length = 1;
+	}
+	for (int i = 0; i < 3; i++)
+	{
+		sim->exponential_transform[i] = direction[i] / length;
+	}
+	sim->exponential_transform[3] = strength;
+}
+
+void set_threading(void *dev_simulation, int n_threads, int schedule, int chunk_size, int *affinity, int n_affinity)
+{
+	/*Sets the number of threads, the OpenMP schedule kind and chunk size of the history loops and the cpus threads are
+	pinned to for the following runs of the simulation. n_threads of zero or less uses the OpenMP default and the
+	threads are not pinned if n_affinity is zero. Pinning is only supported on linux, threads are unpinned after a run.
+	Compilers with OpenMP before 3.0, such as MSVC, take the schedule from OMP_SCHEDULE instead. Results do not depend
+	on these settings.*/
+	Simulation *sim = (Simulation*)dev_simulation;
+	sim->n_threads = n_threads;
+	sim->schedule = schedule;
+	sim->chunk_size = chunk_size;
+	if (sim->affinity)
+	{
+		free(sim->affinity);
+		sim->affinity = NULL;
+	}
+	sim->n_affinity = 0;
+	if ((affinity != NULL) && (n_affinity > 0))
+	{
+		sim->affinity = (int*)malloc(n_affinity * sizeof(int));
+		for (int i = 0; i < n_affinity; i++)
+		{
+			sim->affinity[i] = affinity[i];
+		}
+		sim->n_affinity = n_affinity;
+	}
+}
+
+void sample_compton(void *dev_simulation, FLOAT energy, int64_t n, int use_table, uint64_t stream, FLOAT *scatter_energy, FLOAT *theta)
+{
+	/*Draws n compton scattered energies and angles for photons of energy from the random stream number stream, with
+	the inverse cdf table of the simulation if use_table is non zero, else with the rejection sampler. Used to
+	validate the table sampling.*/
+	uint64_t state[2];
+	init_history_stream(((Simulation*)dev_simulation)->seed, stream, state);
+	for (int64_t i = 0; i < n; i++)
+	{
+		if (use_table)
+		{
+			scatter_energy[i] = compton_table_draw_energy_theta(((Simulation*)dev_simulation)->compton_table, energy, &theta[i], state);
+		}
+		else
+		{
+			scatter_energy[i] = compton_event_draw_energy_theta(energy, &theta[i], state);
+		}
+	}
+}
+
+void set_random_stream(void *dev_simulation, uint64_t stream)
+{
+	/*Sets the stream number of the next history. Histories are numbered consecutively from this stream by the
+	following runs, a history with a given seed and stream number is simulated identically whatever the number of
+	threads or how the histories are split between runs and processes.*/
+	((Simulation*)dev_simulation)->stream = stream;
+}
+
+void set_progress(void *dev_simulation, Progress *progress)
+{
+	/*Sets the progress counters of the simulation, NULL stops progress counting. Running threads add to the
+	histories and interactions counters every PROGRESS_INTERVAL histories and skip the remaining histories of the
+	run once the cancel flag is set. The counters are updated atomically and may be read while a run is going.*/
+	((Simulation*)dev_simulation)->progress = progress;
+}
 #endif
 
 #ifdef USINGCUDA
@@ -1382,7 +2795,7 @@ void cleanup_source(void *dev_source)
 
 
 
-void setup_test_environment(int *shape, FLOAT *spacing, FLOAT *offset, int *material_map, FLOAT *density_map, int *att_shape, FLOAT *attenuation_lut, FLOAT *energy_imparted)
+void setup_test_environment(int *shape, FLOAT *spacing, FLOAT *offset, uint32_t *voxels, int *att_shape, FLOAT *attenuation_lut, double *energy_imparted)
 {
 	int i, j, k;
 	size_t ind;
@@ -1400,8 +2813,7 @@ void setup_test_environment(int *shape, FLOAT *spacing, FLOAT *offset, int *mate
 			for (k = 0; k < shape[2]; k++)
 			{
 				ind = i * shape[2] * shape[1] + j * shape[2] + k;
-				material_map[ind] = 0;
-				density_map[ind] = 1;
+				voxels[ind] = pack_voxel(0, 1);
 				energy_imparted[ind] = 0;
 			}
 
@@ -1463,17 +2875,19 @@ int main()
 
 	// init geometry variables
 	//FLOAT *particles = (FLOAT *)malloc(n_particles * 8 * sizeof(FLOAT));
-	int *material_map = (int *)malloc(shape[0] * shape[1] * shape[2] * sizeof(int));
-	FLOAT *density_map = (FLOAT *)malloc(shape[0] * shape[1] * shape[2] * sizeof(FLOAT));
+	uint32_t *voxels = (uint32_t *)malloc(shape[0] * shape[1] * shape[2] * sizeof(uint32_t));
 	FLOAT *attenuation_lut = (FLOAT *)malloc(lut_shape[0] * lut_shape[1] * lut_shape[2] * sizeof(FLOAT));
-	FLOAT *energy_imparted = (FLOAT *)malloc(shape[0] * shape[1] * shape[2] * sizeof(FLOAT));
+	double *energy_imparted = (double *)malloc(shape[0] * shape[1] * shape[2] * sizeof(double));
 
 	// initialazing geometry
-	setup_test_environment(shape, spacing, offset, material_map, density_map, lut_shape, attenuation_lut, energy_imparted);
+	setup_test_environment(shape, spacing, offset, voxels, lut_shape, attenuation_lut, energy_imparted);
 
 
 	void* sim;
-	sim = setup_simulation(shape, spacing, offset, material_map, density_map, lut_shape, attenuation_lut, energy_imparted, &use_siddon);
+	int tally_mode = TALLY_AUTO;
+	int64_t tally_memory_budget = 1073741824;
+	uint64_t seed = time(NULL);
+	sim = setup_simulation(shape, spacing, offset, voxels, lut_shape, attenuation_lut, energy_imparted, NULL, NULL, &use_siddon, &tally_mode, &tally_memory_budget, &seed);
 
 	//init source variables
 	FLOAT source_position[3] = { -7, 0, 0 };
@@ -1503,8 +2917,8 @@ int main()
 
 	void *geo2 = setup_source_bowtie(source_position, source_direction, scan_axis, &scan_angle, &rot_angle, &weight, specter_cpd, specter_energy, &specter_elements, bowtie_weights, bowtie_angle, &bowtie_size);
 
-	run_simulation(geo, n_particles, sim);
-	run_simulation_bowtie(geo2, n_particles, sim);
+	run_simulation(geo, n_particles, sim, NULL);
+	run_simulation_bowtie(geo2, n_particles, sim, NULL);
 
 
 	cleanup_simulation(sim);
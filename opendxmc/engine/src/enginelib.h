@@ -79,29 +79,159 @@ const FLOAT PI = 3.14159265359;
 const FLOAT ENERGY_CUTOFF = 1000; // eV
 const FLOAT WEIGHT_CUTOFF = 0.01;
 const FLOAT RUSSIAN_RULETTE_CHANCE = .2; //CHANCE probability of photon survival
+const int DYNAMIC_CHUNK_SIZE = 64; // default number of histories handed to a thread at a time
+const int64_t PROGRESS_INTERVAL = 64; // histories a thread runs between updates of the shared progress counters
+const int MACRO_BLOCK_SHIFT = 3; // macro voxel blocks are 2^MACRO_BLOCK_SHIFT voxels along each axis
+const FLOAT MACRO_STEP_EPSILON = 1e-4; // fraction of the smallest voxel spacing a particle is pushed past a macro block boundary
+const FLOAT LOG_GRID_TOLERANCE = 1e-5; // relative energy tolerance for detecting an uniform logarithmic lut energy grid
+const int COMPTON_TABLE_ENERGIES = 64; // energies of the compton inverse cdf table, on an uniform logarithmic grid
+const int COMPTON_TABLE_VARIATES = 257; // uniform variates of the compton inverse cdf table
+const int COMPTON_TABLE_INTEGRATION_POINTS = 4096; // points used to integrate the Klein-Nishina cross section for the compton table
 #endif
 
+// packed voxels are float32 densities with the lowest VOXEL_MATERIAL_BITS mantissa bits replaced by the material index
+#define VOXEL_MATERIAL_BITS 8
+#define VOXEL_MATERIAL_MASK 0xFFu
+
+// transport event counters are only compiled in the instrumented build
+#ifdef USING_COUNTERS
+#define COUNT(counters, counter) ((counters)->counter++)
+#else
+#define COUNT(counters, counter)
+#endif
+
+// energy tally modes
+#define TALLY_AUTO -1  // private tallies if they fit in the tally memory budget, else slab tallies
+#define TALLY_ATOMIC 0  // omp atomic add on the shared energy_imparted array
+#define TALLY_PRIVATE 1  // one tally per thread reduced into energy_imparted by end_batch and cleanup
+#define TALLY_SLAB 2  // shared energy_imparted array with one lock per x plane, see setup_tallies
+
+// phase space recording modes
+#define PHASE_SPACE_OFF 0
+#define PHASE_SPACE_SOURCE 1  // photons as generated by the source
+#define PHASE_SPACE_BOUNDARY 2  // photons intersecting the volume, at the point where they enter it
+#define PHASE_SPACE_FIELDS 8  // x, y, z, u, v, w, energy, weight
+
+// energy scoring estimators
+#define SCORING_COLLISION 0  // energy deposited at the interaction sites
+#define SCORING_TRACK_LENGTH 1  // kerma approximation, fluence times path length times energy absorption coefficient
+#define LUT_ENERGY_ABSORPTION 5  // lut row of the mass energy absorption coefficients used by track length scoring
+
+// photons split by an importance map waiting for transport, per history
+#define SPLIT_BANK_SIZE 64
+
 
 
 #ifdef __cplusplus
 extern "C" {
 #endif
 
+	typedef struct
+	{
+		int shape[3];  // number of blocks along each axis
+		int block_shift;  // log2 of the number of voxels along each axis of a block
+		int block_size;
+		int *block_set;  // material set index of each block, -1 flags an empty block
+		FLOAT *block_density;  // largest density in each block
+		int n_sets;
+		FLOAT *majorant_lut;  // [n_sets, n_energies] largest total attenuation of the materials in each set
+		FLOAT step_epsilon;
+	}MacroGrid;
+
+	typedef struct
+	{
+		int n_energies;
+		int n_variates;
+		FLOAT log_emin;  // logarithm of the first table energy
+		FLOAT inv_dlog;  // table energies per unit log energy
+		FLOAT *fraction;  // [n_energies, n_variates] inverse cdf as the fraction (epsilon - epsilon_0) / (1 - epsilon_0)
+	}ComptonTable;
+
+	typedef struct
+	{
+		int64_t histories;  // histories completed
+		int64_t interactions;  // photon interactions
+		int32_t cancel;  // set non zero by the caller to stop a running simulation between histories
+		int32_t padding;
+	}Progress;
+
+	typedef struct
+	{
+		int64_t histories;
+		int64_t missed;  // histories not intersecting the volume
+		int64_t woodcock_real;  // woodcock steps ending in a real interaction
+		int64_t woodcock_virtual;  // woodcock steps ending in a rejected virtual interaction
+		int64_t macro_block_steps;  // steps ending at a macro block boundary and empty blocks skipped
+		int64_t siddon_voxels;  // voxels crossed by siddon tracking
+		int64_t rayleigh;
+		int64_t compton;
+		int64_t photoelectric;
+		int64_t energy_cutoff;  // histories ended by the energy cutoff
+		int64_t roulette_kills;  // photons ended by russian roulette
+		int64_t splits;  // photons added by importance splitting
+	}Counters;
+
+	typedef struct
+	{
+		float *data;  // [PHASE_SPACE_FIELDS, capacity] one contiguous float32 array per field
+		int64_t capacity;
+		int64_t *count;  // photons recorded, may exceed capacity in which case the excess photons are not stored
+		int mode;
+	}PhaseSpace;
+
+	typedef struct
+	{
+		double *energy_imparted;
+		int mode;
+		size_t slab_size;
+		omp_lock_t *slab_locks;
+	}Tally;
+
 	typedef struct
 	{
 		int *shape;
 		FLOAT *spacing;
 		FLOAT *offset;
-		int *material_map;
-		FLOAT *density_map;
+		uint32_t *voxels;  // packed material index and density
 		int *lut_shape;
 		FLOAT *attenuation_lut;
-		FLOAT *energy_imparted;
+		double *energy_imparted;  // energy is tallied in double precision also in float builds
+		double *energy_squared;  // sum of squared batch energies for the uncertainty tally, NULL if not used
+		FLOAT *importance;  // importance of each voxel for splitting and russian roulette, NULL if not used
+		double *batch_start;  // energy imparted when the current batch started
 		FLOAT *max_density;
-		uint64_t *seed;
+		FLOAT *lut_log_grid;
+		MacroGrid *macro_grid;
+		ComptonTable *compton_table;
+		uint64_t seed;
+		uint64_t stream;  // stream number of the next history, each history has its own random stream
+		Progress *progress;  // shared progress counters and cancel flag, NULL if not used
+		int n_threads;  // threads used by runs, zero or less uses the OpenMP default
+		int schedule;  // OpenMP schedule kind of the history loops
+		int chunk_size;  // histories handed to a thread at a time, zero or less uses the schedule default
+		int *affinity;  // cpus threads are pinned to in turn, NULL if threads are not pinned
+		int n_affinity;
 		int *use_siddon_pathing;
+		int tally_mode;
+		int64_t tally_memory_budget;
+		Tally *tallies;  // energy tally of each thread kept between runs, NULL until the first run
+		size_t n_tallies;
+		PhaseSpace phase_space;
+		int scoring;  // energy scoring estimator
+		int forced_interaction;  // non zero forces the first interaction of photons from the source inside the volume
+		FLOAT weight_cutoff;  // photons with weight times importance below the cutoff play russian roulette
+		FLOAT roulette_chance;  // probability of surviving russian roulette
+		FLOAT weight_window;  // photons with weight times importance above the window are split, zero disables splitting
+		FLOAT exponential_transform[4];  // unit direction and strength of the Woodcock exponential transform, zero strength disables it
 	}Simulation;
 
+	typedef struct
+	{
+		int n;  // number of bins
+		FLOAT *probability;  // [n] probability of keeping each bin, else its alias is taken
+		int *alias;  // [n]
+	}AliasTable;
+
 	typedef struct
 	{
 		FLOAT *source_position;
@@ -114,6 +244,7 @@ extern "C" {
 		int *specter_elements;
 		FLOAT *specter_cpd;
 		FLOAT *specter_energy;
+		AliasTable specter_table;  // bin 0 is the first energy, bin i the interval from energy i - 1 to energy i
 	}Source;
 
 	typedef struct
@@ -130,23 +261,70 @@ extern "C" {
 		int *bowtie_elements;
 		FLOAT *bowtie_weight;
 		FLOAT *bowtie_angle;
+		AliasTable specter_table;
+		AliasTable bowtie_table;  // bin i is the fan angle interval from bowtie angle i to i + 1
+		FLOAT bowtie_mean_weight;  // weight of photons with importance sampled fan angles
 	}SourceBowtie;
 
-	typedef bool(*trackingFuncPtr)(size_t *, FLOAT *, int *, FLOAT *, FLOAT *, int *, FLOAT *, int *, FLOAT *, FLOAT *, uint64_t *);
+	typedef bool(*trackingFuncPtr)(size_t *, FLOAT *, int *, FLOAT *, FLOAT *, uint32_t *, int *, FLOAT *, FLOAT *, MacroGrid *, Tally *, FLOAT *, uint64_t *, Counters *);
+
+	typedef struct
+	{
+		SourceBowtie *source;
+		FLOAT *source_position;  // [n_exposures * 3]
+		FLOAT *source_direction;  // [n_exposures * 3]
+		FLOAT *scan_axis;  // [n_exposures * 3]
+		FLOAT *weight;  // [n_exposures]
+		int64_t n_particles;  // histories per exposure
+	}BowtieBatch;
+
+	typedef struct
+	{
+		float *data;  // [PHASE_SPACE_FIELDS, capacity]
+		int64_t capacity;
+		int64_t start;  // first photon replayed
+	}PhaseSpaceReplay;
+
+	// transports history number int64_t of a source, the run loop gives each history its random stream
+	typedef void(*historyFuncPtr)(void *, int64_t, size_t *, Simulation *, Tally *, trackingFuncPtr, uint64_t *, int64_t *, Counters *);
 
 	EXTERN int number_of_cuda_devices();
 
 	EXTERN void cuda_device_name(int device_number, char* name);
 
-	EXTERN void* setup_simulation(int *shape, FLOAT *spacing, FLOAT *offset, int *material_map, FLOAT *density_map, int *lut_shape, FLOAT *lut, FLOAT *energy_imparted, int *use_siddon);
+	EXTERN void* setup_simulation(int *shape, FLOAT *spacing, FLOAT *offset, uint32_t *voxels, int *lut_shape, FLOAT *lut, double *energy_imparted, double *energy_squared, FLOAT *importance, int *use_siddon, int *tally_mode, int64_t *tally_memory_budget, uint64_t *seed);
 
 	EXTERN void* setup_source(FLOAT *source_position, FLOAT *source_direction, FLOAT *scan_axis, FLOAT *sdd, FLOAT *fov, FLOAT *collimation, FLOAT *weight, FLOAT *specter_cpd, FLOAT *specter_energy, int *specter_elements);
 
 	EXTERN void* setup_source_bowtie(FLOAT *source_position, FLOAT *source_direction, FLOAT *scan_axis, FLOAT *scan_axis_fan_angle, FLOAT *rot_axis_fan_angle, FLOAT *weight, FLOAT *specter_cpd, FLOAT *specter_energy, int *specter_elements, FLOAT* bowtie_weight, FLOAT* bowtie_angle, int *bowtie_elements);
 
-	EXTERN void run_simulation(void *source, int64_t n_particles, void *simulation);
+	EXTERN void run_simulation(void *source, int64_t n_particles, void *simulation, Counters *counters);
+
+	EXTERN void run_simulation_bowtie(void *dev_source, int64_t n_particles, void *dev_simulation, Counters *counters);
+
+	EXTERN void run_simulation_bowtie_batch(void *dev_source, FLOAT *source_position, FLOAT *source_direction, FLOAT *scan_axis, FLOAT *weight, int64_t n_exposures, int64_t n_particles, void *dev_simulation, Counters *counters);
+
+	EXTERN void run_simulation_phase_space(float *phase_space, int64_t capacity, int64_t start, int64_t n_particles, void *dev_simulation, Counters *counters);
+
+	EXTERN void end_batch(void *simulation);
+
+	EXTERN void set_random_stream(void *simulation, uint64_t stream);
+
+	EXTERN void set_progress(void *simulation, Progress *progress);
+
+	EXTERN void set_phase_space(void *simulation, float *data, int64_t capacity, int64_t *count, int mode);
+
+	EXTERN void set_scoring(void *simulation, int scoring);
+
+	EXTERN void set_forced_interaction(void *simulation, int forced);
+
+	EXTERN void set_russian_roulette(void *simulation, FLOAT weight_cutoff, FLOAT roulette_chance, FLOAT weight_window);
+
+	EXTERN void set_exponential_transform(void *simulation, FLOAT strength, FLOAT *direction);
+
+	EXTERN void set_threading(void *simulation, int n_threads, int schedule, int chunk_size, int *affinity, int n_affinity);
 
-	EXTERN void run_simulation_bowtie(void *dev_source, int64_t n_particles, void *dev_simulation);
+	EXTERN void sample_compton(void *simulation, FLOAT energy, int64_t n, int use_table, uint64_t stream, FLOAT *scatter_energy, FLOAT *theta);
 
 	EXTERN void cleanup_simulation(void *simulation);
 
@@ -1,6 +1,8 @@
 #
 from opendxmc.runner.ct_study_runner import ct_runner
+from opendxmc.runner.ct_study_runner import SimulationCancelled
 from opendxmc.runner.ct_study_runner import obtain_ctdiair_conversion_factor
 from opendxmc.runner.ct_study_runner import obtain_ctdiw_conversion_factor
 from opendxmc.runner.ct_study_runner import ct_runner_validate_simulation
-from opendxmc.runner.ct_study_runner import generate_attinuation_lut
\ No newline at end of file
+from opendxmc.runner.ct_study_runner import generate_attinuation_lut
+from opendxmc.runner.ct_comparison import ct_comparison_runner
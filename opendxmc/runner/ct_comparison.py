@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Correlated sampling of protocol comparison runs.
+
+A comparison set is a reference simulation and protocol variants of it on
+the same patient, such as copies made with copy_simulation with another kV,
+filtration or pitch. All simulations of a set are run with the same random
+seed, histories per exposure and number of batches, so exposure k of batch b
+uses the same random streams in every simulation, history for history. The
+dose differences between the variants and the reference are then much less
+noisy than between independent runs. Their uncertainty is estimated from
+the paired batches of the variant and the reference, the simulations run
+their batches in turns so only the current batch of the reference is kept.
+"""
+
+import threading
+import numpy as np
+from opendxmc.engine import random_seed
+from opendxmc.runner.ct_study_runner import ct_runner, recarray_to_dict
+from opendxmc.runner.ct_study_runner import SimulationCancelled
+import logging
+logger = logging.getLogger('OpenDXMC')
+
+# properties every simulation of a comparison set takes from the reference,
+# the random streams of the histories are only shared if these are equal
+SHARED_PROPERTIES = ['random_seed', 'histories', 'uncertainty_batches',
+                     'scaling']
+
+# properties that change the number of batches or the source photons of a
+# run, they are switched off in a comparison set
+UNSHARED_PROPERTIES = {'target_uncertainty': 0., 'time_budget': 0.,
+                       'phase_space_mode': 'none', 'start_at_exposure_no': 0}
+
+
+def prepare_comparison_set(reference, variants):
+    """Sets the shared properties of the variant simulations to those of
+    the reference and switches off target uncertainties, time budgets,
+    phase space files and resumed runs in all simulations. A random seed is
+    drawn for the set if the reference has none.
+    """
+    if reference['random_seed'] == 0:
+        reference['random_seed'] = random_seed()
+    if reference['uncertainty_batches'] < 2:
+        logger.info('Comparison set {0} needs at least two batches for the '
+                    'difference uncertainty, using two'.format(reference['name']))
+        reference['uncertainty_batches'] = 2
+    for simulation in [reference] + list(variants):
+        for name, value in UNSHARED_PROPERTIES.items():
+            simulation[name] = value
+    for variant in variants:
+        for name in SHARED_PROPERTIES:
+            if np.any(variant[name] != reference[name]):
+                logger.info('Setting {0} of {1} to {2} as in the reference '
+                            '{3}'.format(name, variant['name'], reference[name],
+                                         reference['name']))
+                variant[name] = reference[name]
+
+
+def conversion_factor(simulation):
+    """CTDI dose conversion factor of a simulation, 0 if it is not
+    calibrated."""
+    if simulation['conversion_factor_ctdiair'] > 0:
+        return simulation['conversion_factor_ctdiair']
+    return simulation['conversion_factor_ctdiw']
+
+
+def paired_difference(a, b, x, y, xx, yy, xy, n_batches):
+    """Returns the difference a * x - b * y of two sums of n_batches paired
+    batches, its standard error and the standard error of the difference
+    of independent runs. x and y are the sums, xx and yy the sums of the
+    squared batches and xy the sum of the batch products.
+    """
+    n = float(n_batches)
+    difference = a * x - b * y
+    variance = (a**2 * xx + b**2 * yy - 2 * a * b * xy - difference**2 / n) * n / (n - 1.)
+    independent = (a**2 * (xx - x**2 / n) + b**2 * (yy - y**2 / n)) * n / (n - 1.)
+    return (difference, np.sqrt(np.clip(variance, 0, None)),
+            np.sqrt(np.clip(independent, 0, None)))
+
+
+class BatchTurns(object):
+    """Lets the simulations of a comparison set, each run by ct_runner in a
+    thread of its own, simulate their batches in turns. Only the simulation
+    holding the turn runs, the turn passes from a simulation to the next one
+    that has not finished. If a simulation fails the waiting simulations
+    raise SimulationCancelled and error holds the exception.
+    """
+    def __init__(self, n):
+        self.condition = threading.Condition()
+        self.turn = 0
+        self.finished = [False] * n
+        self.error = None
+
+    def wait(self, index):
+        with self.condition:
+            while (self.turn != index) and (self.error is None):
+                self.condition.wait()
+            if self.error is not None:
+                raise SimulationCancelled('Comparison set is stopped')
+
+    def next(self, index):
+        with self.condition:
+            n = len(self.finished)
+            for step in range(1, n + 1):
+                if not self.finished[(index + step) % n]:
+                    self.turn = (index + step) % n
+                    break
+            self.condition.notify_all()
+
+    def finish(self, index, error=None):
+        with self.condition:
+            self.finished[index] = True
+            if (error is not None) and (self.error is None):
+                self.error = error
+            if self.turn == index:
+                self.next(index)
+            self.condition.notify_all()
+
+
+def ct_comparison_runner(materials, reference, variants, organ=None,
+                         organ_map=None, progress=None, calibration_cache=None,
+                         **arrays):
+    """Runs a comparison set of the reference simulation and the variant
+    simulations with correlated sampling, see prepare_comparison_set.
+    arrays are the patient arrays shared by all simulations as for
+    ct_runner, with organ and organ_map the organ dose differences are also
+    reported.
+
+    Returns a list of (simulation, arrays) tuples as returned by ct_runner,
+    the reference first. The arrays also hold the dose and, for the
+    variants, the difference to the reference dose, 'dose_difference', and
+    its standard error, 'dose_difference_uncertainty'. The arrays of the
+    variants also have the 'variance_reduction' of the difference, the
+    summed voxel variance of independent runs over that of the correlated
+    runs, and with organ arrays an 'organ_dose_difference' dictionary of
+    organ names to the organ dose difference and its standard error.
+    Doses are energy imparted per mass if a simulation of the set is not
+    calibrated to a CTDI.
+
+    Each simulation is run by ct_runner in a thread of its own, taking turns
+    batch by batch with the other simulations, see BatchTurns.
+    """
+    prepare_comparison_set(reference, variants)
+    simulations = [reference] + list(variants)
+    n_batches = reference['uncertainty_batches']
+    scaling = reference['scaling']
+    if (organ is not None) and (organ_map is not None):
+        organ_scaled = np.asarray(organ[::scaling[0], ::scaling[1], ::scaling[2]]).ravel()
+        n_organs = int(organ_scaled.max()) + 1
+    else:
+        organ_scaled = None
+
+    # for every simulation the sum, squared sum and product with the
+    # reference batch of the energy imparted by the batches in each voxel and
+    # organ, the simulations run each batch in turns so batch b of the
+    # variants follows batch b of the reference
+    turns = BatchTurns(len(simulations))
+    reference_batch = {}
+    tallies = [{'sum': 0., 'squared': 0., 'product': 0., 'organs': []}
+               for _ in simulations]
+    runs = [None] * len(simulations)
+
+    def run(index):
+        tally = tallies[index]
+
+        def batch_callback(batch, energy):
+            if index == 0:
+                reference_batch['batch'] = batch
+                reference_batch['energy'] = energy
+            elif reference_batch.get('batch') != batch:
+                raise SimulationCancelled('Reference {0} of comparison set is '
+                                          'cancelled'.format(reference['name']))
+            tally['sum'] = tally['sum'] + energy
+            tally['squared'] = tally['squared'] + energy**2
+            tally['product'] = tally['product'] + energy * reference_batch['energy']
+            if organ_scaled is not None:
+                tally['organs'].append(np.bincount(organ_scaled, weights=energy.ravel(),
+                                                   minlength=n_organs))
+            turns.next(index)
+            if batch + 1 < n_batches:
+                turns.wait(index)
+
+        error = None
+        try:
+            turns.wait(index)
+            runs[index] = ct_runner(materials, simulations[index], organ=organ,
+                                    organ_map=organ_map, progress=progress,
+                                    calibration_cache=calibration_cache,
+                                    batch_callback=batch_callback, **arrays)
+        except Exception as e:
+            error = e
+        turns.finish(index, error)
+
+    threads = [threading.Thread(target=run, args=(index,))
+               for index in range(len(simulations))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if turns.error is not None:
+        raise turns.error
+    reference_batch.clear()
+
+    # doses are the normalised energy imparted times the conversion factor
+    # over the mass, the normalised energy is the batch sum times a factor
+    density = runs[0][1]['density']
+    mass = density * np.prod(reference['spacing'] * scaling)
+    inverse_mass = np.where(mass > 0, 1. / np.where(mass > 0, mass, 1.), 0.)
+    factors = [conversion_factor(simulation) for simulation, _ in runs]
+    if not all(f > 0 for f in factors):
+        logger.warning('Comparison set {0} is not calibrated to a CTDI, doses '
+                       'are energy imparted per mass'.format(reference['name']))
+        factors = [1.] * len(runs)
+    scales = []
+    for (simulation, run_arrays), tally, factor in zip(runs, tallies, factors):
+        run_arrays['dose'] = run_arrays['energy_imparted'] * factor * inverse_mass
+        total = np.sum(tally['sum'])
+        scales.append(factor * run_arrays['energy_imparted'].sum() / total if total > 0 else 0.)
+
+    if organ_scaled is not None:
+        organ_names = recarray_to_dict(organ_map, value_is_string=True)
+        organ_mass = np.bincount(organ_scaled, weights=mass.ravel(),
+                                 minlength=n_organs)
+        reference_organs = np.array(tallies[0]['organs'])
+
+    reference_tally = tallies[0]
+    for (simulation, run_arrays), tally, scale in zip(runs[1:], tallies[1:], scales[1:]):
+        difference, sigma, independent = paired_difference(scale * inverse_mass,
+                                                           scales[0] * inverse_mass,
+                                                           tally['sum'], reference_tally['sum'],
+                                                           tally['squared'], reference_tally['squared'],
+                                                           tally['product'], n_batches)
+        run_arrays['dose_difference'] = difference
+        run_arrays['dose_difference_uncertainty'] = sigma
+        if np.sum(sigma**2) > 0:
+            run_arrays['variance_reduction'] = float(np.sum(independent**2) / np.sum(sigma**2))
+        else:
+            run_arrays['variance_reduction'] = 1.
+        logger.info('Dose difference of {0} to {1} has {2:.1f} times lower '
+                    'variance than with independent '
+                    'runs'.format(simulation['name'], reference['name'],
+                                  run_arrays['variance_reduction']))
+        if organ_scaled is None:
+            continue
+
+        organs = np.array(tally['organs'])
+        organ_difference = {}
+        for key, name in organ_names.items():
+            if (key >= n_organs) or (organ_mass[key] <= 0):
+                continue
+            x, y = organs[:, key], reference_organs[:, key]
+            d, s, _ = paired_difference(scale / organ_mass[key],
+                                        scales[0] / organ_mass[key],
+                                        x.sum(), y.sum(), np.sum(x**2),
+                                        np.sum(y**2), np.sum(x * y), n_batches)
+            organ_difference[name] = (float(d), float(s))
+            logger.info('{0} {1}: dose difference {2:.4g} +/- '
+                        '{3:.2g}'.format(simulation['name'], name, d, s))
+        run_arrays['organ_dose_difference'] = organ_difference
+    return runs
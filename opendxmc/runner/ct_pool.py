@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Process pool for running blocks of exposures on several engines.
+
+Each worker process has its own Engine set up on geometry shared through
+multiprocessing shared memory, and tallies energy in its own slot of a shared
+energy array which is summed by EnginePool.collect.
+"""
+
+import ctypes as ct
+import multiprocessing
+import queue
+import numpy as np
+from opendxmc.engine import Engine, Progress, COUNTERS_DTYPE
+import logging
+logger = logging.getLogger('OpenDXMC')
+
+# task ending a batch, each worker reduces the private tallies of its engine
+# into its slot
+END_BATCH = 'end_batch'
+
+
+def _pool_worker(index, shared, geometry, precision, threading, instrumented,
+                 scoring, forced_interaction, biasing, seed, source_args, progress_buffer, tasks, results, barrier):
+    voxels_raw, lut_raw, importance_raw, slots_raw = shared
+    shape, spacing, offset, lut_shape, use_siddon = geometry
+    n_voxels = int(np.prod(shape))
+    voxels = np.frombuffer(voxels_raw, dtype=np.uint32).reshape(shape)
+    lut = np.frombuffer(lut_raw, dtype=precision).reshape(lut_shape)
+    if importance_raw is not None:
+        importance = np.frombuffer(importance_raw, dtype=precision).reshape(shape)
+    else:
+        importance = None
+    energy_imparted = np.frombuffer(slots_raw, dtype='float64',
+                                    count=n_voxels,
+                                    offset=index * n_voxels * 8).reshape(shape)
+    try:
+        threads, schedule, chunk_size, affinity = threading
+        engine = Engine(precision=precision, threads=threads,
+                        instrumented=instrumented, schedule=schedule,
+                        chunk_size=chunk_size, affinity=affinity,
+                        scoring=scoring,
+                        forced_interaction=forced_interaction, **biasing)
+        simulation = engine.setup_simulation(shape, spacing, offset, voxels,
+                                             lut_shape, lut, energy_imparted,
+                                             use_siddon, importance=importance,
+                                             seed=seed)
+        source = engine.setup_source_bowtie(*source_args)
+        if progress_buffer is not None:
+            progress = Progress(progress_buffer)
+            engine.set_progress(simulation, progress)
+    except Exception as e:
+        results.put((0, 'Engine worker {0} failed to start: {1}'.format(index, e), None))
+        return
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        if task == END_BATCH:
+            # the barrier keeps a worker from taking the end of batch task
+            # of another worker
+            engine.end_batch(simulation)
+            results.put((0, None, None))
+            barrier.wait()
+            continue
+        stream, positions, directions, scan_axes, weights, histories = task
+        try:
+            engine.set_random_stream(simulation, stream)
+            counters = engine.run_bowtie_batch(source, positions, directions,
+                                               scan_axes, weights, histories,
+                                               simulation)
+        except Exception as e:
+            results.put((0, 'Engine worker {0} failed: {1}'.format(index, e), None))
+            break
+        results.put((weights.shape[0], None, counters))
+    engine.cleanup(simulation=simulation, source=source)
+
+
+class EnginePool(object):
+    def __init__(self, processes, shape, spacing, offset, voxels, lut,
+                 use_siddon, source_args, seed, precision='float64',
+                 threads=None, progress=None, instrumented=False,
+                 schedule='dynamic', chunk_size=64, affinity=None,
+                 scoring='collision', forced_interaction=False,
+                 importance=None, weight_cutoff=0.01, roulette_chance=0.2,
+                 weight_window=0., exponential_transform=0., transform_direction=(0., 0., 1.)):
+        """Starts processes worker processes with an Engine each.
+
+        voxels, lut and the optional importance map are copied once into
+        shared memory which all workers read, the remaining arguments are as
+        for Engine.setup_simulation and Engine.setup_source_bowtie. threads
+        is the number of OpenMP threads in each worker. All workers count
+        histories in progress and stop when it is cancelled. scoring,
+        forced_interaction, weight_cutoff, roulette_chance, weight_window,
+        exponential_transform and transform_direction select the energy
+        estimator, interaction forcing, russian roulette, splitting and
+        exponential transform of the engines, see Engine.
+        With instrumented engines the transport event counts of all blocks
+        are summed in the counters attribute.
+
+        Each worker tallies energy in its own shared array, the pool needs
+        processes + 1 times the energy_imparted memory of a single engine.
+        """
+        self.processes = int(processes)
+        self.shape = tuple(int(i) for i in shape)
+        n_voxels = int(np.prod(self.shape))
+        dtype = np.dtype(precision)
+        if dtype == np.dtype('float32'):
+            c_type = ct.c_float
+        else:
+            c_type = ct.c_double
+
+        voxels_raw = multiprocessing.RawArray(ct.c_uint32, n_voxels)
+        np.frombuffer(voxels_raw, dtype=np.uint32)[:] = voxels.ravel()
+        lut_raw = multiprocessing.RawArray(c_type, lut.size)
+        np.frombuffer(lut_raw, dtype=dtype)[:] = lut.ravel()
+        if importance is not None:
+            importance_raw = multiprocessing.RawArray(c_type, n_voxels)
+            np.frombuffer(importance_raw, dtype=dtype)[:] = importance.ravel()
+        else:
+            importance_raw = None
+        self.slots = multiprocessing.RawArray(ct.c_double,
+                                              self.processes * n_voxels)
+
+        geometry = (np.array(self.shape, dtype='int32'),
+                    np.asarray(spacing, dtype=dtype),
+                    np.asarray(offset, dtype=dtype),
+                    np.array(lut.shape, dtype='int32'),
+                    np.asarray(use_siddon, dtype='int32'))
+
+        self.tasks = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.barrier = multiprocessing.Barrier(self.processes)
+        self.pending = 0
+        self.workers = []
+        if instrumented:
+            self.counters = np.zeros(1, dtype=COUNTERS_DTYPE)
+        else:
+            self.counters = None
+        if progress is not None:
+            progress_buffer = progress.buffer
+        else:
+            progress_buffer = None
+        if affinity:
+            affinity = [list(a) for a in np.array_split(np.asarray(affinity, dtype='int32'),
+                                                         self.processes)]
+        else:
+            affinity = [None] * self.processes
+        for i in range(self.processes):
+            threading = (threads, schedule, chunk_size, affinity[i] or None)
+            worker = multiprocessing.Process(target=_pool_worker,
+                                             args=(i, (voxels_raw, lut_raw, importance_raw, self.slots),
+                                                   geometry, dtype.name,
+                                                   threading, instrumented,
+                                                   scoring,
+                                                   forced_interaction,
+                                                   {'weight_cutoff': weight_cutoff,
+                                                    'roulette_chance': roulette_chance,
+                                                    'weight_window': weight_window,
+                                                    'exponential_transform': exponential_transform,
+                                                    'transform_direction': tuple(transform_direction)},
+                                                   seed, source_args,
+                                                   progress_buffer, self.tasks,
+                                                   self.results, self.barrier))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        logger.info('Started {0} engine worker processes'.format(self.processes))
+
+    def submit(self, stream, positions, directions, scan_axes, weights,
+               histories):
+        """Queues a block of exposures, arguments are as for
+        Engine.set_random_stream and Engine.run_bowtie_batch.
+        """
+        self.tasks.put((stream, positions, directions, scan_axes, weights,
+                        histories))
+        self.pending += 1
+
+    def wait(self, callback=None):
+        """Waits until all submitted blocks are simulated, callback is called
+        with the number of exposures in each finished block. Raises
+        RuntimeError and stops the pool if a worker fails or dies.
+        """
+        while self.pending > 0:
+            try:
+                n_exposures, error, counters = self.results.get(timeout=1.)
+            except queue.Empty:
+                if all(w.is_alive() for w in self.workers):
+                    continue
+                error = 'Engine worker process stopped unexpectedly'
+            if error is not None:
+                self.terminate()
+                raise RuntimeError(error)
+            self.pending -= 1
+            if counters is not None:
+                for name in COUNTERS_DTYPE.names:
+                    self.counters[name] += counters[name]
+            if callback is not None:
+                callback(n_exposures)
+
+    def collect(self):
+        """Returns the energy imparted by all workers since the last call,
+        all submitted blocks must be finished. Ends the batch of each worker
+        engine so their private tallies are added to the shared arrays.
+        """
+        for worker in self.workers:
+            self.tasks.put(END_BATCH)
+            self.pending += 1
+        self.wait()
+        slots = np.frombuffer(self.slots, dtype='float64')
+        slots = slots.reshape((self.processes,) + self.shape)
+        energy_imparted = slots.sum(axis=0)
+        slots[:] = 0
+        return energy_imparted
+
+    def close(self):
+        for worker in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def terminate(self):
+        for worker in self.workers:
+            worker.terminate()
+        self.workers = []
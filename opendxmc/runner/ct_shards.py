@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Splitting a simulation in job shards that can be run on separate machines.
+
+A shard is a database file holding the simulation, the materials, the
+prepared geometry and a slice of the exposures given by the
+start_at_exposure_no and stop_at_exposure_no properties. A headless worker
+runs the shard and writes the partial result back into the shard file, and
+the partial results are merged into the original database. All shards use
+the same random seed, random streams are numbered by exposure so the merged
+result equals a simulation run in one piece.
+
+Usage:
+    python -m opendxmc.runner.ct_shards export DATABASE NAME SHARDS DIRECTORY
+    python -m opendxmc.runner.ct_shards run SHARD [--processes P] [--threads T]
+    python -m opendxmc.runner.ct_shards merge DATABASE SHARD [SHARD ...]
+"""
+
+import os
+import argparse
+import numpy as np
+from opendxmc.database.h5database import Database, ARRAY_TEMPLATES
+from opendxmc.engine import random_seed
+from opendxmc.runner.ct_study_runner import ct_runner
+from opendxmc.runner.ct_study_runner import ct_runner_validate_simulation
+from opendxmc.runner.ct_study_runner import simulation_dtype
+from opendxmc.runner.ct_sources import ct_exposure_count
+import logging
+logger = logging.getLogger('OpenDXMC')
+
+
+def _simulation_arrays(database, name, volatile=False):
+    arrays = {}
+    for key, value in ARRAY_TEMPLATES.items():
+        if value[1] != volatile:
+            continue
+        try:
+            arrays[key] = database.get_simulation_array(name, key)
+        except ValueError:
+            pass
+    return arrays
+
+
+def export_shards(database, name, n_shards, directory):
+    """Writes the simulation name in database as n_shards shard files to
+    directory, each shard simulating an equal slice of the exposures.
+    Returns a list of the shard file paths.
+    """
+    properties = database.get_simulation_metadata(name)
+    arrays = _simulation_arrays(database, name)
+    materials = database.get_materials()
+
+    material, material_map, density = ct_runner_validate_simulation(materials, properties,
+                                                                    ctarray=arrays.get('ctarray', None),
+                                                                    organ=arrays.get('organ', None),
+                                                                    organ_material_map=arrays.get('organ_material_map', None),
+                                                                    dtype=simulation_dtype(properties))
+    arrays['material'] = material
+    arrays['density'] = density.astype(np.double)
+    arrays['material_map'] = material_map
+
+    # all shards must use the same random seed
+    if properties['random_seed'] == 0:
+        properties['random_seed'] = random_seed()
+
+    n_exposures = ct_exposure_count(properties)
+    n_shards = max(min(int(n_shards), n_exposures), 1)
+    limits = np.linspace(0, n_exposures, n_shards + 1).astype(np.int)
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    paths = []
+    for i in range(n_shards):
+        path = os.path.join(directory, '{0}_shard{1}.h5'.format(name, i))
+        if os.path.exists(path):
+            os.remove(path)
+        shard_db = Database(path)
+        for m in materials:
+            shard_db.add_material(m, overwrite=True)
+        shard_properties = dict(properties)
+        shard_properties['start_at_exposure_no'] = limits[i]
+        shard_properties['stop_at_exposure_no'] = limits[i + 1]
+        shard_properties['MC_finished'] = False
+        shard_properties['MC_running'] = False
+        shard_properties['MC_ready'] = True
+        shard_db.add_simulation(shard_properties, arrays)
+        shard_db.close()
+        paths.append(path)
+        logger.info('Exported exposures {0} to {1} of {2} to shard '
+                    '{3}'.format(limits[i], limits[i + 1], name, path))
+    return paths
+
+
+def run_shard(path, processes=None, threads=None):
+    """Runs the simulation in a shard file and writes the partial result,
+    energy imparted and uncertainty, back into the shard. The shard with the
+    first exposure also calculates the dose conversion factors.
+    """
+    database = Database(path)
+    name = database.simulation_list()[0]
+    properties = database.get_simulation_metadata(name)
+    arrays = _simulation_arrays(database, name)
+    geometry = _simulation_arrays(database, name, volatile=True)
+    materials = database.get_materials()
+
+    start = properties['start_at_exposure_no']
+    stop = properties['stop_at_exposure_no']
+    if processes is not None:
+        properties['processes'] = processes
+    if threads is not None:
+        properties['threads_per_process'] = threads
+    # shards must run the same fixed number of batches to be merged
+    properties['target_uncertainty'] = 0.
+    properties['time_budget'] = 0.
+
+    logger.info('Running exposures {0} to {1} of {2} from shard '
+                '{3}'.format(start, stop, name, path))
+    properties, result = ct_runner(materials, properties,
+                                   energy_imparted_to_dose_conversion=(start == 0),
+                                   material=geometry['material'],
+                                   density=geometry['density'],
+                                   material_map=geometry['material_map'],
+                                   **arrays)
+    properties['start_at_exposure_no'] = start
+    properties['stop_at_exposure_no'] = stop
+    database.set_simulation_metadata(properties)
+    for key in ['energy_imparted', 'uncertainty', 'engine_counters']:
+        if result[key] is not None:
+            database.set_simulation_array(name, result[key], key)
+    database.close()
+    return path
+
+
+def merge_shards(database, paths):
+    """Merges the partial results of the shard files in paths into the
+    simulation in database. The shards must cover all exposures once.
+    """
+    shards = []
+    for path in paths:
+        shard_db = Database(path)
+        name = shard_db.simulation_list()[0]
+        properties = shard_db.get_simulation_metadata(name)
+        if not properties['MC_finished']:
+            raise ValueError('Shard {} is not simulated'.format(path))
+        shards.append((path, shard_db, name, properties))
+    shards.sort(key=lambda x: x[3]['start_at_exposure_no'])
+
+    name = shards[0][2]
+    n_exposures = ct_exposure_count(shards[0][3])
+    stop = 0
+    for path, shard_db, shard_name, properties in shards:
+        if shard_name != name:
+            raise ValueError('Shard {0} is from simulation {1}, not '
+                             '{2}'.format(path, shard_name, name))
+        if properties['start_at_exposure_no'] != stop:
+            raise ValueError('Shards do not cover exposure {}'.format(stop))
+        stop = properties['stop_at_exposure_no']
+    if stop != n_exposures:
+        raise ValueError('Shards do not cover exposures {0} to '
+                         '{1}'.format(stop, n_exposures))
+
+    # shards are independent, the variances of the energy imparted add
+    energy_imparted = None
+    variance = None
+    counters = {}
+    for path, shard_db, shard_name, properties in shards:
+        try:
+            shard_counters = shard_db.get_simulation_array(shard_name, 'engine_counters')
+        except ValueError:
+            counters = None
+        else:
+            if counters is not None:
+                for counter, count in shard_counters:
+                    counter = str(counter, encoding='utf-8')
+                    counters[counter] = counters.get(counter, 0) + count
+
+        shard_energy = shard_db.get_simulation_array(shard_name, 'energy_imparted')
+        if energy_imparted is None:
+            energy_imparted = np.zeros_like(shard_energy)
+            variance = np.zeros_like(shard_energy)
+        energy_imparted += shard_energy
+        try:
+            shard_uncertainty = shard_db.get_simulation_array(shard_name, 'uncertainty')
+        except ValueError:
+            variance = None
+        else:
+            if variance is not None:
+                variance += (shard_uncertainty * shard_energy)**2
+
+    shard_properties = shards[0][3]
+    properties = database.get_simulation_metadata(name)
+    for key in ['conversion_factor_ctdiair', 'conversion_factor_ctdiw',
+                'batches_simulated', 'random_seed_used']:
+        properties[key] = shard_properties[key]
+    arrays = _simulation_arrays(shards[0][1], name, volatile=True)
+    arrays['energy_imparted'] = energy_imparted
+    if counters:
+        arrays['engine_counters'] = counters
+    else:
+        arrays.pop('engine_counters', None)
+    if variance is not None:
+        uncertainty = np.ones_like(energy_imparted)
+        ind = energy_imparted > 0
+        uncertainty[ind] = np.sqrt(variance[ind]) / energy_imparted[ind]
+        arrays['uncertainty'] = uncertainty
+        properties['uncertainty_reached'] = np.nan_to_num(np.sum(uncertainty * energy_imparted) / energy_imparted.sum())
+    else:
+        arrays.pop('uncertainty', None)
+
+    c_factor = properties['conversion_factor_ctdiair']
+    if c_factor == 0:
+        c_factor = properties['conversion_factor_ctdiw']
+    if c_factor > 0:
+        arrays['dose'] = (energy_imparted * c_factor) / (arrays['density'] * np.prod(properties['spacing'] * properties['scaling']))
+    for path, shard_db, shard_name, shard_properties in shards:
+        shard_db.close()
+
+    properties['start_at_exposure_no'] = 0
+    properties['stop_at_exposure_no'] = 0
+    properties['MC_finished'] = True
+    properties['MC_running'] = False
+    properties['MC_ready'] = False
+    database.set_simulation_metadata(properties)
+    for key, value in arrays.items():
+        database.set_simulation_array(name, value, key)
+    database.close()
+    logger.info('Merged {0} shards into simulation {1}'.format(len(shards), name))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Split a simulation in job '
+                                     'shards, run shards and merge the '
+                                     'results.')
+    commands = parser.add_subparsers(dest='command')
+    export = commands.add_parser('export', help='export a simulation to shard files')
+    export.add_argument('database')
+    export.add_argument('name')
+    export.add_argument('shards', type=int)
+    export.add_argument('directory')
+    run = commands.add_parser('run', help='run a shard file')
+    run.add_argument('shard')
+    run.add_argument('--processes', type=int, default=None)
+    run.add_argument('--threads', type=int, default=None)
+    merge = commands.add_parser('merge', help='merge shard files into a database')
+    merge.add_argument('database')
+    merge.add_argument('shards', nargs='+')
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'export':
+        export_shards(Database(args.database), args.name, args.shards,
+                      args.directory)
+    elif args.command == 'run':
+        run_shard(args.shard, processes=args.processes, threads=args.threads)
+    elif args.command == 'merge':
+        merge_shards(Database(args.database), args.shards)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
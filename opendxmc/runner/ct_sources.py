@@ -34,15 +34,70 @@ def bowtie_path_lenght(angles, radius, distance):
     c[angle_max_ind] = radius
     return c / np.cos(angles)
 
-def ct_source_space(simulation, exposure_modulation=None):
+def ct_source_arrays(scan_fov, sdd, total_collimation, energy=70000.,
+                     energy_specter=None, bowtie_radius=1, bowtie_distance=0,
+                     dtype='float64'):
+    """Returns the source arrays shared by all exposures of a CT phase
+    space, (scan_fan_angle, rot_fan_angle, specter_cpd, specter_energy,
+    n_specter, bowtie_weights, bowtie_angle, n_bowtie), in the order of the
+    exposure tuples from ct_spiral and ct_seq. The engine builds its
+    sampling tables from these arrays when a source is set up.
+    """
+    if energy_specter is None:
+        energy_specter = [np.array([energy], dtype=np.double),
+                          np.array([1.0], dtype=np.double)]
+    energy_specter = (energy_specter[0],
+                      energy_specter[1] / energy_specter[1].sum())
+
+    specter_cpd = np.cumsum(energy_specter[1]).astype(dtype)
+    specter_cpd /= specter_cpd.max()
+
+    specter_energy = energy_specter[0].astype(dtype)
+
+    fov_arr=np.array([scan_fov], dtype=dtype)
+    collimation_arr=np.array([total_collimation], dtype=dtype)
+    rot_fan_angle = np.array([np.arctan(fov_arr[0]/sdd) * 2],dtype=dtype)
+    scan_fan_angle = np.array([np.arctan(collimation_arr[0] *.5 / sdd) * 2], dtype=dtype)
+
+    bowtie_angle = np.linspace(-rot_fan_angle[0]/2, rot_fan_angle[0]/2, 101, dtype=dtype)
+    bowtie_lenghts= bowtie_path_lenght(bowtie_angle, bowtie_radius, bowtie_distance)
+    bowtie_weights = np.empty_like(bowtie_angle, dtype=dtype)
+    bowtie_att = attinuation(specter_energy/1000, name='aluminum', density=True).astype(dtype)
+    for i in range(bowtie_lenghts.shape[0]):
+        bowtie_weights[i] = np.sum(energy_specter[1]*np.exp(-bowtie_att*bowtie_lenghts[i]))
+
+    n_bowtie = np.array(bowtie_weights.shape, dtype='int32')
+    n_specter = np.array(specter_energy.shape, dtype='int32')
+    return (scan_fan_angle, rot_fan_angle, specter_cpd, specter_energy,
+            n_specter, bowtie_weights, bowtie_angle, n_bowtie)
+
+
+def ct_simulation_source_arrays(simulation, dtype='float64'):
+    """Returns the source arrays from ct_source_arrays for a simulation."""
+    s = specter(simulation.get('kV'), angle_deg=simulation['anode_angle'], filtration_materials='Al',
+                filtration_mm=simulation.get('al_filtration'))
+    return ct_source_arrays(simulation.get('scan_fov'), simulation.get('sdd'),
+                            simulation.get('detector_rows') * simulation.get('detector_width'),
+                            energy_specter=s,
+                            bowtie_radius=simulation.get('bowtie_radius'),
+                            bowtie_distance=simulation.get('bowtie_distance'),
+                            dtype=dtype)
+
+
+def ct_source_space(simulation, exposure_modulation=None, dtype='float64',
+                    source_arrays=None):
+    """Returns the phase space iterator for a simulation. The spectrum and
+    bowtie filter arrays are computed unless source_arrays from
+    ct_simulation_source_arrays are given.
+    """
     arglist = ['scan_fov', 'sdd']
     kwarglist = ['start', 'stop', 'exposures', 'histories',
-                 'start_at_exposure_no','tube_start_angle',
+                 'start_at_exposure_no', 'stop_at_exposure_no', 'tube_start_angle',
                  'bowtie_distance', 'bowtie_radius']
 
     args = [simulation.get(a) for a in arglist]
     args.append(simulation.get('detector_rows') * simulation.get('detector_width'))
-    kwargs = {'exposure_modulation': exposure_modulation}
+    kwargs = {'exposure_modulation': exposure_modulation, 'dtype': dtype}
     for a in kwarglist:
         kwargs[a] = simulation.get(a)
     kwargs['rotation_center'] = simulation.get('data_center')
@@ -56,12 +111,21 @@ def ct_source_space(simulation, exposure_modulation=None):
         kwargs['step'] = simulation.get('step')
         phase_func = ct_seq
 
-    s = specter(simulation.get('kV'), angle_deg=simulation['anode_angle'], filtration_materials='Al',
-                filtration_mm=simulation.get('al_filtration'))
-    kwargs['energy_specter'] = s
+    if source_arrays is None:
+        source_arrays = ct_simulation_source_arrays(simulation, dtype=dtype)
+    kwargs['source_arrays'] = source_arrays
 
     return phase_func(*args, **kwargs)
 
+def ct_exposure_count(simulation):
+    """Returns the total number of exposures in the phase space of a
+    simulation."""
+    simulation = dict(simulation)
+    simulation['start_at_exposure_no'] = 0
+    for p, e, n in ct_source_space(simulation):
+        return n
+    return 0
+
 def world_image_matrix(orientation):
     iop = np.array(orientation, dtype=np.float).reshape(2, 3).T
     s_norm = np.cross(*iop.T[:])
@@ -82,7 +146,9 @@ def ct_spiral(scan_fov, sdd, total_collimation, pitch=1,
               rotation_center=None,
               rotation_plane_cosines=None,
               exposure_modulation=None, start_at_exposure_no=0,
-              bowtie_radius=1, bowtie_distance=0):
+              stop_at_exposure_no=0,
+              bowtie_radius=1, bowtie_distance=0, dtype='float64',
+              source_arrays=None):
     """Generate CT phase space, return a iterator.
 
     INPUT:
@@ -116,6 +182,16 @@ def ct_spiral(scan_fov, sdd, total_collimation, pitch=1,
             (ndarray(position), ndarray(scale_factors))
         start_at_exposure_no: int
             Starting at this exposure number, used for resuming a simulation
+        stop_at_exposure_no: int
+            Stopping before this exposure number, used for splitting a
+            simulation in shards. Zero or less simulates all exposures
+        dtype : str or np.dtype
+            floating point type of the returned arrays, must match the
+            engine precision
+        source_arrays : tuple
+            [optional] source arrays from ct_source_arrays shared by all
+            exposures, energy, energy_specter and the bowtie arguments are
+            ignored if given
     OUTPUT:
         Iterator returning ndarrays of shape (8, batch_size),
         one row is equal to photon (start_x, start_y, star_z, direction_x,
@@ -146,16 +222,13 @@ def ct_spiral(scan_fov, sdd, total_collimation, pitch=1,
 
     # rotation matrix along z-axis for an angle x
 
-    if energy_specter is None:
-        energy_specter = [np.array([energy], dtype=np.double),
-                          np.array([1.0], dtype=np.double)]
-    energy_specter = (energy_specter[0],
-                      energy_specter[1] / energy_specter[1].sum())
-
-    specter_cpd = np.cumsum(energy_specter[1]).astype('float64')
-    specter_cpd /= specter_cpd.max()
-
-    specter_energy = energy_specter[0].astype('float64')
+    if source_arrays is None:
+        source_arrays = ct_source_arrays(scan_fov, sdd, total_collimation,
+                                         energy=energy,
+                                         energy_specter=energy_specter,
+                                         bowtie_radius=bowtie_radius,
+                                         bowtie_distance=bowtie_distance,
+                                         dtype=dtype)
 
 #    if modulation_xy is None:
 #        mod_xy = lambda x: 1.0
@@ -176,37 +249,20 @@ def ct_spiral(scan_fov, sdd, total_collimation, pitch=1,
                                                fill_value=1.0, kind='nearest')
         else:
             mod_z = lambda x: 1.0
-    fov_arr=np.array([scan_fov], dtype='float64')
-    collimation_arr=np.array([total_collimation], dtype='float64')
-    rot_fan_angle = np.array([np.arctan(fov_arr[0]/sdd) * 2],dtype='float64')
-    scan_fan_angle = np.array([np.arctan(collimation_arr[0] *.5 / sdd) * 2], dtype='float64')
-
-    bowtie_angle = np.linspace(-rot_fan_angle[0]/2, rot_fan_angle[0]/2, 101, dtype='float64')
-    bowtie_lenghts= bowtie_path_lenght(bowtie_angle, bowtie_radius, bowtie_distance)
-    bowtie_weights = np.empty_like(bowtie_angle, dtype='float64')
-    bowtie_att = attinuation(specter_energy/1000, name='aluminum', density=True).astype('float64')
-    for i in range(bowtie_lenghts.shape[0]):
-        bowtie_weights[i] = np.sum(energy_specter[1]*np.exp(-bowtie_att*bowtie_lenghts[i]))
-
-
-    n_bowtie = np.array(bowtie_weights.shape, dtype='int')
-    n_specter = np.array(specter_energy.shape, dtype='int')
 
 
     M = world_image_matrix(rotation_plane_cosines)
     rotation_center_image = np.dot(M, rotation_center[[1, 0, 2]])
-    for i in range(start_at_exposure_no, e):
+    if stop_at_exposure_no is None or stop_at_exposure_no <= 0:
+        stop_at_exposure_no = e
+    for i in range(start_at_exposure_no, min(stop_at_exposure_no, e)):
         R = np.dot(M, rotation_z_matrix(ang[i]))
 
-        position = np.dot(R, np.array([-sdd/2., 0, t[i]], dtype='float64')) + rotation_center_image
-        direction = np.dot(R, np.array([1., 0, 0], dtype='float64'))
-        scan_axis = np.dot(R, np.array([0, 0, 1], dtype='float64'))
-        ret = (position, direction, scan_axis,
-               scan_fan_angle,
-               rot_fan_angle,
-               np.array([mod_z(t[i])], dtype='float64'),
-               specter_cpd, specter_energy, n_specter,
-               bowtie_weights, bowtie_angle, n_bowtie)
+        position = (np.dot(R, np.array([-sdd/2., 0, t[i]])) + rotation_center_image).astype(dtype)
+        direction = np.dot(R, np.array([1., 0, 0])).astype(dtype)
+        scan_axis = np.dot(R, np.array([0, 0, 1])).astype(dtype)
+        ret = (position, direction, scan_axis) + source_arrays[:2] + \
+              (np.array([mod_z(t[i])], dtype=dtype),) + source_arrays[2:]
 #        ret = (position, direction, scan_axis,
 #               np.array([sdd], dtype='float64'),
 #               np.array([scan_fov], dtype='float64'),
@@ -225,7 +281,8 @@ def ct_seq(scan_fov, sdd, total_collimation, step=1,
               rotation_center=None,
               rotation_plane_cosines = None,
               bowtie_radius=1, bowtie_distance=0,
-              exposure_modulation=None, start_at_exposure_no=0):
+              exposure_modulation=None, start_at_exposure_no=0,
+              stop_at_exposure_no=0, dtype='float64', source_arrays=None):
     """Generate CT phase space, return a iterator.
 
     INPUT:
@@ -259,6 +316,16 @@ def ct_seq(scan_fov, sdd, total_collimation, step=1,
             (ndarray(position), ndarray(scale_factors))
         start_at_exposure_no: int
             Starting at this exposure number, used for resuming a simulation
+        stop_at_exposure_no: int
+            Stopping before this exposure number, used for splitting a
+            simulation in shards. Zero or less simulates all exposures
+        dtype : str or np.dtype
+            floating point type of the returned arrays, must match the
+            engine precision
+        source_arrays : tuple
+            [optional] source arrays from ct_source_arrays shared by all
+            exposures, energy, energy_specter and the bowtie arguments are
+            ignored if given
     OUTPUT:
         Iterator returning ndarrays of shape (8, batch_size),
         one row is equal to photon (start_x, start_y, star_z, direction_x,
@@ -292,14 +359,13 @@ def ct_seq(scan_fov, sdd, total_collimation, step=1,
     t = half_shuffle(t)
     ang = half_shuffle(ang)
 
-    if energy_specter is None:
-        energy_specter = [np.array([energy], dtype=np.double),
-                          np.array([1.0], dtype=np.double)]
-    energy_specter = (energy_specter[0],
-                      energy_specter[1] / energy_specter[1].sum())
-    specter_cpd = np.cumsum(energy_specter[1]).astype('float64')
-    specter_cpd /= specter_cpd.max()
-    specter_energy = energy_specter[0].astype('float64')
+    if source_arrays is None:
+        source_arrays = ct_source_arrays(scan_fov, sdd, total_collimation,
+                                         energy=energy,
+                                         energy_specter=energy_specter,
+                                         bowtie_radius=bowtie_radius,
+                                         bowtie_distance=bowtie_distance,
+                                         dtype=dtype)
 
 #    if modulation_xy is None:
 #        mod_xy = lambda x: 1.0
@@ -308,20 +374,6 @@ def ct_seq(scan_fov, sdd, total_collimation, step=1,
 #                                            copy=False, bounds_error=False,
 #                                            fill_value=1.0)
 
-    fov_arr=np.array([scan_fov], dtype='float64')
-    collimation_arr=np.array([total_collimation], dtype='float64')
-    rot_fan_angle = np.array([np.arctan(fov_arr[0]/sdd) * 2],dtype='float64')
-    scan_fan_angle = np.array([np.arctan(collimation_arr[0] *.5 / sdd) * 2], dtype='float64')
-
-    bowtie_angle = np.linspace(-rot_fan_angle[0]/2, rot_fan_angle[0]/2, 101, dtype='float64')
-    bowtie_lenghts= bowtie_path_lenght(bowtie_angle, bowtie_radius, bowtie_distance)
-    bowtie_weights = np.empty_like(bowtie_angle, dtype='float64')
-    bowtie_att = attinuation(specter_energy/1000, name='aluminum', density=True).astype('float64')
-    for i in range(bowtie_lenghts.shape[0]):
-        bowtie_weights[i] = np.sum(energy_specter[1]*np.exp(-bowtie_att*bowtie_lenghts[i]))
-
-    n_bowtie = np.array(bowtie_weights.shape, dtype='int')
-    n_specter = np.array(specter_energy.shape, dtype='int')
 
 
     if exposure_modulation is None:
@@ -339,19 +391,17 @@ def ct_seq(scan_fov, sdd, total_collimation, step=1,
 
     M = world_image_matrix(rotation_plane_cosines)
     rotation_center_image = np.dot(M, rotation_center[[1, 0, 2]])
-    for i in range(start_at_exposure_no, e):
+    if stop_at_exposure_no is None or stop_at_exposure_no <= 0:
+        stop_at_exposure_no = e
+    for i in range(start_at_exposure_no, min(stop_at_exposure_no, e)):
         R = np.dot(M, rotation_z_matrix(ang[i]))
 
-        position = np.dot(R, np.array([-sdd/2., 0, t[i]], dtype='float64')) + rotation_center_image
-        direction = np.dot(R, np.array([1., 0, 0], dtype='float64'))
-        scan_axis = np.dot(R, np.array([0, 0, 1], dtype='float64'))
+        position = (np.dot(R, np.array([-sdd/2., 0, t[i]])) + rotation_center_image).astype(dtype)
+        direction = np.dot(R, np.array([1., 0, 0])).astype(dtype)
+        scan_axis = np.dot(R, np.array([0, 0, 1])).astype(dtype)
 
-        ret = (position, direction, scan_axis,
-               scan_fan_angle,
-               rot_fan_angle,
-               np.array([mod_z(t[i])], dtype='float64'),
-               specter_cpd, specter_energy, n_specter,
-               bowtie_weights, bowtie_angle, n_bowtie)
+        ret = (position, direction, scan_axis) + source_arrays[:2] + \
+              (np.array([mod_z(t[i])], dtype=dtype),) + source_arrays[2:]
 
 #        ret = (position, direction, scan_axis,
 #               np.array([sdd], dtype='float64'),
@@ -361,3 +411,41 @@ def ct_seq(scan_fov, sdd, total_collimation, step=1,
 #               specter_cpd.astype('float64'), specter_energy.astype('float64'))
         yield ret, i, e
 
+
+
+def batch_phase_space(phase_space, batch_size=100):
+    """Groups the exposures of a phase space iterator into blocks for
+    Engine.run_bowtie_batch.
+
+    INPUT:
+        phase_space : iterator
+            phase space iterator from ct_spiral or ct_seq
+        batch_size : int
+            maximum number of exposures in each block
+    OUTPUT:
+        Iterator returning (source, positions, directions, scan_axes,
+        weights, e, n) where source is the argument tuple for
+        Engine.setup_source_bowtie of the first exposure in the block,
+        positions, directions and scan_axes are contiguous (batch, 3)
+        arrays, weights is a (batch,) array, e is the exposure number of
+        the last exposure in the block and n is the total number of
+        exposures.
+    """
+    batch_size = max(int(batch_size), 1)
+    block = []
+    for p, e, n in phase_space:
+        block.append(p)
+        if len(block) >= batch_size:
+            yield _stack_exposures(block) + (e, n)
+            block = []
+    if len(block) > 0:
+        yield _stack_exposures(block) + (e, n)
+
+
+def _stack_exposures(block):
+    dtype = block[0][0].dtype
+    positions = np.ascontiguousarray([p[0] for p in block], dtype=dtype)
+    directions = np.ascontiguousarray([p[1] for p in block], dtype=dtype)
+    scan_axes = np.ascontiguousarray([p[2] for p in block], dtype=dtype)
+    weights = np.ascontiguousarray([p[5][0] for p in block], dtype=dtype)
+    return block[0], positions, directions, scan_axes, weights
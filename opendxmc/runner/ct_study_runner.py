@@ -8,22 +8,44 @@ import numpy as np
 from scipy.ndimage.interpolation import affine_transform, spline_filter
 from scipy.ndimage.filters import gaussian_filter
 
-from opendxmc.engine import Engine
+from opendxmc.engine import Engine, Progress, pack_voxels, random_seed
+from opendxmc.engine import COUNTERS_DTYPE, PhaseSpace
 
 from opendxmc.tube.tungsten import specter as tungsten_specter
 from opendxmc.runner.ct_sources import ct_source_space
+from opendxmc.runner.ct_sources import ct_simulation_source_arrays
 from opendxmc.runner.ct_sources import ct_seq
+from opendxmc.runner.ct_sources import batch_phase_space
+from opendxmc.runner.ct_pool import EnginePool
 from opendxmc.utils import circle_mask
 import time
+import os
+import hashlib
 from opendxmc.utils import human_time, rebin
 
 import logging
 logger = logging.getLogger('OpenDXMC')
 
 
+class SimulationCancelled(Exception):
+    """Raised by ct_runner when the simulation progress is cancelled."""
+    pass
+
+
+# anode angle of the tube specter in the CTDI calibration simulations
+CTDI_ANODE_ANGLE = 10.
+
+ELECTRON_MASS = 510998.9  # eV/(c*c)
+
+# random stream numbers of each batch, exposure k of batch b uses the same
+# streams whatever the number of exposures so simulations of a protocol
+# comparison set use the same streams history for history
+STREAM_BATCH_STRIDE = 2**40
+
+
 def log_elapsed_time(time_start, elapsed_exposures, total_exposures,
                      start_exposure, n_histories=None):
-    time_delta = time.clock() - time_start
+    time_delta = time.perf_counter() - time_start
     p = np.round(float(elapsed_exposures) / float(total_exposures) * 100., 1)
     eta = time_delta * (float(total_exposures-start_exposure) / float(elapsed_exposures-start_exposure) - 1.)
     if elapsed_exposures == total_exposures:
@@ -41,6 +63,19 @@ def log_elapsed_time(time_start, elapsed_exposures, total_exposures,
     return '{0}% ETA: '.format(p) + human_time(eta)
 
 
+def log_engine_counters(counters):
+    """Logs transport event counts from an instrumented engine."""
+    histories = max(counters['histories'], 1)
+    steps = max(counters['woodcock_real'] + counters['woodcock_virtual'], 1)
+    logger.info('Engine counters per history: ' + ', '.join(
+        '{0} {1:.3f}'.format(name, counters[name] / histories)
+        for name in COUNTERS_DTYPE.names if name != 'histories'))
+    logger.info('{0} histories, {1:.1f}% of woodcock steps are virtual, {2:.1f}% '
+                'of histories miss the volume'.format(counters['histories'],
+                                                     100. * counters['woodcock_virtual'] / steps,
+                                                     100. * counters['missed'] / histories))
+
+
 def recarray_to_dict(arr, key=None, value=None, value_is_string=False):
     key, value = arr.dtype.names
     assert key in arr.dtype.names
@@ -51,8 +86,40 @@ def recarray_to_dict(arr, key=None, value=None, value_is_string=False):
     return {arr[key][i]: arr[value][i] for i in range(arr.shape[0])}
 
 
+def simulation_dtype(simulation):
+    """Floating point type of all arrays passed to the engine for this
+    simulation, energy_imparted excepted, which is always float64.
+    """
+    if simulation['single_precision']:
+        return np.dtype('float32')
+    return np.dtype('float64')
+
+
 def generate_attinuation_lut(materials, material_map, min_eV=None,
-                             max_eV=None, ignore_air=False):
+                             max_eV=None, ignore_air=False, log_grid=False,
+                             max_error=1e-2, max_points=2**14,
+                             dtype='float64'):
+    """Generate an attenuation lookup table of shape
+    (n_materials, 6, n_energies) where the second axis is energy, total,
+    rayleigh, photoelectric and compton attenuation and the energy absorption
+    coefficient used by track length scoring.
+
+    The energy absorption coefficient is the photoelectric attenuation plus
+    the compton attenuation times the mean Klein-Nishina energy transfer
+    fraction, the energy the engine deposits per interaction, fluorescence
+    and bremsstrahlung are neglected as in the engine.
+
+    If log_grid is True the table is resampled onto an uniform logarithmic
+    energy grid from min_eV to max_eV, which lets the engine index the table
+    directly instead of searching it. The number of grid points is doubled
+    until the maximum relative interpolation error against the table on the
+    original energies is below max_error or max_points is reached. Grid
+    cells containing an absorption edge are excluded from the error since no
+    uniform grid can resolve them.
+
+    The table is returned with floating point type dtype, the interpolation
+    error is evaluated before conversion.
+    """
 
     if isinstance(material_map, np.recarray):
         material_map = recarray_to_dict(material_map, value_is_string=True)
@@ -80,11 +147,15 @@ def generate_attinuation_lut(materials, material_map, min_eV=None,
 
     energies = np.unique(np.hstack([a['energy'] for a in list(atts.values())]))
     e_ind = (energies <= max_eV) * (energies >= min_eV)
+    if log_grid:
+        # keeping the first energy above max_eV so the grid can end at max_eV
+        e_ind[np.searchsorted(energies, max_eV, side='right'):][:1] = True
     if not any(e_ind):
         raise ValueError('Supplied minimum or maximum energies '
                          'are out of range')
     energies = energies[e_ind]
-    lut = np.empty((len(atts), 5, len(energies)), dtype='float64')
+    lut = np.empty((len(atts), 6, len(energies)), dtype='float64')
+    transfer_fraction = compton_energy_transfer_fraction(energies)
     for i, a in list(atts.items()):
         lut[i, 0, :] = energies
         if ignore_air and air_key == i:
@@ -93,9 +164,94 @@ def generate_attinuation_lut(materials, material_map, min_eV=None,
             for j, key in enumerate(['total', 'rayleigh', 'photoelectric',
                                      'compton']):
                 lut[i, j+1, :] = np.interp(energies, a['energy'], a[key])
-    return lut
-
-def prepare_geometry_from_organ_array(organ, organ_material_map, scale, materials):
+            lut[i, 5, :] = lut[i, 3, :] + lut[i, 4, :] * transfer_fraction
+    if not log_grid:
+        return lut.astype(dtype)
+
+    # absorption edges are listed twice in the material tables
+    edges = np.unique(np.hstack([a['energy'][1:][np.diff(a['energy']) == 0]
+                                 for a in list(atts.values())]))
+    edges = edges[(edges > energies[0]) * (edges <= energies[-1])]
+    e_max = min(max_eV, energies[-1])
+
+    n_points = 2**8
+    while True:
+        log_lut = resample_lut_log_grid(lut, n_points, energies[0], e_max)
+        error = lut_interpolation_error(log_lut, lut, edges)
+        if error <= max_error or n_points >= max_points:
+            break
+        n_points *= 2
+    if error > max_error:
+        logger.warning('Attenuation LUT interpolation error {0:.2e} is above '
+                       'the requested {1:.2e} with {2} log energy '
+                       'points'.format(error, max_error, n_points))
+    logger.info('Attenuation LUT resampled to {0} log energy points from '
+                '{1:.0f} eV to {2:.0f} eV, maximum relative interpolation '
+                'error is {3:.2e}'.format(n_points, energies[0], e_max,
+                                          error))
+    return log_lut.astype(dtype)
+
+
+def compton_energy_transfer_fraction(energies, n_angles=2**11 + 1):
+    """Mean fraction of the photon energy transferred to the electron in
+    Klein-Nishina scattering for each energy in eV, integrated numerically
+    over n_angles uniform scatter angle cosines.
+    """
+    k = np.asarray(energies, dtype='float64')[:, np.newaxis] / ELECTRON_MASS
+    cos_theta = np.linspace(-1., 1., n_angles)
+    # trapezoidal integration weights
+    weights = np.ones(n_angles)
+    weights[[0, -1]] = .5
+    epsilon = 1. / (1. + k * (1. - cos_theta))
+    cross_section = epsilon**2 * (epsilon + 1. / epsilon - 1. + cos_theta**2)
+    return (np.sum((1. - epsilon) * cross_section * weights, axis=1) /
+            np.sum(cross_section * weights, axis=1))
+
+
+def resample_lut_log_grid(lut, n_points, min_eV, max_eV):
+    """Resample an attenuation lut onto n_points uniform logarithmic energies
+    from min_eV to max_eV by linear interpolation.
+    """
+    energies = np.exp(np.linspace(np.log(min_eV), np.log(max_eV), n_points))
+    log_lut = np.empty(lut.shape[:2] + (n_points,), dtype=lut.dtype)
+    for i in range(lut.shape[0]):
+        log_lut[i, 0, :] = energies
+        for j in range(1, lut.shape[1]):
+            log_lut[i, j, :] = np.interp(energies, lut[i, 0, :], lut[i, j, :])
+    return log_lut
+
+
+def lut_interpolation_error(log_lut, lut, edges=None):
+    """Maximum relative error of log_lut against lut, evaluated at the
+    energies of lut with the same linear interpolation the engine uses.
+    Energies outside the log_lut grid and energies in log_lut grid cells that
+    overlap the lut interval rising to an absorption edge in edges are
+    excluded.
+    """
+    energies = lut[0, 0, :]
+    grid = log_lut[0, 0, :]
+    cells = np.searchsorted(grid, energies, side='right') - 1
+    valid = (energies >= grid[0]) * (energies <= grid[-1])
+    if edges is not None:
+        for edge in edges:
+            below = energies[energies < edge]
+            start = below[-1] if below.size > 0 else edge
+            low = np.searchsorted(grid, start, side='right') - 1
+            high = np.searchsorted(grid, edge, side='right') - 1
+            valid *= (cells < low) + (cells > high)
+    error = 0.
+    for i in range(lut.shape[0]):
+        for j in range(1, lut.shape[1]):
+            reference = lut[i, j, :]
+            ind = valid * (reference > 0)
+            if not any(ind):
+                continue
+            value = np.interp(energies[ind], grid, log_lut[i, j, :])
+            error = max(error, np.max(np.abs(value - reference[ind]) /
+                                      reference[ind]))
+    return error
+
+def prepare_geometry_from_organ_array(organ, organ_material_map, scale, materials, dtype='float64'):
         """genereate material and density arrays and material map from
            a list of materials to use
            INPUT:
@@ -121,8 +277,9 @@ def prepare_geometry_from_organ_array(organ, organ_material_map, scale, material
 #                                 cval=0, output=np.uint8, prefilter=True,
 #                                 order=0).astype(np.uint8)
         organ = organ[::scale[0], ::scale[1], ::scale[2]]
-        material_array = np.asarray(organ, dtype=np.uint8)
-        density_array = np.zeros(organ.shape, dtype='float64')
+        # a copy, the organ array of the caller must not be overwritten
+        material_array = np.array(organ, dtype=np.uint8)
+        density_array = np.zeros(organ.shape, dtype=dtype)
 
         material_map = {}
         key = 0
@@ -157,7 +314,7 @@ def attinuation_to_ct_numbers(material_attinuations, air_key, water_key):
         atts.append((key,HU))
     return atts
 
-def prepare_geometry_from_ct_array(ctarray, scale ,specter, materials):
+def prepare_geometry_from_ct_array(ctarray, scale ,specter, materials, dtype='float64'):
         """genereate material and density arrays and material map from
            a list of materials to use
            INPUT:
@@ -222,7 +379,7 @@ def prepare_geometry_from_ct_array(ctarray, scale ,specter, materials):
         material_array = np.digitize(
             ctarray.ravel(), HU_bins).reshape(ctarray.shape).astype('int32')
         # Using densities fromdefined materials
-        density_array = np.asarray(material_array, dtype='float64')
+        density_array = np.asarray(material_array, dtype=dtype)
         np.choose(material_array,
                   [material_dens[i] for i, _ in material_HU_list],
                   out=density_array)
@@ -239,7 +396,7 @@ def prepare_geometry_from_ct_array(ctarray, scale ,specter, materials):
 
 
 def ct_runner_validate_simulation(materials, simulation, ctarray=None, organ=None,
-                                  organ_material_map=None):
+                                  organ_material_map=None, dtype='float64'):
     """
     validating a ct mc simulation
     """
@@ -253,14 +410,16 @@ def ct_runner_validate_simulation(materials, simulation, ctarray=None, organ=Non
         vals = prepare_geometry_from_ct_array(ctarray,
                                               simulation['scaling'],
                                               specter,
-                                              materials)
+                                              materials,
+                                              dtype=dtype)
     elif (organ is not None) and (organ_material_map is not None):
         logger.info('Recalculating material mapping from organ array for {}'.format(simulation['name']))
 
         vals = prepare_geometry_from_organ_array(organ,
                                                  organ_material_map,
                                                  simulation['scaling'],
-                                                 materials)
+                                                 materials,
+                                                 dtype=dtype)
     else:
         logger.warning('CT study {} has no CT images or organ arrays. Simulation not '
                        'started'.format(simulation['name']))
@@ -294,13 +453,585 @@ def ct_runner_validate_simulation(materials, simulation, ctarray=None, organ=Non
                        'current simulation.')
         material_map = None
         raise ValueError('Error in material definitions for simulation')
-    return material.astype('int32'), material_map, density.astype('float64')
+    return material.astype('int32'), material_map, density.astype(dtype)
+
+
+def relative_uncertainty(energy_imparted, energy_squared, n_batches):
+    """Relative standard error of energy_imparted in each voxel, estimated
+    from energy_squared, the sum of squared energies imparted in each of
+    n_batches equally sized batches. Voxels where no energy is imparted are
+    given a relative uncertainty of one.
+    """
+    uncertainty = np.ones_like(energy_imparted)
+    ind = energy_imparted > 0
+    variance = n_batches * energy_squared[ind] / energy_imparted[ind]**2 - 1.
+    uncertainty[ind] = np.sqrt(np.clip(variance, 0, None) / (n_batches - 1.))
+    return uncertainty
+
+
+def batch_uncertainty(batch_energies):
+    """Relative standard error of the summed energy in each column of
+    batch_energies, where each row holds the energies imparted in one batch.
+    Columns where no energy is imparted are given a relative uncertainty of
+    one.
+    """
+    batch_energies = np.asarray(batch_energies, dtype='float64')
+    n_batches = batch_energies.shape[0]
+    total = batch_energies.sum(axis=0)
+    squared = (batch_energies**2).sum(axis=0)
+    return relative_uncertainty(total, squared, n_batches)
+
+
+def target_organ_indices(simulation, organ_map):
+    """Returns the organ numbers named in the comma separated target_organs
+    property, or None if the target uncertainty applies to the whole volume.
+    """
+    names = [n.strip().lower() for n in simulation['target_organs'].split(',')]
+    names = [n for n in names if len(n) > 0]
+    if len(names) == 0:
+        return None
+    if organ_map is None:
+        logger.warning('No organ map in {0}, target organs are ignored and '
+                       'the target uncertainty applies to the whole '
+                       'volume'.format(simulation['name']))
+        return None
+    organs = recarray_to_dict(organ_map, value_is_string=True)
+    organs = {value.lower(): key for key, value in organs.items()}
+    for name in names:
+        if name not in organs:
+            logger.warning('Target organ {0} not in organ map for '
+                           '{1}'.format(name, simulation['name']))
+    indices = [organs[name] for name in names if name in organs]
+    if len(indices) == 0:
+        return None
+    return np.array(indices, dtype='int')
+
+
+def importance_map(organ, organs, factor, spacing, ramp=1., dtype='float64'):
+    """Returns a voxel importance map of the organ array, factor in the
+    organs numbered in organs and one elsewhere. The importance changes
+    smoothly over about ramp cm at the organ borders, spacing is the voxel
+    size in cm, so photons are split or rouletted in several smaller steps.
+    """
+    inside = np.isin(organ, organs)
+    sigma = ramp / np.asarray(spacing, dtype='float64')
+    weight = np.clip(2 * gaussian_filter(inside.astype('float64'), sigma), 0, 1)
+    return (1 + (factor - 1) * weight).astype(dtype)
+
+
+def target_organ_direction(simulation, organ, organs, spacing):
+    """Returns the unit vector from the scan center, the data collection
+    center at the middle of the start and stop positions, to the center of
+    the organs numbered in organs, or None if organ has none of the organs.
+    spacing is the voxel size of organ in cm.
+    """
+    inside = np.argwhere(np.isin(organ, organs))
+    if inside.shape[0] == 0:
+        return None
+    center = (inside.mean(axis=0) + .5) * spacing
+    scan_center = np.array(simulation['data_center'], dtype='float64')
+    scan_center[2] = (simulation['start'] + simulation['stop']) / 2.
+    direction = center - scan_center
+    length = np.sqrt(np.sum(direction**2))
+    if length == 0:
+        return np.array([0., 0., 1.])
+    return direction / length
+
+
+def engine_threading(simulation):
+    """Returns the threads, schedule, chunk_size and affinity keyword
+    arguments for Engine from the properties of simulation.
+    """
+    threads = simulation['threads_per_process']
+    if threads <= 0:
+        threads = None
+    affinity = [int(c) for c in simulation['cpu_affinity'].split(',') if len(c.strip()) > 0]
+    return {'threads': threads, 'schedule': simulation['thread_schedule'],
+            'chunk_size': simulation['chunk_size'],
+            'affinity': affinity or None}
+
+
+def autotune_threads(N, spacing, offset, voxels, lut, use_siddon, source_args,
+                     seed, positions, directions, scan_axes, weights, histories,
+                     precision='float64', schedule='dynamic', affinity=None,
+                     max_threads=None, chunk_sizes=(16, 64, 256),
+                     burst_time=.2, scoring='collision',
+                     forced_interaction=False, importance=None,
+                     weight_cutoff=0.01, roulette_chance=0.2,
+                     weight_window=0., exponential_transform=0., transform_direction=(0., 0., 1.)):
+    """Times short bursts of a block of exposures on the simulation geometry
+    and returns the thread count and chunk size with the best throughput.
+    The thread count is tuned first with the default chunk size, then the
+    chunk size. The fewest threads within 5% of the best throughput are
+    chosen as more threads only add contention. Bursts are tallied in a
+    scratch array and do not change the simulation result.
+    """
+    if max_threads is None:
+        if affinity:
+            max_threads = len(affinity)
+        else:
+            max_threads = os.cpu_count() or 1
+    max_threads = max(int(max_threads), 1)
+    candidates = [2**i for i in range(int(np.log2(max_threads)) + 1)]
+    if candidates[-1] != max_threads:
+        candidates.append(max_threads)
+
+    engine = Engine(precision=precision, schedule=schedule, affinity=affinity,
+                    scoring=scoring, forced_interaction=forced_interaction,
+                    weight_cutoff=weight_cutoff, roulette_chance=roulette_chance,
+                    weight_window=weight_window,
+                    exponential_transform=exponential_transform,
+                    transform_direction=transform_direction)
+    # the engine keeps pointers to the arrays
+    scratch = np.zeros(tuple(N), dtype='float64')
+    lut_shape = np.array(lut.shape, dtype='int32')
+    geometry = engine.setup_simulation(N, spacing, offset, voxels,
+                                       lut_shape, lut, scratch, use_siddon,
+                                       importance=importance, seed=seed)
+    source = engine.setup_source_bowtie(*source_args)
+
+    def burst(threads, chunk_size, burst_histories):
+        engine.set_threading(geometry, threads=threads, chunk_size=chunk_size)
+        engine.set_random_stream(geometry, 0)
+        t0 = time.perf_counter()
+        engine.run_bowtie_batch(source, positions, directions, scan_axes,
+                                weights, burst_histories, geometry)
+        return weights.shape[0] * burst_histories / (time.perf_counter() - t0)
+
+    # the warm up run scales the bursts to about burst_time seconds on all
+    # threads
+    burst_histories = min(100, histories)
+    rate = burst(max_threads, engine.chunk_size, burst_histories)
+    burst_histories = int(min(max(rate * burst_time / weights.shape[0], 100), histories))
+
+    rates = [burst(threads, engine.chunk_size, burst_histories) for threads in candidates]
+    best = max(rates)
+    threads = min(t for t, r in zip(candidates, rates) if r >= .95 * best)
+    rates = [burst(threads, chunk_size, burst_histories) for chunk_size in chunk_sizes]
+    chunk_size = chunk_sizes[int(np.argmax(rates))]
+
+    engine.cleanup(simulation=geometry, source=source)
+    logger.info('Tuned engine to {0} threads with chunks of {1} histories, '
+                '{2:.0f} histories per second'.format(threads, chunk_size, max(rates)))
+    return threads, chunk_size
+
+
+def simulation_batches(simulation):
+    """Returns the number of batches, the histories per exposure in each
+    batch, the largest number of batches and whether batches are added
+    until the target uncertainty is reached or the time budget is spent.
+    Adaptive simulations run at least two batches to estimate the
+    uncertainty. Phase space files are recorded and replayed in a fixed
+    number of batches.
+    """
+    n_batches = max(simulation['uncertainty_batches'], 1)
+    histories = int(np.ceil(simulation['histories'] / n_batches))
+    adaptive = (simulation['target_uncertainty'] > 0) or (simulation['time_budget'] > 0)
+    if adaptive:
+        n_batches = max(n_batches, 2)
+        if simulation['phase_space_mode'] != 'none':
+            if simulation['phase_space_mode'] == 'replay':
+                action = 'Replaying'
+            else:
+                # the phase space file is sized for the photons of all batches
+                action = 'Recording'
+            logger.info('{0} phase space in {1} batches, target uncertainty '
+                        'and time budget are ignored'.format(action, n_batches))
+            adaptive = False
+    if adaptive:
+        max_batches = max(simulation['max_uncertainty_batches'], n_batches)
+    else:
+        max_batches = n_batches
+    return n_batches, histories, max_batches, adaptive
+
+
+def batch_target_uncertainty(energy_imparted, energy_squared, n_batches,
+                             organ_energies=None):
+    """Returns the relative uncertainty compared with the target uncertainty
+    after n_batches batches, the largest uncertainty of the target organs if
+    organ_energies, a list of the energy imparted in the target organs
+    summed after each batch, is given, else the energy weighted mean
+    uncertainty of the volume.
+    """
+    if organ_energies is not None:
+        return batch_uncertainty(np.diff(np.array(organ_energies), axis=0)).max()
+    uncertainty = relative_uncertainty(energy_imparted, energy_squared, n_batches)
+    return np.sum(uncertainty * energy_imparted) / energy_imparted.sum()
+
+
+def batches_done(simulation, batch, n_batches, uncertainty_reached,
+                 time_elapsed):
+    """Returns True if an adaptive simulation should stop after batch
+    batches, when the target uncertainty is reached after n_batches
+    batches or the next batch would exceed the time budget. The time budget
+    also stops a simulation before n_batches batches, but not before the
+    two batches needed for the uncertainty.
+    """
+    if batch < 2:
+        return False
+    target_uncertainty = simulation['target_uncertainty']
+    if (target_uncertainty > 0) and (batch >= n_batches):
+        logger.info('{0}: Relative uncertainty after {1} batches is '
+                    '{2:.4f}, target is {3}'.format(time.ctime(), batch, uncertainty_reached, target_uncertainty))
+        if uncertainty_reached <= target_uncertainty:
+            return True
+    time_budget = simulation['time_budget'] * 60.
+    if (time_budget > 0) and (time_elapsed * (batch + 1) / batch > time_budget):
+        logger.info('{0}: Time budget is spent after {1} '
+                    'batches'.format(time.ctime(), batch))
+        return True
+    return False
+
+
+def target_organ_volume(simulation, organ, organ_map, shape):
+    """Returns the target organ numbers of simulation and the organ array
+    at the simulation scaling, or None and None if there are no target
+    organs or the scaled organ array does not have the geometry shape.
+    """
+    target_organs = target_organ_indices(simulation, organ_map)
+    if (target_organs is None) or (organ is None):
+        return None, None
+    scaling = simulation['scaling']
+    organ_volume = np.asarray(organ[::scaling[0], ::scaling[1], ::scaling[2]])
+    if organ_volume.shape != tuple(shape):
+        return None, None
+    return target_organs, organ_volume
+
+
+def simulation_biasing(simulation, target_organs, organ_volume, spacing,
+                       dtype='float64'):
+    """Returns the voxel importance map of simulation, or None, and the
+    russian roulette, splitting and exponential transform keyword arguments
+    for Engine. Photons are split entering and rouletted leaving the target
+    organs if they are given an importance factor. Woodcock photon paths
+    are stretched along the transform direction, by default toward the
+    target organs. Biasing needing target organs is ignored without them.
+    """
+    biasing = {'weight_cutoff': simulation['weight_cutoff'],
+               'roulette_chance': simulation['roulette_survival'],
+               'weight_window': simulation['weight_window'],
+               'exponential_transform': simulation['exponential_transform'],
+               'transform_direction': simulation['exponential_transform_direction']}
+
+    importance = None
+    if simulation['importance_factor'] != 1:
+        if target_organs is None:
+            logger.warning('No target organs for the importance map of {0}, '
+                           'importance factor is ignored'.format(simulation['name']))
+        else:
+            importance = importance_map(organ_volume, target_organs,
+                                        simulation['importance_factor'],
+                                        spacing, dtype=dtype)
+
+    if biasing['exponential_transform'] > 0:
+        if simulation['use_siddon']:
+            logger.warning('The exponential transform needs Woodcock '
+                           'tracking, it is ignored for {0}'.format(simulation['name']))
+            biasing['exponential_transform'] = 0.
+        elif not np.any(biasing['transform_direction']):
+            if target_organs is not None:
+                biasing['transform_direction'] = target_organ_direction(simulation, organ_volume,
+                                                                        target_organs, spacing)
+            if (target_organs is None) or (biasing['transform_direction'] is None):
+                logger.warning('No target organs for the exponential '
+                               'transform direction of {0}, the transform is '
+                               'ignored'.format(simulation['name']))
+                biasing['exponential_transform'] = 0.
+                biasing['transform_direction'] = simulation['exponential_transform_direction']
+        if biasing['exponential_transform'] > 0:
+            logger.info('Exponential transform of strength {0} along '
+                        '{1}'.format(biasing['exponential_transform'],
+                                     np.round(biasing['transform_direction'], 3)))
+    return importance, biasing
+
+
+def add_engine_counters(counters, run_counters):
+    """Adds the transport event counts of an engine run, None if the engine
+    is not instrumented, to counters."""
+    if run_counters is not None:
+        for name in COUNTERS_DTYPE.names:
+            counters[name] += run_counters[name]
+
+
+def setup_engine(geometry, engine_args, threading, energy_imparted,
+                 energy_squared=None, progress=None):
+    """Returns an Engine created with the engine_args and threading keyword
+    arguments and its simulation set up on geometry, see ExposureBatches,
+    tallying energy in energy_imparted and the optional energy_squared and
+    counting histories in progress.
+    """
+    engine = Engine(**engine_args, **threading)
+    simulation = engine.setup_simulation(geometry['shape'], geometry['spacing'],
+                                         geometry['offset'], geometry['voxels'],
+                                         geometry['lut_shape'], geometry['lut'],
+                                         energy_imparted, geometry['use_siddon'],
+                                         energy_squared=energy_squared,
+                                         importance=geometry['importance'],
+                                         seed=geometry['seed'])
+    if progress is not None:
+        engine.set_progress(simulation, progress)
+    return engine, simulation
+
+
+class ExposureBatches(object):
+    def __init__(self, simulation, geometry, engine_args, energy_imparted,
+                 energy_squared, n_batches, histories, processes=1,
+                 exposure_modulation=None, progress=None, callback=None):
+        """Simulates batches of histories histories for every exposure of
+        simulation, run_batch and end_batch are called for each batch and
+        close after the last batch.
+
+        geometry is a dictionary of the shape, spacing, offset, voxels, lut,
+        lut_shape, use_siddon, importance and seed arguments of
+        Engine.setup_simulation, the engines keep pointers to the arrays.
+        engine_args are keyword arguments for Engine except the threading,
+        which is taken from simulation.
+
+        Blocks of batch_size exposures are simulated with one engine call,
+        by an engine in this process or by an EnginePool of processes
+        engine processes. Energy is tallied in energy_imparted and the sum
+        of squared batch energies in energy_squared if given. Thread
+        autotuning, the bowtie source, the pool and phase space recording
+        are set up on the first block of exposures. Simulation stops
+        between blocks when progress is cancelled.
+        """
+        self.simulation = simulation
+        self.geometry = geometry
+        self.engine_args = engine_args
+        self.energy_imparted = energy_imparted
+        self.energy_squared = energy_squared
+        self.n_batches = n_batches
+        self.histories = histories
+        self.processes = processes
+        self.exposure_modulation = exposure_modulation
+        if progress is None:
+            progress = Progress()
+        self.progress = progress
+        self.callback = callback
+        self.dtype = engine_args['precision']
+        self.threading = engine_threading(simulation)
+        self.counters = np.zeros(1, dtype=COUNTERS_DTYPE)
+        self.start_exposure = simulation['start_at_exposure_no']
+        self.stop_exposure = simulation['stop_at_exposure_no']
+        self.n_stop = None
+        self.last_exposure = None
+
+        # the source is set up once, specter and bowtie are shared by all
+        # exposures and batches and the engine builds its sampling tables
+        # from them once
+        self.source_arrays = ct_simulation_source_arrays(simulation, dtype=self.dtype)
+        self.source_args, self.source = None, None
+        self.pool = None
+        self.recording = None
+        if self.processes <= 1:
+            self.engine, self.engine_simulation = setup_engine(geometry, engine_args, self.threading,
+                                                               energy_imparted, energy_squared,
+                                                               progress)
+        self.time_start = time.perf_counter()
+        self.exposure_time = self.time_start
+        self.histories_start = progress.histories
+
+    def _setup(self, source_args, positions, directions, scan_axes, weights):
+        # with autotuning the thread count and chunk size are chosen on the
+        # first block of exposures and stored with the simulation
+        simulation = self.simulation
+        geometry = self.geometry
+        threading = self.threading
+        self.source_args = source_args
+        if simulation['autotune_threads']:
+            if threading['affinity']:
+                max_threads = len(threading['affinity']) // max(self.processes, 1)
+            else:
+                max_threads = (os.cpu_count() or 1) // max(self.processes, 1)
+            threading['threads'], threading['chunk_size'] = autotune_threads(geometry['shape'], geometry['spacing'], geometry['offset'],
+                                                                             geometry['voxels'], geometry['lut'], geometry['use_siddon'],
+                                                                             source_args, geometry['seed'], positions, directions,
+                                                                             scan_axes, weights, self.histories,
+                                                                             precision=self.dtype, schedule=threading['schedule'],
+                                                                             affinity=threading['affinity'],
+                                                                             max_threads=max(max_threads, 1),
+                                                                             scoring=self.engine_args['scoring'],
+                                                                             forced_interaction=self.engine_args['forced_interaction'],
+                                                                             importance=geometry['importance'],
+                                                                             **{k: self.engine_args[k] for k in ['weight_cutoff', 'roulette_chance', 'weight_window',
+                                                                                                                 'exponential_transform', 'transform_direction']})
+            simulation['threads_per_process'] = threading['threads']
+            simulation['chunk_size'] = threading['chunk_size']
+            if self.processes <= 1:
+                self.engine.set_threading(self.engine_simulation, threads=threading['threads'],
+                                          chunk_size=threading['chunk_size'])
+        if self.processes > 1:
+            self.pool = EnginePool(self.processes, geometry['shape'], geometry['spacing'],
+                                   geometry['offset'], geometry['voxels'], geometry['lut'],
+                                   geometry['use_siddon'], source_args, geometry['seed'],
+                                   progress=self.progress,
+                                   importance=geometry['importance'],
+                                   **self.engine_args, **threading)
+            return
+        self.source = self.engine.setup_source_bowtie(*source_args)
+        phase_space_mode = simulation['phase_space_mode']
+        if phase_space_mode in ('source', 'boundary'):
+            # room for every history of every batch, only photons entering
+            # the volume are recorded in boundary mode
+            self.recording = PhaseSpace(simulation['phase_space_file'],
+                                        capacity=self.n_batches * (self.n_stop - self.start_exposure) * self.histories,
+                                        mode=phase_space_mode, shape=geometry['shape'],
+                                        spacing=geometry['spacing'])
+            self.engine.set_phase_space(self.engine_simulation, self.recording)
+
+    def _log_progress(self, exposures, batch):
+        # logs the elapsed time of exposures simulated exposures and returns
+        # the estimated time left
+        total = max(self.n_batches, batch + 1) * (self.n_stop - self.start_exposure) + self.start_exposure
+        eta = log_elapsed_time(self.time_start, exposures, total, self.start_exposure)
+        if self.callback is not None:
+            self.callback(self.simulation['name'], progressbar_data=[np.squeeze(self.energy_imparted.max(axis=0)), self.geometry['spacing'][1] ,self.geometry['spacing'][2] ,eta, True])
+        return eta
+
+    def run_batch(self, batch):
+        """Simulates all exposures of batch number batch, with a pool the
+        blocks of exposures are queued and waited for."""
+        simulation = self.simulation
+        simulation['start_at_exposure_no'] = self.start_exposure
+        phase_space = ct_source_space(simulation, self.exposure_modulation, dtype=self.dtype,
+                                      source_arrays=self.source_arrays)
+        for p, positions, directions, scan_axes, weights, e, n in batch_phase_space(phase_space, simulation['batch_size']):
+            if 0 < self.stop_exposure < n:
+                self.n_stop = self.stop_exposure
+            else:
+                self.n_stop = n
+            self.last_exposure = e
+            # random streams are numbered by batch, exposure and history so
+            # results do not depend on how exposures are split between runs
+            first_exposure = e + 1 - weights.shape[0]
+            stream = batch * STREAM_BATCH_STRIDE + first_exposure * self.histories
+            if self.source_args is None:
+                self._setup(p, positions, directions, scan_axes, weights)
+            if self.pool is not None:
+                self.pool.submit(stream, positions, directions, scan_axes,
+                                 weights, self.histories)
+                continue
+            self.engine.set_random_stream(self.engine_simulation, stream)
+            add_engine_counters(self.counters,
+                                self.engine.run_bowtie_batch(self.source, positions, directions,
+                                                             scan_axes, weights, self.histories,
+                                                             self.engine_simulation))
+            if self.progress.cancelled:
+                return
+            if (time.perf_counter() - self.exposure_time) > 5:
+                # exposures are counted from the histories the engines have simulated
+                self._log_progress(self.start_exposure + (self.progress.histories - self.histories_start) // self.histories,
+                                   batch)
+                if self.callback is not None:
+                    simulation['start_at_exposure_no'] = e + 1
+                self.exposure_time = time.perf_counter()
+        if self.pool is not None:
+            self.pool.wait()
+
+    def end_batch(self, batch):
+        """Ends batch number batch, the energy imparted in the batch is added
+        to energy_imparted and its square to energy_squared."""
+        if self.pool is None:
+            self.engine.end_batch(self.engine_simulation)
+            return
+        batch_energy = self.pool.collect()
+        self.energy_imparted += batch_energy
+        if self.energy_squared is not None:
+            self.energy_squared += batch_energy**2
+        del batch_energy
+        self._log_progress(batch * (self.n_stop - self.start_exposure) + self.n_stop, batch)
+
+    def energy_scale(self, n_batches):
+        """Returns the factor normalising the energy imparted in n_batches
+        batches to the histories per exposure of the simulation."""
+        return self.simulation['histories'] / (self.histories * n_batches)
+
+    def close(self, n_batches):
+        """Stops the engines and closes the phase space recording of
+        n_batches batches."""
+        if self.pool is not None:
+            self.pool.close()
+            if self.pool.counters is not None:
+                self.counters = self.pool.counters
+        else:
+            if self.source is not None:
+                self.engine.cleanup(source=self.source)
+            self.engine.cleanup(simulation=self.engine_simulation)
+        recording = self.recording
+        if recording is not None:
+            # the recorded photons stand for the histories of every batch
+            # over the simulated exposures
+            recording.exposures = self.n_stop - self.start_exposure
+            recording.source_histories = recording.exposures * self.histories * n_batches
+            if recording.recorded > recording.capacity:
+                logger.warning('Phase space file is full, {0} of {1} photons are '
+                               'stored'.format(recording.capacity, recording.recorded))
+            recording.close()
+            logger.info('{0}: Recorded {1} photons to {2}'.format(time.ctime(), recording.photons,
+                                                              self.simulation['phase_space_file']))
+
+
+class ReplayBatches(object):
+    def __init__(self, simulation, geometry, engine_args, energy_imparted,
+                 energy_squared, n_batches, progress=None, callback=None):
+        """Replays the photons of the phase space file of simulation as the
+        source in n_batches batches with one engine in this process,
+        batches replay consecutive parts of the recorded photons. The
+        arguments and methods are as for ExposureBatches.
+        """
+        self.simulation = simulation
+        self.geometry = geometry
+        self.energy_imparted = energy_imparted
+        self.n_batches = n_batches
+        self.callback = callback
+        self.counters = np.zeros(1, dtype=COUNTERS_DTYPE)
+        self.replay = PhaseSpace(simulation['phase_space_file'])
+        if not self.replay.matches(geometry['shape'], geometry['spacing']):
+            self.replay.close()
+            raise ValueError('Phase space file {} is recorded for another '
+                             'geometry'.format(simulation['phase_space_file']))
+        self.starts = np.linspace(0, self.replay.photons, n_batches + 1).astype('int64')
+        self.last_exposure = self.replay.exposures - 1
+        self.engine, self.engine_simulation = setup_engine(geometry, engine_args,
+                                                           engine_threading(simulation),
+                                                           energy_imparted, energy_squared,
+                                                           progress)
+
+    def run_batch(self, batch):
+        start = int(self.starts[batch])
+        self.engine.set_random_stream(self.engine_simulation, start)
+        add_engine_counters(self.counters,
+                            self.engine.run_phase_space(self.engine_simulation, self.replay, start,
+                                                        int(self.starts[batch + 1]) - start))
+
+    def end_batch(self, batch):
+        self.engine.end_batch(self.engine_simulation)
+        logger.info('{0}: Replayed {1} of {2} phase space '
+                    'batches'.format(time.ctime(), batch + 1, self.n_batches))
+        if self.callback is not None:
+            self.callback(self.simulation['name'], progressbar_data=[np.squeeze(self.energy_imparted.max(axis=0)), self.geometry['spacing'][1] ,self.geometry['spacing'][2] ,'', True])
+
+    def energy_scale(self, n_batches):
+        return self.simulation['histories'] * self.replay.exposures / self.replay.source_histories
+
+    def close(self, n_batches):
+        self.engine.cleanup(simulation=self.engine_simulation)
+        self.replay.close()
+
+
+def raise_if_cancelled(progress, simulation):
+    """Raises SimulationCancelled if progress is cancelled."""
+    if (progress is not None) and progress.cancelled:
+        logger.info('{0}: Simulation {1} is cancelled'.format(time.ctime(), simulation['name']))
+        raise SimulationCancelled('Simulation {} is cancelled'.format(simulation['name']))
 
 
 def ct_runner(materials, simulation, ctarray=None, organ=None,
               organ_material_map=None, exposure_modulation=None,
               energy_imparted_to_dose_conversion=True, callback=None,
-              energy_imparted=None, **kwargs):
+              energy_imparted=None, organ_map=None, material=None,
+              density=None, material_map=None, progress=None,
+              calibration_cache=None, batch_callback=None, **kwargs):
     """Runs a MC simulation on a simulation object, and updates the
     energy_imparted property.
 
@@ -313,36 +1044,85 @@ def ct_runner(materials, simulation, ctarray=None, organ=None,
         ignore_air : [optional] If set, ignores the material 'air' in
             MC calculation
 
+        material, density, material_map : [optional] prepared geometry as
+            returned from an earlier run, used instead of preparing the
+            geometry from the CT or organ arrays
+
+        energy_imparted_to_dose_conversion : if False the dose conversion
+            factors are not calculated
+
+        progress : [optional] an engine Progress counting the simulated
+            histories, cancelling it stops the engines between histories,
+            also in the dose calibration, and ct_runner raises
+            SimulationCancelled
+
+        calibration_cache : [optional] cache of the dose conversion
+            factors, such as a Database, see generate_dose_conversion_factor
+
+        batch_callback : [optional] called with the batch number and an
+            array of the energy imparted in that batch after each batch,
+            before energy_imparted is normalised
+
     OUTPUT:
         None, but updates the energy_imparted property of simulation
     """
     logger.info('Preparing simulation for {}'.format(simulation['name']))
+    if progress is None:
+        progress = Progress()
     if simulation['is_phantom']:
         materials_organic = [m for m in materials]
     else:
         materials_organic = [m for m in materials if m.organic]
 
-    # Validating if everything is in place
-    material, material_map, density = ct_runner_validate_simulation(materials, simulation,
-                                                                    ctarray=ctarray,
-                                                                    organ_material_map=organ_material_map,
-                                                                    organ=organ)
+    dtype = simulation_dtype(simulation)
 
-    phase_space = ct_source_space(simulation, exposure_modulation)
+    if (material is not None) and (density is not None) and (material_map is not None):
+        # using prepared geometry
+        if not isinstance(material_map, dict):
+            material_map = recarray_to_dict(material_map, value_is_string=True)
+        material = material.astype('int32')
+        density = density.astype(dtype)
+    else:
+        # Validating if everything is in place
+        material, material_map, density = ct_runner_validate_simulation(materials, simulation,
+                                                                        ctarray=ctarray,
+                                                                        organ_material_map=organ_material_map,
+                                                                        organ=organ,
+                                                                        dtype=dtype)
 
     N = np.array(material.shape, dtype='int32')
 
-    offset = np.zeros(3, dtype='float64')
-    spacing = (simulation['spacing'] * simulation['scaling']).astype('float64')
+    offset = np.zeros(3, dtype=dtype)
+    spacing = (simulation['spacing'] * simulation['scaling']).astype(dtype)
 
     lut = generate_attinuation_lut(materials_organic, material_map,
-                                   max_eV=500.e3,
-                                   ignore_air=simulation['ignore_air'])
+                                   max_eV=simulation['kV'] * 1000.,
+                                   ignore_air=simulation['ignore_air'],
+                                   log_grid=True, dtype=dtype)
     del energy_imparted
     energy_imparted = None
     if energy_imparted is None:
         energy_imparted = np.zeros_like(density, dtype='float64')
 
+    # histories are split in batches of full passes over all exposures, the
+    # spread between batches gives the dose uncertainty
+    n_batches, histories, max_batches, adaptive = simulation_batches(simulation)
+    target_uncertainty = simulation['target_uncertainty']
+
+    # the energy imparted in the target organs is summed after each batch
+    # for their uncertainty, the organs also steer the importance map and
+    # the exponential transform
+    target_organs, organ_volume = target_organ_volume(simulation, organ, organ_map, N)
+    if target_organs is not None:
+        organ_scaled = organ_volume.ravel()
+        organ_energies = [np.zeros(target_organs.shape, dtype='float64')]
+    else:
+        organ_energies = None
+
+    if n_batches > 1:
+        energy_squared = np.zeros_like(energy_imparted)
+    else:
+        energy_squared = None
 
     tot_histories = simulation['histories'] * simulation['exposures']
 
@@ -353,45 +1133,123 @@ def ct_runner(materials, simulation, ctarray=None, organ=None,
     logger.info('{0}: Starting simulation with about {1} histories per '
                 'rotation{2}'.format(time.ctime(), tot_histories, coffe_msg))
 
-    lut_shape = np.array(lut.shape, dtype='int32')
-
     logger.info('Initializing geometry')
-    use_siddon = np.array([simulation['use_siddon']], dtype='int32')
-    engine = Engine()
-    geometry = engine.setup_simulation(N, spacing, offset, material, density, lut_shape, lut, energy_imparted, use_siddon)
-
-    start_exposure = simulation['start_at_exposure_no']
-    time_start = time.clock()
-    exposure_time = time_start
-
-    for p, e, n in phase_space:
-        source = engine.setup_source_bowtie(*p)
-        engine.run_bowtie(source, simulation['histories'], geometry)
-        engine.cleanup(source=source)
-
-        if (time.clock() - exposure_time) > 5:
-            eta = log_elapsed_time(time_start, e+1, n, start_exposure)
-            if callback is not None:
-                callback(simulation['name'], progressbar_data=[np.squeeze(energy_imparted.max(axis=0)), spacing[1] ,spacing[2] ,eta, True])
-                simulation['start_at_exposure_no'] = e + 1
-            exposure_time = time.clock()
-
-
-    engine.cleanup(simulation=geometry)
-#    time_start = time.clock()
-#    for p, e, n in phase_space:
-#        score_energy(p, N, spacing, offset, material,
-#                     density, lut, energy_imparted)
-#        eta = log_elapsed_time(time_start, e+1, n, start_exposure)
-#        if callback is not None:
-#            callback(simulation['name'], {'energy_imparted': energy_imparted}, e + 1, eta)
-#        simulation['start_at_exposure_no'] = e + 1
+    importance, biasing = simulation_biasing(simulation, target_organs, organ_volume,
+                                             spacing, dtype=dtype)
+    instrumented = simulation['instrumented_engine']
+    engine_args = {'precision': dtype, 'instrumented': instrumented,
+                   'scoring': simulation['energy_scoring'],
+                   'forced_interaction': simulation['forced_interaction']}
+    engine_args.update(biasing)
+
+    # the seed is stored so the simulation can be reproduced
+    seed = simulation['random_seed']
+    if seed == 0:
+        seed = random_seed()
+    simulation['random_seed_used'] = seed
+    # material index and density are packed in one array read with one load
+    # per voxel, the engines keep pointers to the arrays
+    geometry = {'shape': N, 'spacing': spacing, 'offset': offset,
+                'voxels': pack_voxels(material, density), 'lut': lut,
+                'lut_shape': np.array(lut.shape, dtype='int32'),
+                'use_siddon': np.array([simulation['use_siddon']], dtype='int32'),
+                'importance': importance, 'seed': seed}
+
+    # with several processes each block of exposures is simulated by one of
+    # a pool of engines, else by one engine in this process. Photons leaving
+    # the source or entering the volume may be recorded to a phase space
+    # file, or photons from such a file replayed as the source
+    processes = simulation['processes']
+    if (simulation['phase_space_mode'] != 'none') and (processes > 1):
+        logger.warning('Phase space files are recorded and replayed by '
+                       'one engine, ignoring {} processes'.format(processes))
+        processes = 1
+    histories_start = progress.histories
+    interactions_start = progress.interactions
+    if simulation['phase_space_mode'] == 'replay':
+        batches = ReplayBatches(simulation, geometry, engine_args, energy_imparted,
+                                energy_squared, n_batches, progress=progress,
+                                callback=callback)
+    else:
+        batches = ExposureBatches(simulation, geometry, engine_args, energy_imparted,
+                                  energy_squared, n_batches, histories,
+                                  processes=processes,
+                                  exposure_modulation=exposure_modulation,
+                                  progress=progress, callback=callback)
+
+    time_start = time.perf_counter()
+    uncertainty_reached = 0.
+    if batch_callback is not None:
+        batch_start_energy = energy_imparted.copy()
+    batch = 0
+    while batch < max_batches:
+        batches.run_batch(batch)
+        if progress.cancelled:
+            break
+        batches.end_batch(batch)
+        if batch_callback is not None:
+            batch_callback(batch, energy_imparted - batch_start_energy)
+            batch_start_energy[:] = energy_imparted
+        batch += 1
+        if target_organs is not None:
+            organ_energies.append(np.bincount(organ_scaled, weights=energy_imparted.ravel(), minlength=target_organs.max() + 1)[target_organs])
+
+        if not adaptive:
+            if batch >= n_batches:
+                break
+            continue
+
+        # testing if the target uncertainty is reached or if the next batch
+        # would exceed the time budget
+        if (target_uncertainty > 0) and (batch >= 2):
+            uncertainty_reached = batch_target_uncertainty(energy_imparted, energy_squared,
+                                                           batch, organ_energies)
+        if batches_done(simulation, batch, n_batches, uncertainty_reached,
+                        time.perf_counter() - time_start):
+            break
+    n_batches = batch
+    batches.close(n_batches)
+
+    raise_if_cancelled(progress, simulation)
+    logger.info('{0}: Simulated {1} histories with {2} photon '
+                'interactions'.format(time.ctime(), progress.histories - histories_start,
+                                      progress.interactions - interactions_start))
+    if instrumented:
+        counters = {name: int(batches.counters[name][0]) for name in COUNTERS_DTYPE.names}
+        log_engine_counters(counters)
+    else:
+        counters = None
+
+    if energy_squared is not None:
+        uncertainty = relative_uncertainty(energy_imparted, energy_squared,
+                                           n_batches)
+        del energy_squared
+        if target_uncertainty <= 0:
+            uncertainty_reached = np.sum(uncertainty * energy_imparted) / energy_imparted.sum()
+    else:
+        uncertainty = None
+    simulation['uncertainty_reached'] = np.nan_to_num(uncertainty_reached)
+    if (target_organs is not None) and (len(organ_energies) > 2):
+        organ_uncertainty = batch_uncertainty(np.diff(np.array(organ_energies), axis=0))
+        organ_names = recarray_to_dict(organ_map, value_is_string=True)
+        for index, value in zip(target_organs, organ_uncertainty):
+            logger.info('Target organ {0}: relative uncertainty '
+                        '{1:.4f}'.format(organ_names[index], value))
+    simulation['batches_simulated'] = n_batches
+
+    # energy imparted is normalised to the number of histories per exposure
+    # the dose conversion factors are calculated for
+    energy_imparted *= batches.energy_scale(n_batches)
+    e = batches.last_exposure
 
     if callback is not None:
         callback(simulation['name'], progressbar_data=[np.squeeze(energy_imparted.max(axis=0)), spacing[1] ,spacing[2] ,'Preforming dose calibration', True])
-#        callback(simulation['name'], {'energy_imparted': None}, e + 1, 'Preforming dose calibration')
 
-    generate_dose_conversion_factor(simulation, materials, callback)
+    if energy_imparted_to_dose_conversion:
+        generate_dose_conversion_factor(simulation, materials, callback,
+                                        calibration_cache=calibration_cache,
+                                        progress=progress)
+        raise_if_cancelled(progress, simulation)
 
     if callback is not None:
         callback(simulation['name'], {'energy_imparted': None}, e + 1, progressbar_data=[np.squeeze(energy_imparted.max(axis=1)), spacing[0] ,spacing[2] ,'Done', False])
@@ -399,22 +1257,78 @@ def ct_runner(materials, simulation, ctarray=None, organ=None,
     simulation['MC_finished'] = True
     simulation['MC_running'] = False
     simulation['MC_ready'] = False
-    return simulation, {'density': density, 'material': material, 'material_map': material_map, 'energy_imparted': energy_imparted}
+    return simulation, {'density': density, 'material': material, 'material_map': material_map, 'energy_imparted': energy_imparted, 'uncertainty': uncertainty, 'engine_counters': counters}
 
 
-def generate_dose_conversion_factor(simulation, materials, callback=None):
+def calibration_key(simulation, materials, measurement):
+    """Returns a hash of the inputs of a CTDI calibration, measurement is
+    'ctdiair' or 'ctdiw'. The density and attenuation data of the materials
+    are part of the hash, changed material data gives a new key.
+    """
+    parameters = ['kV', 'al_filtration', 'bowtie_radius', 'bowtie_distance',
+                  'sdd', 'scan_fov', 'exposures']
+    if measurement == 'ctdiw':
+        parameters.append('ctdi_phantom_diameter')
+    key = hashlib.sha1()
+    key.update('{0};anode_angle={1!r};total_collimation={2!r};'.format(
+        measurement, CTDI_ANODE_ANGLE,
+        float(simulation['detector_rows'] * simulation['detector_width'])).encode('utf-8'))
+    for name in parameters:
+        key.update('{0}={1!r};'.format(name, float(simulation[name])).encode('utf-8'))
+    for m in sorted(materials, key=lambda m: m.name):
+        key.update('{0}={1!r};'.format(m.name, float(m.density)).encode('utf-8'))
+        key.update(np.ascontiguousarray(m.attinuation).tobytes())
+    return key.hexdigest()
+
+
+def generate_dose_conversion_factor(simulation, materials, callback=None,
+                                    calibration_cache=None, progress=None):
+    """Calculates the CTDIair and CTDIw conversion factors of simulation by
+    simulating the CTDI measurements.
+
+    progress is an optional engine Progress counting the calibration
+    histories, cancelling it stops the calibration and SimulationCancelled
+    is raised, nothing is cached for a cancelled calibration.
+
+    calibration_cache is an optional cache of calibrations with
+    get_calibration(key) and set_calibration(key, value) methods, such as a
+    Database. Cached calibrations are reused unless the simulation
+    recompute_calibration property is set. The factors are cached per
+    history, pitch and measured CTDIw since they scale with these.
+    """
     air, pmma = None, None
     for m in materials:
         if m.name == 'pmma':
             pmma = m
         elif m.name == 'air':
             air = m
+    recompute = (calibration_cache is None) or simulation['recompute_calibration']
 
     if (simulation['ctdi_air100'] > 0.) and (air is not None):
-        obtain_ctdiair_conversion_factor(simulation, air, callback=callback)
+        key = calibration_key(simulation, [air], 'ctdiair')
+        value = None if recompute else calibration_cache.get_calibration(key)
+        if value is None:
+            obtain_ctdiair_conversion_factor(simulation, air, callback=callback,
+                                             progress=progress)
+            value = simulation['conversion_factor_ctdiair'] * simulation['histories'] / simulation['pitch']
+            if (calibration_cache is not None) and (value > 0):
+                calibration_cache.set_calibration(key, value)
+        else:
+            logger.info('Using cached CTDIair100 calibration for {}'.format(simulation['name']))
+            simulation['conversion_factor_ctdiair'] = value * simulation['pitch'] / simulation['histories']
     if (simulation['ctdi_w100'] > 0.) and (pmma is not None) and (air is not None):
-        size = simulation['ctdi_phantom_diameter']
-        obtain_ctdiw_conversion_factor(simulation, pmma, air, size=size, callback=callback)
+        key = calibration_key(simulation, [air, pmma], 'ctdiw')
+        value = None if recompute else calibration_cache.get_calibration(key)
+        if value is None:
+            size = simulation['ctdi_phantom_diameter']
+            obtain_ctdiw_conversion_factor(simulation, pmma, air, size=size,
+                                           callback=callback, progress=progress)
+            value = simulation['conversion_factor_ctdiw'] * simulation['histories'] / simulation['ctdi_w100']
+            if (calibration_cache is not None) and (value > 0):
+                calibration_cache.set_calibration(key, value)
+        else:
+            logger.info('Using cached CTDIw100 calibration for {}'.format(simulation['name']))
+            simulation['conversion_factor_ctdiw'] = value * simulation['ctdi_w100'] / simulation['histories']
 #    else:
 #        msg = """Need a combination of air material and ctdi air or ctdi_w100
 #                 pmma material and ctdiw_100 to generate energy to dose
@@ -423,39 +1337,48 @@ def generate_dose_conversion_factor(simulation, materials, callback=None):
 
 
 
-def obtain_ctdiair_conversion_factor(simulation, air_material, callback=None):
+def obtain_ctdiair_conversion_factor(simulation, air_material, callback=None,
+                                     progress=None):
 
     logger.info('Starting simulating CTDIair100 measurement for '
                 '{0}. CTDIair100 is {1}mGy'.format(simulation['name'], simulation['ctdi_air100']))
-    spacing = np.array((2, 2, 10), dtype='float64')
+    dtype = simulation_dtype(simulation)
+    spacing = np.array((2, 2, 10), dtype=dtype)
 
     N = np.rint(np.array((simulation['sdd'] / spacing[0],
                           simulation['sdd'] / spacing[1], 3),
-                         dtype='int32')).astype('int')
+                         dtype='int32')).astype('int32')
 
-    offset = (-N * spacing / 2.).astype('float64')
+    offset = (-N * spacing / 2.).astype(dtype)
     material_array = np.zeros(N, dtype='int32')
     material_map = {0: air_material.name}
-    density_array = np.zeros(N, dtype='float64') + air_material.density
+    density_array = np.zeros(N, dtype=dtype) + air_material.density
 
-    lut = generate_attinuation_lut([air_material], material_map, max_eV=0.15e6).astype('float64')
+    lut = generate_attinuation_lut([air_material], material_map,
+                                   max_eV=simulation['kV'] * 1000.,
+                                   log_grid=True, dtype=dtype)
     lut_shape = np.array(lut.shape, dtype='int32')
     dose = np.zeros_like(density_array, dtype='float64')
 
-    en_specter = tungsten_specter(simulation['kV'], angle_deg=10.,
+    en_specter = tungsten_specter(simulation['kV'], angle_deg=CTDI_ANODE_ANGLE,
                                   filtration_materials='Al',
                                   filtration_mm=simulation['al_filtration'])
     total_collimation = simulation['detector_rows'] * simulation['detector_width']
 
 
-    engine = Engine()
-    use_siddon = np.array([simulation['use_siddon']], dtype=np.int)
-    geometry = engine.setup_simulation(N, spacing, offset, material_array, density_array, lut_shape, lut, dose, use_siddon)
+    engine = Engine(precision=dtype, **engine_threading(simulation))
+    use_siddon = np.array([simulation['use_siddon']], dtype='int32')
+    voxels = pack_voxels(material_array, density_array)
+    geometry = engine.setup_simulation(N, spacing, offset, voxels, lut_shape, lut, dose, use_siddon,
+                                       seed=simulation['random_seed_used'] or None)
+    if progress is not None:
+        engine.set_progress(geometry, progress)
+    cancelled = False
     teller = 0
-    center = np.floor(N / 2).astype(np.int)
+    center = np.floor(N / 2).astype(int)
     center_dose = 0
-    t1 = time.clock()
-    while center_dose < en_specter[0].max()*1000:
+    t1 = time.perf_counter()
+    while (center_dose < en_specter[0].max()*1000) and not cancelled:
         if teller > 0:
             logger.debug('Not sufficient data, running again. Dose in center is now {0}, max dose: {1}.'.format(center_dose, dose.max()))
         teller += 1
@@ -465,23 +1388,36 @@ def obtain_ctdiair_conversion_factor(simulation, air_material, callback=None):
                              histories=simulation['histories'],
                              energy_specter=en_specter,
                              bowtie_radius=simulation['bowtie_radius'],
-                             bowtie_distance=simulation['bowtie_distance']
+                             bowtie_distance=simulation['bowtie_distance'],
+                             dtype=dtype
                              )
 
-        for batch, e, n in phase_space:
-            source = engine.setup_source_bowtie(*batch)
-            engine.run_bowtie(source, simulation['histories'], geometry)
-            engine.cleanup(source=source)
-    #        break
-            if (time.clock() - t1) > 1:
+        source_args, source = None, None
+        for p, positions, directions, scan_axes, weights, e, n in batch_phase_space(phase_space, simulation['batch_size']):
+            if source is None:
+                source_args = p
+                source = engine.setup_source_bowtie(*source_args)
+            engine.run_bowtie_batch(source, positions, directions, scan_axes,
+                                    weights, simulation['histories'], geometry)
+            if (progress is not None) and progress.cancelled:
+                cancelled = True
+                break
+            if (time.perf_counter() - t1) > 1:
 #                eta = log_elapsed_time(t0, e+1, n, 0)
-                t1 = time.clock()
+                t1 = time.perf_counter()
                 if callback:
                     callback(simulation['name'], progressbar_data=[np.squeeze(dose.max(axis=2)), spacing[0] ,spacing[1] ,'Run number {0}'.format(teller+1), True])
 #                    callback(simulation['name'], {'energy_imparted':dose}, 0, '', save=False)
-        center_dose += np.sum(dose[center[0], center[1], center[2]])
-    callback(simulation['name'], progressbar_data=[np.squeeze(dose.max(axis=2)), spacing[0] ,spacing[1] ,'Done', True])
+        if source is not None:
+            engine.cleanup(source=source)
+        # dose accumulates over the runs, ending the batch reduces the
+        # thread tallies into dose
+        engine.end_batch(geometry)
+        center_dose = np.sum(dose[center[0], center[1], center[2]])
     engine.cleanup(simulation=geometry)
+    raise_if_cancelled(progress, simulation)
+    if callback:
+        callback(simulation['name'], progressbar_data=[np.squeeze(dose.max(axis=2)), spacing[0] ,spacing[1] ,'Done', True])
 
 #    engine.cleanup(simulation=geometry, energy_imparted=dose)
 #    dose = gaussian_filter(dose, (1., 1., 0.))
@@ -490,8 +1426,9 @@ def obtain_ctdiair_conversion_factor(simulation, air_material, callback=None):
     simulation['conversion_factor_ctdiair'] = np.nan_to_num(1. / d * total_collimation)
     return dose
 
-def generate_ctdi_phantom(simulation, pmma, air, size=32., callback=None):
-    spacing = np.array((.1, .1, 2.5), dtype='float64')
+def generate_ctdi_phantom(simulation, pmma, air, size=32., callback=None,
+                          dtype='float64'):
+    spacing = np.array((.1, .1, 2.5), dtype=dtype)
 #    N = np.rint(np.array((simulation['sdd'] / spacing[0],
 #                          simulation['sdd'] / spacing[0], 6),
 #                         )).astype('int32')
@@ -499,7 +1436,7 @@ def generate_ctdi_phantom(simulation, pmma, air, size=32., callback=None):
                           size*1.15 / spacing[0], 6),
                          )).astype('int32')
 
-    offset = (-N * spacing / 2.).astype('float64')
+    offset = (-N * spacing / 2.).astype(dtype)
     material_array = np.zeros(N, dtype='int32')
     radii_phantom = size / spacing[0] / 2
     radii_meas = (1.3 / 2 / spacing[0])
@@ -526,28 +1463,31 @@ def generate_ctdi_phantom(simulation, pmma, air, size=32., callback=None):
                 measure_indices.append(np.argwhere(mask))
 
     material_map = {0: air.name, 1: pmma.name, 2: air.name}
-    density_array = np.zeros_like(material_array, dtype='float64')
+    density_array = np.zeros_like(material_array, dtype=dtype)
     density_array[material_array == 0] = air.density
     density_array[material_array == 1] = pmma.density
     density_array[material_array == 2] = air.density
 
-    lut = generate_attinuation_lut([air, pmma], material_map)
+    lut = generate_attinuation_lut([air, pmma], material_map,
+                                   max_eV=simulation['kV'] * 1000.,
+                                   log_grid=True, dtype=dtype)
     return N, spacing, offset, material_array, density_array, lut, measure_indices
 
 
 def obtain_ctdiw_conversion_factor(simulation, pmma, air,
-                                   size=32., callback=None):
+                                   size=32., callback=None, progress=None):
 
     logger.info('Starting simulating CTDIw100 measurement for '
                 '{}'.format(simulation['name']))
-    args = generate_ctdi_phantom(simulation, pmma, air, size=size)
+    dtype = simulation_dtype(simulation)
+    args = generate_ctdi_phantom(simulation, pmma, air, size=size, dtype=dtype)
     N, spacing, offset, material_array, density_array, lut, meas_pos = args
 
     lut_shape = np.array(lut.shape, dtype='int32')
 
     dose = np.zeros_like(density_array, dtype='float64')
 
-    en_specter = tungsten_specter(simulation['kV'], angle_deg=10.,
+    en_specter = tungsten_specter(simulation['kV'], angle_deg=CTDI_ANODE_ANGLE,
                                   filtration_materials='Al',
                                   filtration_mm=simulation['al_filtration'])
     total_collimation = simulation['detector_rows'] * simulation['detector_width']
@@ -557,41 +1497,53 @@ def obtain_ctdiw_conversion_factor(simulation, pmma, air,
                          histories=simulation['histories'],
                          energy_specter=en_specter,
                          bowtie_radius=simulation['bowtie_radius'],
-                         bowtie_distance=simulation['bowtie_distance']
+                         bowtie_distance=simulation['bowtie_distance'],
+                         dtype=dtype
                          )
-    use_siddon = np.array([simulation['use_siddon']], dtype=np.int)
-    engine = Engine()
-    geometry = engine.setup_simulation(N, spacing, offset, material_array,
-                            density_array, lut_shape, lut, dose, use_siddon)
-
+    use_siddon = np.array([simulation['use_siddon']], dtype='int32')
+    engine = Engine(precision=dtype, **engine_threading(simulation))
+    voxels = pack_voxels(material_array, density_array)
+    geometry = engine.setup_simulation(N, spacing, offset, voxels, lut_shape,
+                                       lut, dose, use_siddon,
+                                       seed=simulation['random_seed_used'] or None)
+    if progress is not None:
+        engine.set_progress(geometry, progress)
 
     history_factor = int(1e8 / simulation['histories'] / simulation['exposures'])
     if history_factor < 1:
         history_factor = 1
     histories = simulation['histories'] * history_factor
-    t0 = time.clock()
+    t0 = time.perf_counter()
     t1 = t0
 
 
-    for batch, e, n in phase_space:
-        source = engine.setup_source_bowtie(*batch)
-        engine.run_bowtie(source, histories, geometry)
-        engine.cleanup(source=source)
+    source_args, source = None, None
+    for p, positions, directions, scan_axes, weights, e, n in batch_phase_space(phase_space, simulation['batch_size']):
+        if source is None:
+            source_args = p
+            source = engine.setup_source_bowtie(*source_args)
+        engine.run_bowtie_batch(source, positions, directions, scan_axes,
+                                weights, histories, geometry)
+        if (progress is not None) and progress.cancelled:
+            break
 
-        if (time.clock() - t1) > 5:
+        if (time.perf_counter() - t1) > 5:
             eta = log_elapsed_time(t0, e+1, n, 0)
             if callback:
                 callback(simulation['name'], progressbar_data=[np.squeeze(dose.max(axis=2)), spacing[0] ,spacing[1] ,eta, True])
 #                callback(simulation['name'], {'energy_imparted':dose}, 0, '', save=False)
-            t1 = time.clock()
+            t1 = time.perf_counter()
+
+    if source is not None:
+        engine.cleanup(source=source)
+    engine.cleanup(simulation=geometry)
+    raise_if_cancelled(progress, simulation)
 
     if callback:
         callback(simulation['name'], progressbar_data=[np.squeeze(dose.max(axis=2)), spacing[0] ,spacing[1] ,'Done', True])
 #        callback(simulation['name'], {'energy_imparted':dose}, 0, 'Done', save=False)
 
     dose /= history_factor
-
-    engine.cleanup(simulation=geometry)
 #
 #    plt.imshow(dose[:,:,1])
 #    plt.show()